@@ -0,0 +1,181 @@
+"""AI chat replies shared by both entry points."""
+import contextlib
+import logging
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional
+
+import clients
+import metrics
+import settings
+import streaming
+from answer_cache import AnswerCache, normalize_question, prompt_version
+from conversation import ConversationMemory, estimate_tokens
+from intent_router import IntentRouter
+from ratelimit import AdaptiveLimiter, UserRateLimiter, retry_after_seconds
+from singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from telegram import Message
+
+logger = logging.getLogger(__name__)
+
+# Shared by every responder in the process: the quota belongs to the OpenAI account
+openai_limiter = AdaptiveLimiter(
+    initial=settings.OPENAI_MAX_CONCURRENCY,
+    maximum=settings.OPENAI_MAX_CONCURRENCY,
+)
+metrics.register_collector("bot_openai_limiter", openai_limiter.stats)
+
+
+class ChatResponder:
+    """Answers user questions with OpenAI, serving repeat questions from cache.
+
+    Recent turns of each user's conversation are sent along with the question
+    so follow-ups keep their context. The answer cache only applies to
+    questions asked without prior context, whose answer depends on nothing
+    but the prompt and the question itself; identical context-free questions
+    asked at the same time share one completion.
+
+    Users asking faster than ``AI_USER_RATE`` get ``slow_down_text`` straight
+    away, and upstream calls go through the process-wide adaptive limiter.
+    Without ``openai_client`` the shared client from :mod:`clients` is used.
+
+    With a ``router``, questions it can answer confidently from the knowledge
+    base are answered locally and never reach OpenAI.
+    """
+
+    def __init__(
+        self,
+        system_prompt: str,
+        namespace: str,
+        slow_down_text: str,
+        model: str = "gpt-3.5-turbo",
+        openai_client=None,
+        router: Optional[IntentRouter] = None,
+    ) -> None:
+        self.openai_client = openai_client
+        self.router = router
+        self.slow_down_text = slow_down_text
+        self.system_prompt = system_prompt
+        self.model = model
+        self.answers = AnswerCache(
+            namespace=namespace,
+            version=prompt_version(system_prompt, model),
+            maxsize=settings.ANSWER_CACHE_SIZE,
+            ttl=settings.ANSWER_CACHE_TTL,
+            path=settings.SHARED_STATE_DB_PATH if settings.ANSWER_CACHE_PERSIST else None,
+        )
+        self.memory = ConversationMemory(
+            token_budget=settings.CHAT_HISTORY_TOKEN_BUDGET,
+            max_turns=settings.CHAT_HISTORY_MAX_TURNS,
+            max_users=settings.CHAT_HISTORY_MAX_USERS,
+        )
+        self.flights = SingleFlight()
+        self.user_limiter = UserRateLimiter(rate=settings.AI_USER_RATE, burst=settings.AI_USER_BURST)
+        self._system_tokens = estimate_tokens(system_prompt)
+        metrics.register_collector("bot_answer_cache", self.answers.stats)
+        metrics.register_collector("bot_answer_flights", self.flights.stats)
+        metrics.register_collector("bot_prompt", self.memory.prompt_stats.snapshot)
+        metrics.register_collector("bot_ai_user_limiter", lambda: {"rejected": self.user_limiter.rejected})
+        if router is not None:
+            metrics.register_collector("bot_intent_router", router.stats)
+
+    async def reply(
+        self,
+        message: "Message",
+        user_id: int,
+        question: str,
+        pin: bool = False,
+        use_history: bool = True,
+    ) -> Optional[str]:
+        """Reply to ``message`` with the answer to ``question`` and return it.
+
+        ``pin`` keeps the answer cached for as long as the prompt is unchanged
+        and ``use_history=False`` answers without (and without recording)
+        conversation context; use both for fixed questions the bot asks on the
+        user's behalf. Upstream errors propagate so the caller can send its
+        own apology. Returns ``None`` if the user was asked to slow down.
+        """
+        if not self.user_limiter.allow(user_id):
+            logger.info("User %s is over the AI rate limit", user_id)
+            await message.reply_text(self.slow_down_text)
+            return None
+
+        # Pinned questions are asked by the bot itself and are answered by the model only once anyway
+        if self.router is not None and not pin:
+            answer = self.router.answer(question)
+            if answer is not None:
+                await message.reply_text(answer)
+                if use_history:
+                    self.memory.append(user_id, question, answer)
+                return answer
+
+        history = self.memory.history(user_id) if use_history else []
+        if not history:
+            answer = await self.answers.get(question)
+            if answer is not None:
+                await message.reply_text(answer)
+                logger.debug("Answer cache hit (%s)", self.answers.stats())
+                if use_history:
+                    self.memory.append(user_id, question, answer)
+                return answer
+
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            *history,
+            {"role": "user", "content": question},
+        ]
+        prompt_tokens = self._system_tokens + sum(estimate_tokens(m["content"]) for m in messages[1:])
+        self.memory.prompt_stats.record(prompt_tokens, len(history))
+        logger.debug("Prompt for user %s: ~%d tokens, %d history messages", user_id, prompt_tokens, len(history))
+
+        if history:
+            answer = await self._complete(message, messages)
+        else:
+            answer, shared = await self.flights.do(
+                (self.answers.version, normalize_question(question)),
+                lambda: self._complete(message, messages),
+            )
+            if shared:
+                await message.reply_text(answer)
+            else:
+                await self.answers.set(question, answer, pinned=pin)
+        if use_history:
+            self.memory.append(user_id, question, answer)
+        return answer
+
+    async def _complete(self, message: "Message", messages: List[Dict[str, str]]) -> str:
+        """Get a completion for ``messages`` and deliver it as a reply to ``message``."""
+        client = self.openai_client or clients.get_openai()
+        if settings.AI_STREAMING:
+            return await streaming.stream_reply(message, streaming.buffered(self._stream(client, messages)))
+        async with _openai_call():
+            response = await client.chat.completions.create(model=self.model, messages=messages)
+        answer = response.choices[0].message.content
+        await message.reply_text(answer)
+        return answer
+
+    async def _stream(self, client, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        async with _openai_call():
+            async for delta in streaming.openai_text_stream(client, model=self.model, messages=messages):
+                yield delta
+
+
+@contextlib.asynccontextmanager
+async def _openai_call() -> AsyncIterator[None]:
+    """Hold an OpenAI slot for the block and time it, backing off if OpenAI rate limits it.
+
+    Only the request itself belongs in the block: sending the reply to
+    Telegram would keep the slot from other users and skew the latency
+    metrics. Waiting for the slot is not timed.
+    """
+    from openai import RateLimitError
+
+    if openai_limiter.queue_depth:
+        logger.debug("Waiting for an OpenAI slot (%s)", openai_limiter.stats())
+    async with openai_limiter.slot():
+        try:
+            with metrics.track_upstream("openai", "chat.completions"):
+                yield
+        except RateLimitError as e:
+            openai_limiter.on_rate_limited(retry_after_seconds(e))
+            raise
@@ -0,0 +1,149 @@
+"""Cache of AI answers keyed by prompt version and normalized question.
+
+The assistant's knowledge base is fixed, so most users get the same answer to
+the same handful of questions. Entries are keyed by a hash of the model and
+system prompt plus the normalized question, so editing the prompt or the
+knowledge base invalidates every old answer automatically. An optional SQLite
+backing store lets answers survive restarts.
+"""
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Dict, Optional
+
+from cache import TTLCache
+from upstream import run_blocking
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def prompt_version(system_prompt: str, model: str) -> str:
+    """Return a short fingerprint of everything that shapes an answer besides the question."""
+    return hashlib.sha256(f"{model}\0{system_prompt}".encode()).hexdigest()[:16]
+
+
+def normalize_question(question: str) -> str:
+    """Fold case, punctuation and whitespace so trivially different questions share an entry."""
+    folded = unicodedata.normalize("NFKC", question).casefold()
+    return _NON_WORD.sub(" ", folded).strip()
+
+
+class AnswerCache:
+    """Size/TTL-bounded answer cache with optional on-disk backing.
+
+    ``namespace`` separates entry points that share one database file; rows in
+    the namespace written under a different prompt version are purged when the
+    store is first opened. Both tiers hold at most ``maxsize`` unpinned answers,
+    the oldest going first. Pinned answers are never evicted or expired.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        version: str,
+        maxsize: int,
+        ttl: float,
+        path: Optional[str] = None,
+    ) -> None:
+        self.namespace = namespace
+        self.version = version
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._pinned: Dict[str, str] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            # Worker processes in cluster mode share this file; WAL lets readers run during writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_cache ("
+                "namespace TEXT NOT NULL, version TEXT NOT NULL, question TEXT NOT NULL, "
+                "answer TEXT NOT NULL, created_at REAL NOT NULL, pinned INTEGER NOT NULL DEFAULT 0, "
+                "PRIMARY KEY (namespace, version, question))"
+            )
+            purged = self._conn.execute(
+                "DELETE FROM answer_cache WHERE namespace = ? AND version != ?",
+                (self.namespace, self.version),
+            ).rowcount
+            self._conn.commit()
+            if purged:
+                logger.info("Purged %d stale cached answers for %s", purged, self.namespace)
+        return self._conn
+
+    def _load(self, question: str) -> Optional[tuple]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT answer, created_at, pinned FROM answer_cache "
+                "WHERE namespace = ? AND version = ? AND question = ?",
+                (self.namespace, self.version, question),
+            ).fetchone()
+
+    def _store(self, question: str, answer: str, pinned: bool) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO answer_cache "
+                "(namespace, version, question, answer, created_at, pinned) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.namespace, self.version, question, answer, time.time(), int(pinned)),
+            )
+            conn.execute(
+                "DELETE FROM answer_cache WHERE namespace = ? AND pinned = 0 AND created_at < ?",
+                (self.namespace, time.time() - self.ttl),
+            )
+            conn.execute(
+                "DELETE FROM answer_cache WHERE rowid IN (SELECT rowid FROM answer_cache "
+                "WHERE namespace = ? AND pinned = 0 ORDER BY created_at DESC, rowid DESC LIMIT -1 OFFSET ?)",
+                (self.namespace, self.maxsize),
+            )
+            conn.commit()
+
+    async def get(self, question: str) -> Optional[str]:
+        """Return the cached answer to ``question``, if any."""
+        key = normalize_question(question)
+        if key in self._pinned:
+            self._memory.hits += 1
+            return self._pinned[key]
+        answer = self._memory.get(key)
+        if answer is not None or self.path is None:
+            return answer
+
+        row = await run_blocking(self._load, key)
+        if row is None:
+            return None
+        answer, created_at, pinned = row
+        if pinned:
+            self._pinned[key] = answer
+        else:
+            remaining = self.ttl - (time.time() - created_at)
+            if remaining <= 0:
+                return None
+            self._memory.set(key, answer, ttl=remaining)
+        # The memory tier already counted this lookup as a miss
+        self._memory.misses -= 1
+        self._memory.hits += 1
+        return answer
+
+    async def set(self, question: str, answer: str, pinned: bool = False) -> None:
+        """Cache ``answer`` for ``question``; pinned answers stay until the prompt changes."""
+        key = normalize_question(question)
+        if pinned:
+            self._pinned[key] = answer
+        else:
+            self._memory.set(key, answer)
+        if self.path is not None:
+            await run_blocking(self._store, key, answer, pinned)
+
+    def stats(self) -> Dict[str, int]:
+        """Return size and hit/miss counters."""
+        return {**self._memory.stats(), "pinned": len(self._pinned)}
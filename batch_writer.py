@@ -0,0 +1,127 @@
+"""Coalesced bulk writes to a Supabase table.
+
+During signup spikes each registration would otherwise cost its own HTTP
+round-trip. :class:`BatchWriter` buffers rows for up to ``max_delay`` seconds
+(or ``max_rows`` rows) and sends them as one bulk insert/upsert, while every
+caller still awaits the outcome of its own row.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import metrics
+
+from upstream import call_upstream
+
+logger = logging.getLogger(__name__)
+
+# (operation, on_conflict) - rows are only coalesced with rows written the same way
+BatchKey = Tuple[str, Optional[str]]
+
+
+class FlushStats:
+    """Counters describing the flushes a writer has performed."""
+
+    def __init__(self) -> None:
+        self.flushes = 0
+        self.rows = 0
+        self.fallbacks = 0
+        self.max_size = 0
+        self.total_seconds = 0.0
+
+    def record(self, size: int, seconds: float) -> None:
+        self.flushes += 1
+        self.rows += size
+        self.max_size = max(self.max_size, size)
+        self.total_seconds += seconds
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "flushes": self.flushes,
+            "rows": self.rows,
+            "fallbacks": self.fallbacks,
+            "mean_flush_size": round(self.rows / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_size": self.max_size,
+            "mean_flush_ms": round(self.total_seconds / self.flushes * 1000, 2) if self.flushes else 0.0,
+        }
+
+
+class BatchWriter:
+    """Buffers row writes to ``table`` and flushes them as bulk requests."""
+
+    def __init__(self, supabase, table: str, max_rows: int = 100, max_delay: float = 0.02) -> None:
+        self.supabase = supabase
+        self.table = table
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.stats = FlushStats()
+        metrics.register_collector(f"bot_{table}_batch", self.stats.snapshot)
+        self._pending: Dict[BatchKey, List[Tuple[Dict[str, Any], asyncio.Future]]] = {}
+        self._timers: Dict[BatchKey, asyncio.TimerHandle] = {}
+
+    async def insert(self, row: Dict[str, Any]) -> Any:
+        """Insert ``row`` as part of the next bulk insert and return the stored row."""
+        return await self._write(("insert", None), row)
+
+    async def upsert(self, row: Dict[str, Any], on_conflict: str) -> Any:
+        """Upsert ``row`` as part of the next bulk upsert and return the stored row."""
+        return await self._write(("upsert", on_conflict), row)
+
+    async def _write(self, key: BatchKey, row: Dict[str, Any]) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((row, future))
+        if len(batch) >= self.max_rows:
+            self._start_flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_delay, self._start_flush, key)
+        return await future
+
+    def _start_flush(self, key: BatchKey) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            asyncio.get_running_loop().create_task(self._flush(key, batch))
+
+    def _execute(self, key: BatchKey, rows: List[Dict[str, Any]]):
+        operation, on_conflict = key
+        query = self.supabase.table(self.table)
+        if operation == "upsert":
+            return query.upsert(rows, on_conflict=on_conflict).execute()
+        return query.insert(rows).execute()
+
+    async def _flush(self, key: BatchKey, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        rows = [row for row, _ in batch]
+        started = time.perf_counter()
+        try:
+            response = await call_upstream("supabase", f"{self.table}.{key[0]}", self._execute, key, rows)
+        except Exception as e:
+            if len(batch) == 1:
+                self._resolve(batch[0][1], error=e)
+            else:
+                # One bad row fails the whole request; split until each caller gets its own outcome
+                self.stats.fallbacks += 1
+                logger.warning("Bulk %s of %d rows into %s failed, splitting: %s", key[0], len(batch), self.table, e)
+                middle = len(batch) // 2
+                await asyncio.gather(self._flush(key, batch[:middle]), self._flush(key, batch[middle:]))
+            return
+
+        elapsed = time.perf_counter() - started
+        self.stats.record(len(batch), elapsed)
+        logger.debug("Flushed %d %s rows into %s in %.1f ms", len(batch), key[0], self.table, elapsed * 1000)
+        data = response.data or []
+        for i, (_, future) in enumerate(batch):
+            self._resolve(future, result=data[i] if len(data) == len(batch) else None)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
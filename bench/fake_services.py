@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+"""Local stand-ins for the Telegram Bot API, Supabase and OpenAI.
+
+One aiohttp server answers all three APIs well enough for the bot to run
+its full flow offline:
+
+* Bot API: ``/bot<token>/<method>`` and file downloads under ``/file/bot<token>/``
+* Supabase: PostgREST tables under ``/rest/v1/`` and Storage under ``/storage/v1/``
+* OpenAI: ``/v1/chat/completions``, including ``stream=true`` (server-sent events)
+
+Each service gets its own latency and error rate, so slow or flaky upstreams
+can be simulated, and the Bot API can enforce Telegram's flood control
+(``--flood-limit`` messages per second overall, ``--chat-flood-limit`` per
+chat) by answering 429 with ``retry_after``. Point the bot at it with::
+
+    python bench/fake_services.py --port 8081 --latency openai=0.4 --error-rate supabase=0.01
+    TELEGRAM_API_URL=http://127.0.0.1:8081 SUPABASE_URL=http://127.0.0.1:8081 \\
+        OPENAI_BASE_URL=http://127.0.0.1:8081/v1 BOT_MODE=webhook python bitid_bot_final.py
+
+``bench/loadgen.py`` starts it in-process and drives the bot with scripted journeys.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import operator
+import random
+import time
+from collections import defaultdict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+SERVICES = ("telegram", "supabase", "openai")
+
+# Bot API methods whose result is a message shown in a chat
+MESSAGE_METHODS = ("sendMessage", "editMessageText", "sendPhoto")
+
+ANSWER = (
+    "BitID is a digital identity generated from a single selfie. It is private, "
+    "free and not transferable, and everyone can hold exactly one. Join Genesis to get yours."
+)
+
+ReplyListener = Callable[[int, str, Dict[str, Any]], None]
+
+
+def _parse_service_values(pairs: List[str], default: float) -> Dict[str, float]:
+    values = dict.fromkeys(SERVICES, default)
+    for pair in pairs:
+        service, _, value = pair.partition("=")
+        if service not in values:
+            raise argparse.ArgumentTypeError(f"unknown service {service!r}, expected one of {SERVICES}")
+        values[service] = float(value)
+    return values
+
+
+def _sample_jpeg() -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        # Not decodable, but the bot only needs bytes when Pillow is missing
+        return b"\xff\xd8\xff\xe0" + bytes(2048) + b"\xff\xd9"
+    out = io.BytesIO()
+    Image.new("RGB", (960, 1280), (200, 170, 150)).save(out, "JPEG", quality=80)
+    return out.getvalue()
+
+
+class FakeServices:
+    """In-memory fake of the upstream APIs the bot talks to.
+
+    ``latency`` and ``error_rate`` map a service name to seconds of added
+    delay (jittered by up to ``jitter``) and the probability of failing a
+    request. Functions in ``reply_listeners`` are called with
+    ``(chat_id, method, message)`` whenever the bot sends or edits a message.
+    ``flood_limit`` and ``chat_flood_limit`` cap messages sent in any one-second
+    window overall and per chat (0 disables); ``flood_errors`` counts the 429s.
+    """
+
+    def __init__(
+        self,
+        latency: Optional[Dict[str, float]] = None,
+        error_rate: Optional[Dict[str, float]] = None,
+        jitter: float = 0.2,
+        token_delay: float = 0.02,
+        flood_limit: int = 0,
+        chat_flood_limit: int = 0,
+    ) -> None:
+        self.latency = {**dict.fromkeys(SERVICES, 0.0), **(latency or {})}
+        self.error_rate = {**dict.fromkeys(SERVICES, 0.0), **(error_rate or {})}
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.flood_limit = flood_limit
+        self.chat_flood_limit = chat_flood_limit
+        self.flood_errors = 0
+        self._sent: Deque[float] = deque()
+        self._chat_sent: Dict[int, Deque[float]] = defaultdict(deque)
+        self.reply_listeners: List[ReplyListener] = []
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.last_request = time.monotonic()
+        self.tables: Dict[str, Dict[Any, Dict[str, Any]]] = defaultdict(dict)
+        self.objects: Dict[str, bytes] = {}
+        self._ids = itertools.count(1)
+        self._row_ids = itertools.count(1)
+        self._shown: Dict[tuple, tuple] = {}
+        self._photo = _sample_jpeg()
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=32 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/bot{token}/{method}", self.bot_api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.bot_file)
+        app.router.add_route("*", "/rest/v1/{table}", self.rest)
+        app.router.add_post("/storage/v1/object/list/{bucket}", self.storage_list)
+        app.router.add_get("/storage/v1/object/public/{bucket}/{path:.+}", self.storage_get)
+        app.router.add_route("*", "/storage/v1/object/{bucket}/{path:.+}", self.storage_object)
+        app.router.add_delete("/storage/v1/object/{bucket}", self.storage_remove)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        return app
+
+    async def _upstream(self, service: str) -> bool:
+        """Apply the service's latency; return ``False`` if this request should fail."""
+        self.calls[service] += 1
+        self.last_request = time.monotonic()
+        delay = self.latency[service]
+        if delay:
+            await asyncio.sleep(delay * (1 + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate[service]:
+            self.errors[service] += 1
+            return False
+        return True
+
+    # Bot API
+
+    async def bot_api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._bot_params(request)
+        if not await self._upstream("telegram"):
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500
+            )
+        if method in MESSAGE_METHODS:
+            retry_after = self._flood_wait(int(params["chat_id"]))
+            if retry_after:
+                self.flood_errors += 1
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {retry_after}",
+                        "parameters": {"retry_after": retry_after},
+                    },
+                    status=429,
+                )
+        handler = getattr(self, f"_tg_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        try:
+            result = handler(params)
+        except _BadRequest as e:
+            return web.json_response({"ok": False, "error_code": 400, "description": str(e)}, status=400)
+        if method in MESSAGE_METHODS:
+            for listener in self.reply_listeners:
+                listener(int(params["chat_id"]), method, result)
+        return web.json_response({"ok": True, "result": result})
+
+    def _flood_wait(self, chat_id: int) -> int:
+        """Record a message to ``chat_id``; return seconds to wait if it breaks a flood limit."""
+        now = time.monotonic()
+        windows = [(self._sent, self.flood_limit), (self._chat_sent[chat_id], self.chat_flood_limit)]
+        wait = 0.0
+        for sent, limit in windows:
+            while sent and sent[0] <= now - 1:
+                sent.popleft()
+            if limit and len(sent) >= limit:
+                wait = max(wait, sent[0] + 1 - now)
+        if wait:
+            return max(1, round(wait))
+        for sent, _ in windows:
+            sent.append(now)
+        if not self._chat_sent[chat_id]:
+            del self._chat_sent[chat_id]
+        return 0
+
+    @staticmethod
+    async def _bot_params(request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        params: Dict[str, Any] = {}
+        for name, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[name] = value
+        return params
+
+    def _message(self, chat_id: int, **fields: Any) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"},
+            **fields,
+        }
+
+    def _tg_getMe(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": 1,
+            "is_bot": True,
+            "first_name": "FakeBot",
+            "username": "fake_bot",
+            "can_join_groups": True,
+            "can_read_all_group_messages": False,
+            "supports_inline_queries": False,
+        }
+
+    def _tg_sendMessage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        message = self._message(params["chat_id"], text=params.get("text", ""))
+        self._shown[(int(params["chat_id"]), message["message_id"])] = (params.get("text"), params.get("reply_markup"))
+        return message
+
+    def _tg_editMessageText(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        key = (int(params["chat_id"]), int(params["message_id"]))
+        shown = (params.get("text"), params.get("reply_markup"))
+        if self._shown.get(key) == shown:
+            raise _BadRequest(
+                "Bad Request: message is not modified: specified new message content and reply markup "
+                "are exactly the same as a current content and reply markup of the message"
+            )
+        self._shown[key] = shown
+        message = self._message(params["chat_id"], text=params.get("text", ""))
+        message["message_id"] = key[1]
+        return message
+
+    def _tg_sendPhoto(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        photo = params.get("photo")
+        file_id = photo if isinstance(photo, str) and not photo.startswith("http") else f"photo{next(self._ids)}"
+        return self._message(
+            params["chat_id"],
+            photo=[{"file_id": file_id, "file_unique_id": f"u{file_id}", "width": 960, "height": 1280}],
+        )
+
+    def _tg_getFile(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        file_id = params["file_id"]
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"u{file_id}",
+            "file_size": len(self._photo),
+            "file_path": f"photos/{file_id}.jpg",
+        }
+
+    async def bot_file(self, request: web.Request) -> web.Response:
+        if not await self._upstream("telegram"):
+            return web.Response(status=500)
+        # Vary the content per file so repeated uploads are not deduplicated away
+        return web.Response(body=self._photo + request.match_info["path"].encode(), content_type="image/jpeg")
+
+    # Supabase REST
+
+    async def rest(self, request: web.Request) -> web.Response:
+        if not await self._upstream("supabase"):
+            return web.json_response({"message": "upstream error", "code": "XX000"}, status=503)
+        table = self.tables[request.match_info["table"]]
+        if request.method == "GET":
+            rows = [row for row in table.values() if _matches(row, request.query)]
+            if "order" in request.query:
+                column = request.query["order"].split(".")[0]
+                rows.sort(key=lambda row: row.get(column))
+            offset = int(request.query.get("offset", 0))
+            limit = request.query.get("limit")
+            rows = rows[offset: offset + int(limit)] if limit is not None else rows[offset:]
+            return web.json_response([_select(row, request.query.get("select", "*")) for row in rows])
+        if request.method in ("POST", "PATCH"):
+            body = await request.json()
+            rows = body if isinstance(body, list) else [body]
+            key_column = request.query.get("on_conflict", "telegram_id")
+            upsert = "merge-duplicates" in request.headers.get("Prefer", "")
+            stored = []
+            for row in rows:
+                key = row.get(key_column)
+                if key in table and not upsert:
+                    return web.json_response(
+                        {"message": "duplicate key value violates unique constraint", "code": "23505"}, status=409
+                    )
+                stored.append(table.setdefault(key, {"id": next(self._row_ids)}))
+                stored[-1].update(row)
+            return web.json_response(stored, status=201)
+        if request.method == "DELETE":
+            doomed = [key for key, row in table.items() if _matches(row, request.query)]
+            return web.json_response([table.pop(key) for key in doomed])
+        return web.Response(status=405)
+
+    # Supabase Storage
+
+    async def storage_object(self, request: web.Request) -> web.Response:
+        if not await self._upstream("supabase"):
+            return web.json_response({"statusCode": "503", "error": "upstream error"}, status=503)
+        key = f"{request.match_info['bucket']}/{request.match_info['path']}"
+        if request.method == "GET":
+            return self._object_response(key)
+        if request.method in ("POST", "PUT"):
+            if request.content_type.startswith("multipart/"):
+                form = await request.post()
+                field = next(iter(form.values()))
+                content = field.file.read() if hasattr(field, "file") else bytes(str(field), "utf-8")
+            else:
+                content = await request.read()
+            if key in self.objects and request.method == "POST" and request.headers.get("x-upsert") != "true":
+                return web.json_response({"statusCode": "409", "error": "Duplicate"}, status=400)
+            self.objects[key] = content
+            return web.json_response({"Key": key, "Id": key})
+        return web.Response(status=405)
+
+    async def storage_get(self, request: web.Request) -> web.Response:
+        if not await self._upstream("supabase"):
+            return web.Response(status=503)
+        return self._object_response(f"{request.match_info['bucket']}/{request.match_info['path']}")
+
+    def _object_response(self, key: str) -> web.Response:
+        if key not in self.objects:
+            return web.json_response({"statusCode": "404", "error": "not_found"}, status=400)
+        return web.Response(body=self.objects[key], content_type="image/jpeg")
+
+    async def storage_remove(self, request: web.Request) -> web.Response:
+        if not await self._upstream("supabase"):
+            return web.json_response({"statusCode": "503", "error": "upstream error"}, status=503)
+        bucket = request.match_info["bucket"]
+        removed = []
+        for name in (await request.json()).get("prefixes", []):
+            if self.objects.pop(f"{bucket}/{name}", None) is not None:
+                removed.append({"name": name, "bucket_id": bucket})
+        return web.json_response(removed)
+
+    async def storage_list(self, request: web.Request) -> web.Response:
+        if not await self._upstream("supabase"):
+            return web.json_response({"statusCode": "503", "error": "upstream error"}, status=503)
+        bucket = request.match_info["bucket"]
+        body = await request.json()
+        prefix = f"{bucket}/{body.get('prefix') or ''}".rstrip("/") + "/"
+        names = sorted(key[len(prefix):] for key in self.objects if key.startswith(prefix))
+        offset, limit = int(body.get("offset", 0)), int(body.get("limit", 100))
+        return web.json_response(
+            [{"name": name, "id": name, "metadata": {"size": len(self.objects[prefix + name])}}
+             for name in names[offset: offset + limit]]
+        )
+
+    # OpenAI
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        if not await self._upstream("openai"):
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after": "1"},
+            )
+        completion_id = f"chatcmpl-{next(self._ids)}"
+        model = body.get("model", "gpt-3.5-turbo")
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 40, "total_tokens": 140},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        try:
+            await send({"role": "assistant", "content": ""})
+            for word in ANSWER.split(" "):
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+                await send({"content": word + " "})
+            await send({}, "stop")
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client went away mid-stream
+            pass
+        return response
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        summary = {service: {"calls": self.calls[service], "errors": self.errors[service]} for service in SERVICES}
+        summary["telegram"]["flood_errors"] = self.flood_errors
+        return summary
+
+
+class _BadRequest(Exception):
+    pass
+
+
+_COMPARISONS = {
+    "eq": operator.eq,
+    "neq": operator.ne,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+
+
+def _matches(row: Dict[str, Any], query) -> bool:
+    """Evaluate PostgREST ``column=op.value`` filters (``eq``, ``neq``, ``gt``, ``gte``, ``lt``, ``lte``, ``in``,
+    ``is.null`` and ``not.is.null``)."""
+    for column, condition in query.items():
+        if column in ("select", "order", "limit", "offset", "on_conflict", "columns"):
+            continue
+        op, _, value = condition.partition(".")
+        actual = row.get(column)
+        if op in ("is", "not") and value in ("null", "is.null"):
+            if (actual is None) != (op == "is"):
+                return False
+            continue
+        if op == "in":
+            if str(actual) not in value.strip("()").split(","):
+                return False
+            continue
+        if actual is None:
+            return False
+        try:
+            expected: Any = type(actual)(value)
+        except (TypeError, ValueError):
+            expected = value
+        compare = _COMPARISONS.get(op)
+        if compare is not None and not compare(actual, expected):
+            return False
+    return True
+
+
+def _select(row: Dict[str, Any], columns: str) -> Dict[str, Any]:
+    if columns in ("*", ""):
+        return dict(row)
+    return {column: row.get(column) for column in columns.split(",")}
+
+
+async def serve(services: FakeServices, host: str, port: int) -> web.AppRunner:
+    """Start ``services`` on ``host:port`` and return the runner (call ``cleanup()`` to stop)."""
+    runner = web.AppRunner(services.build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def add_service_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--latency", action="append", default=[], metavar="SERVICE=SECONDS",
+        help=f"added latency per request for one of {', '.join(SERVICES)} (repeatable)",
+    )
+    parser.add_argument(
+        "--error-rate", action="append", default=[], metavar="SERVICE=FRACTION",
+        help="fraction of requests that fail (repeatable)",
+    )
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative latency jitter")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="delay between streamed OpenAI tokens")
+    parser.add_argument("--flood-limit", type=int, default=0, help="Bot API messages per second before 429 (0: off)")
+    parser.add_argument("--chat-flood-limit", type=int, default=0, help="messages per chat per second before 429")
+
+
+def services_from_args(args: argparse.Namespace) -> FakeServices:
+    return FakeServices(
+        latency=_parse_service_values(args.latency, 0.0),
+        error_rate=_parse_service_values(args.error_rate, 0.0),
+        jitter=args.jitter,
+        token_delay=args.token_delay,
+        flood_limit=args.flood_limit,
+        chat_flood_limit=args.chat_flood_limit,
+    )
+
+
+async def _run_forever(args: argparse.Namespace) -> None:
+    runner = await serve(services_from_args(args), args.host, args.port)
+    print(f"Fake Telegram/Supabase/OpenAI listening on http://{args.host}:{args.port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_service_arguments(parser)
+    try:
+        asyncio.run(_run_forever(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
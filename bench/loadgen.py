@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""Replay scripted user journeys against the bot, fully offline.
+
+Starts :mod:`fake_services` in-process, launches an entry point in webhook
+mode pointed at it, and runs ``--users`` simulated users through
+start -> about -> join -> selfie -> chat, ``--concurrency`` at a time. Each
+step is timed from posting the update to the bot's first visible reply
+(the selfie step waits for the background upload to report back as well).
+
+Reports startup time, throughput, per-step and per-handler p50/p99 latency
+(the latter from the bot's own ``/metrics``), upstream call counts and the
+bot's peak memory; ``--json`` writes the same numbers for comparing runs.
+With ``--workers N`` the bot runs under ``cluster.py`` and metrics and memory
+are summed over the workers.
+
+    python bench/loadgen.py --users 500 --concurrency 50 --latency openai=0.3
+    python bench/loadgen.py --users 2000 --concurrency 200 --workers 4
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from fake_services import add_service_arguments, serve, services_from_args
+from webhook_push import SECRET_HEADER, make_update, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (step name, kind, payload, replies to wait for)
+JOURNEYS = {
+    "bitid_bot_final.py": [
+        ("start", "text", "/start", 1),
+        ("about", "callback", "about", 1),
+        ("join", "callback", "join", 1),
+        ("selfie", "photo", None, 2),
+        ("chat", "text", "What is BitID and why do I need it?", 1),
+    ],
+    "main.py": [
+        ("start", "text", "/start", 1),
+        ("about", "text", "About BitID", 1),
+        ("join", "text", "Join Genesis.BitID", 1),
+        ("selfie", "photo", None, 2),
+        ("discuss", "text", "Discuss, ask about BitID.(ai)", 1),
+        ("chat", "text", "What is BitID and why do I need it?", 1),
+    ],
+}
+
+# A fake JWT: supabase-py validates the shape of the key
+FAKE_SUPABASE_KEY = "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.ZmFrZQ"
+WEBHOOK_SECRET = "bench-secret"
+
+
+class Chats:
+    """Tracks the bot's replies per chat so each step can wait for its answer."""
+
+    def __init__(self) -> None:
+        self.last_message_id: Dict[int, int] = {}
+        self._replies: Dict[int, int] = defaultdict(int)
+        self._events: Dict[int, asyncio.Event] = defaultdict(asyncio.Event)
+
+    def on_reply(self, chat_id: int, method: str, message: Dict[str, Any]) -> None:
+        if method != "editMessageText":
+            self.last_message_id[chat_id] = message["message_id"]
+        self._replies[chat_id] += 1
+        self._events[chat_id].set()
+
+    def replies(self, chat_id: int) -> int:
+        return self._replies[chat_id]
+
+    async def wait(self, chat_id: int, count: int, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while self._replies[chat_id] < count:
+            event = self._events[chat_id]
+            event.clear()
+            await asyncio.wait_for(event.wait(), deadline - time.monotonic())
+
+
+def make_callback(update_id: int, user_id: int, data: str, message_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "FakeBot"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def make_photo(update_id: int, user_id: int) -> dict:
+    update = make_update(update_id, user_id, "")
+    message = update["message"]
+    del message["text"]
+    message["photo"] = [{"file_id": f"selfie{user_id}", "file_unique_id": f"u{user_id}", "width": 960, "height": 1280}]
+    return update
+
+
+def _process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            for child in children.read().split():
+                pids.extend(_process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def process_memory(pid: int) -> Dict[str, Optional[int]]:
+    """Current and peak resident memory of ``pid`` and its children in KiB (Linux only)."""
+    usage: Dict[str, Optional[int]] = {"rss_kib": None, "peak_rss_kib": None}
+    for member in _process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as status:
+                for line in status:
+                    if line.startswith(("VmRSS:", "VmHWM:")):
+                        field = "rss_kib" if line.startswith("VmRSS:") else "peak_rss_kib"
+                        usage[field] = (usage[field] or 0) + int(line.split()[1])
+        except OSError:
+            pass
+    return usage
+
+
+def histogram_quantiles(text: str, name: str, label: str) -> Dict[str, Dict[str, float]]:
+    """Estimate p50/p99 per label value from a Prometheus histogram exposition."""
+    pattern = re.compile(rf'^{name}_bucket\{{{label}="([^"]*)"(?:,[^}}]*)?,le="([^"]+)"\}} (\S+)$', re.M)
+    # Series that differ only in other labels are summed
+    buckets: Dict[str, Dict[float, float]] = defaultdict(lambda: defaultdict(float))
+    for value, bound, count in pattern.findall(text):
+        buckets[value][float("inf") if bound == "+Inf" else float(bound)] += float(count)
+    result = {}
+    for value, counts in buckets.items():
+        series = sorted(counts.items())
+        total = series[-1][1]
+        if not total:
+            continue
+
+        def quantile(q: float) -> float:
+            for bound, cumulative in series:
+                if cumulative >= q * total:
+                    return bound
+            return float("inf")
+
+        result[value] = {"count": total, "p50": quantile(0.5), "p99": quantile(0.99)}
+    return result
+
+
+async def wait_healthy(session: aiohttp.ClientSession, url: str, bot: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if bot.poll() is not None:
+            raise RuntimeError(f"bot exited with code {bot.returncode} before becoming healthy")
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("bot did not become healthy in time")
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    journey = JOURNEYS[os.path.basename(args.entry)]
+    services = services_from_args(args)
+    chats = Chats()
+    services.reply_listeners.append(chats.on_reply)
+    fakes = await serve(services, "127.0.0.1", args.fake_port)
+
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    state_dir = tempfile.mkdtemp(prefix="bitid-bench-")
+    env = {
+        **os.environ,
+        "BOT_MODE": "webhook",
+        "WEBHOOK_LISTEN": "127.0.0.1",
+        "WEBHOOK_PORT": str(args.bot_port),
+        "WEBHOOK_URL": "",
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "TELEGRAM_API_URL": fake_url,
+        "SUPABASE_URL": fake_url,
+        "SUPABASE_SERVICE_KEY": FAKE_SUPABASE_KEY,
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "STATE_DB_PATH": os.path.join(state_dir, "state.sqlite3"),
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": args.log_level,
+    }
+    spawned = time.perf_counter()
+    command = [sys.executable, os.path.join(ROOT, args.entry)]
+    metrics_urls = [f"http://127.0.0.1:{args.bot_port}/metrics"]
+    if args.workers:
+        env["CLUSTER_WORKER_BASE_PORT"] = str(args.worker_base_port)
+        command = [sys.executable, os.path.join(ROOT, "cluster.py"), args.entry, "--workers", str(args.workers)]
+        metrics_urls = [f"http://127.0.0.1:{args.worker_base_port + i}/metrics" for i in range(args.workers)]
+    bot = subprocess.Popen(command, cwd=ROOT, env=env)
+
+    bot_url = f"http://127.0.0.1:{args.bot_port}"
+    step_latency: Dict[str, List[float]] = defaultdict(list)
+    timeouts: Dict[str, int] = defaultdict(int)
+    update_ids = itertools.count(1)
+    memory_peak = 0
+
+    async def user_journey(session: aiohttp.ClientSession, user_id: int) -> None:
+        for name, kind, payload, replies in journey:
+            update_id = next(update_ids)
+            if kind == "callback":
+                update = make_callback(update_id, user_id, payload, chats.last_message_id.get(user_id, 1))
+            elif kind == "photo":
+                update = make_photo(update_id, user_id)
+            else:
+                if name == "chat" and args.question_variants > 1:
+                    # Distinct questions defeat the answer cache and single-flight
+                    payload = f"{payload} ({user_id % args.question_variants})"
+                update = make_update(update_id, user_id, payload)
+            expected = chats.replies(user_id) + replies
+            started = time.perf_counter()
+            async with session.post(
+                f"{bot_url}/telegram", json=update, headers={SECRET_HEADER: WEBHOOK_SECRET}
+            ) as response:
+                await response.read()
+            try:
+                await chats.wait(user_id, expected, args.step_timeout)
+            except asyncio.TimeoutError:
+                timeouts[name] += 1
+                return
+            step_latency[name].append(time.perf_counter() - started)
+            if args.think_time:
+                await asyncio.sleep(args.think_time)
+
+    async def sample_memory() -> None:
+        nonlocal memory_peak
+        while True:
+            memory_peak = max(memory_peak, process_memory(bot.pid)["rss_kib"] or 0)
+            await asyncio.sleep(0.5)
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency)) as session:
+            await wait_healthy(session, f"{bot_url}/healthz", bot, args.startup_timeout)
+            startup = time.perf_counter() - spawned
+            memory_at_start = process_memory(bot.pid)
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def limited(user_id: int) -> None:
+                async with semaphore:
+                    await user_journey(session, user_id)
+
+            sampler = asyncio.create_task(sample_memory())
+            started = time.perf_counter()
+            await asyncio.gather(*(limited(100_000 + i) for i in range(args.users)))
+            elapsed = time.perf_counter() - started
+            # Let streamed answers and background jobs finish before scraping metrics
+            while time.monotonic() - services.last_request < args.drain:
+                await asyncio.sleep(0.1)
+            sampler.cancel()
+
+            expositions = []
+            for url in metrics_urls:
+                async with session.get(url) as response:
+                    expositions.append(await response.text())
+            exposition = "".join(expositions)
+            memory_at_end = process_memory(bot.pid)
+    finally:
+        bot.terminate()
+        try:
+            bot.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        await fakes.cleanup()
+
+    completed = sum(len(samples) for samples in step_latency.values())
+    return {
+        "entry": args.entry,
+        "workers": args.workers,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "startup_s": startup,
+        "elapsed_s": elapsed,
+        "journeys_per_s": len(step_latency[journey[-1][0]]) / elapsed,
+        "updates_per_s": completed / elapsed,
+        "steps": {
+            name: {
+                "count": len(step_latency[name]),
+                "timeouts": timeouts[name],
+                "p50_ms": percentile(step_latency[name], 50) * 1000 if step_latency[name] else None,
+                "p99_ms": percentile(step_latency[name], 99) * 1000 if step_latency[name] else None,
+                "mean_ms": statistics.mean(step_latency[name]) * 1000 if step_latency[name] else None,
+            }
+            for name, *_ in journey
+        },
+        "handlers": histogram_quantiles(exposition, "bot_handler_seconds", "handler"),
+        "upstream": histogram_quantiles(exposition, "bot_upstream_seconds", "service"),
+        "fake_services": services.summary(),
+        "memory": {
+            "rss_start_kib": memory_at_start["rss_kib"],
+            "rss_end_kib": memory_at_end["rss_kib"],
+            "rss_peak_kib": max(memory_peak, memory_at_end["peak_rss_kib"] or 0) or None,
+        },
+    }
+
+
+def _ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+def report(result: Dict[str, Any]) -> None:
+    print(
+        f"entry:       {result['entry']} ({result['users']} users, concurrency {result['concurrency']}"
+        + (f", {result['workers']} workers)" if result["workers"] else ")")
+    )
+    print(f"startup:     {result['startup_s']:.2f} s (spawn to healthy)")
+    print(f"elapsed:     {result['elapsed_s']:.2f} s")
+    print(f"throughput:  {result['journeys_per_s']:.1f} journeys/s, {result['updates_per_s']:.1f} updates/s")
+    print()
+    print(f"{'step':<10} {'count':>6} {'timeouts':>8} {'p50 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for name, step in result["steps"].items():
+        print(
+            f"{name:<10} {step['count']:>6} {step['timeouts']:>8} "
+            f"{_ms(step['p50_ms']):>9} {_ms(step['p99_ms']):>9} {_ms(step['mean_ms']):>9}"
+        )
+    print()
+    print(f"{'handler (bucketed)':<28} {'count':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, stats in sorted(result["handlers"].items()):
+        print(f"{name:<28} {int(stats['count']):>6} {stats['p50'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+    print()
+    print(f"{'upstream (bucketed)':<28} {'count':>6} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, stats in sorted(result["upstream"].items()):
+        print(f"{name:<28} {int(stats['count']):>6} {stats['p50'] * 1000:>9.1f} {stats['p99'] * 1000:>9.1f}")
+    print()
+    print("fake upstream calls: " + ", ".join(
+        f"{service} {counts['calls']} ({counts['errors']} failed)" for service, counts in result["fake_services"].items()
+    ))
+    memory = result["memory"]
+    print(
+        "bot memory:  start {} KiB, end {} KiB, peak {} KiB".format(
+            memory["rss_start_kib"], memory["rss_end_kib"], memory["rss_peak_kib"]
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entry", default="bitid_bot_final.py", choices=sorted(JOURNEYS))
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users (one journey each)")
+    parser.add_argument("--concurrency", type=int, default=50, help="journeys in flight at once")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pause between a user's steps")
+    parser.add_argument(
+        "--question-variants", type=int, default=1, help="number of distinct chat questions across users"
+    )
+    parser.add_argument("--drain", type=float, default=1.0, help="idle seconds to wait for before collecting metrics")
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--startup-timeout", type=float, default=30.0)
+    parser.add_argument("--workers", type=int, default=0, help="run through cluster.py with this many workers")
+    parser.add_argument("--worker-base-port", type=int, default=9500)
+    parser.add_argument("--fake-port", type=int, default=8081)
+    parser.add_argument("--bot-port", type=int, default=8443)
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL for the bot process")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    add_service_arguments(parser)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(result, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
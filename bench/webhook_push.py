@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Push synthetic updates at a bot running with ``BOT_MODE=webhook``.
+
+Acts as a minimal fake Telegram: POSTs ``message`` updates to the webhook
+endpoint with the secret-token header and reports accepted updates/sec and
+acknowledgement latency percentiles.
+
+    python bench/webhook_push.py --url http://127.0.0.1:8443/telegram --count 5000
+"""
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+
+import aiohttp
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+            **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]} if text.startswith("/") else {}),
+        },
+    }
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def push(args: argparse.Namespace) -> None:
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    update_ids = itertools.count(1)
+    latencies = []
+    failures = 0
+
+    async def worker(session: aiohttp.ClientSession, n: int) -> None:
+        nonlocal failures
+        for _ in range(n):
+            update_id = next(update_ids)
+            update = make_update(update_id, 10_000 + update_id % args.users, args.text)
+            started = time.perf_counter()
+            async with session.post(args.url, json=update, headers=headers) as response:
+                await response.read()
+                if response.status != 200:
+                    failures += 1
+            latencies.append(time.perf_counter() - started)
+
+    per_worker, extra = divmod(args.count, args.concurrency)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(worker(session, per_worker + (i < extra)) for i in range(args.concurrency))
+        )
+        elapsed = time.perf_counter() - started
+
+    print(f"updates:     {len(latencies)} ({failures} failed)")
+    print(f"throughput:  {len(latencies) / elapsed:.1f} updates/s")
+    print(
+        "ack latency: p50 {:.2f} ms, p99 {:.2f} ms, mean {:.2f} ms".format(
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000,
+            statistics.mean(latencies) * 1000,
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--users", type=int, default=500, help="number of distinct simulated users")
+    parser.add_argument("--text", default="/home", help="message text to send")
+    asyncio.run(push(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,122 +1,52 @@
 #!/usr/bin/env python3
-from supabase import create_client
-from openai import OpenAI
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-
-# Direct config
-TELEGRAM_BOT_TOKEN = TELEGRAM_TOKEN
-SUPABASE_URL = SUPABASE_URL
-SUPABASE_SERVICE_KEY = SUPABASE_SERVICE_KEY
-OPENAI_API_KEY = OPENAI_API_KEY
-
-print(f"Starting BitID bot with token: {TELEGRAM_BOT_TOKEN[:20]}...")
-
-# Setup
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Inline Keyboards
-MAIN_KEYBOARD = InlineKeyboardMarkup([
-    [InlineKeyboardButton("About BitID", callback_data="about")],
-    [InlineKeyboardButton("Join Genesis.BitID", callback_data="join")],
-    [InlineKeyboardButton("Discuss, ask about BitID.(ai)", callback_data="discuss")],
-])
-
-BACK_KEYBOARD = InlineKeyboardMarkup([
-    [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back")]
-])
-
-# About submenu keyboards
-ABOUT_SUBMENU = InlineKeyboardMarkup([
-    [InlineKeyboardButton("What is BitID", callback_data="what_is")],
-    [InlineKeyboardButton("BitID properties", callback_data="properties")],
-    [InlineKeyboardButton("Use cases of BitID", callback_data="use_cases")],
-    [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back")]
-])
-
-BACK_TO_ABOUT = InlineKeyboardMarkup([
-    [InlineKeyboardButton("🔙 Back to About", callback_data="about")]
-])
-
-USE_CASES_SUBMENU = InlineKeyboardMarkup([
-    [InlineKeyboardButton("Use case: Get Connected", callback_data="uc_connected")],
-    [InlineKeyboardButton("Use case: Device-less Access", callback_data="uc_deviceless")],
-    [InlineKeyboardButton("Use case: Fraud Prevention", callback_data="uc_fraud")],
-    [InlineKeyboardButton("🔙 Back to About", callback_data="about")]
-])
-
-BACK_TO_USE_CASES = InlineKeyboardMarkup([
-    [InlineKeyboardButton("🔙 Back to Use Cases", callback_data="use_cases")]
-])
-
-async def start(update, context):
-    print(f"START from user {update.effective_user.id}")
-    # Only greet once
-    if not context.user_data.get('greeted'):
-        greeting = """Welcome to BitID!
-
-I'm Buddy, your guide to the BitID identity network. I'll help you understand how BitID works and register you in Genesis by collecting your selfie.
-
-Please choose an option:"""
-        await update.message.reply_text(
-            greeting,
-            reply_markup=MAIN_KEYBOARD
-        )
-        context.user_data['greeted'] = True
-    else:
-        # Just show menu without greeting
-        await update.message.reply_text(
-            "Choose an option:", 
-            reply_markup=MAIN_KEYBOARD
-        )
-    # Clear only specific states, keep greeted flag
-    context.user_data.pop('awaiting_selfie_registration', None)
-    context.user_data.pop('awaiting_selfie_replacement', None)
-    context.user_data.pop('ai_chat_enabled', None)
-    context.user_data.pop('photo_message_id', None)
-
-async def home(update, context):
-    """Handle /home command - same as start but never greets."""
-    print(f"HOME command from user {update.effective_user.id}")
-    await update.message.reply_text(
-        "Choose an option:", 
-        reply_markup=MAIN_KEYBOARD
-    )
-
-async def button_callback(update, context):
-    """Handle inline button callbacks."""
-    query = update.callback_query
-    user_id = query.from_user.id
-    data = query.data
-    
-    print(f"BUTTON CALLBACK: {data} from user {user_id}")
-    
-    # Answer the callback to remove loading state
-    await query.answer()
-    
-    if data == "about":
-        await query.edit_message_text(
-            "About BitID\n\nChoose a topic:",
-            reply_markup=ABOUT_SUBMENU
-        )
-        
-    elif data == "what_is":
-        what_is_text = """What is BitID
+import asyncio
+import functools
+import logging
+
+import clients
+import metrics
+import selfies
+import settings
+import users
+from ai_chat import ChatResponder
+from intent_router import IntentRouter
+from jobs import DurableQueue, QueueFull
+from menus import MenuRegistry
+
+logger = logging.getLogger(__name__)
+
+# Menus
+menu = MenuRegistry("bitid_bot_final")
+menu.add(
+    "main",
+    "Choose an option:",
+    [
+        ("About BitID", "about"),
+        ("Join Genesis.BitID", "join"),
+        ("Discuss, ask about BitID.(ai)", "discuss"),
+    ],
+    back_label="🔙 Back to Main Menu",
+    back_target="back",
+)
+menu.add(
+    "about",
+    "About BitID\n\nChoose a topic:",
+    [
+        ("What is BitID", "what_is"),
+        ("BitID properties", "properties"),
+        ("Use cases of BitID", "use_cases"),
+    ],
+    parent="main",
+    back_label="🔙 Back to About",
+)
+menu.add("what_is", """What is BitID
 
 • Network of human participants running permissionless biometric identification protocol software
 
 • Think ID issued by network of people you ever met and exchanged bits of identity information
 
-• This network validates your identity to people you never met that are not part of the network"""
-        
-        await query.edit_message_text(
-            what_is_text,
-            reply_markup=BACK_TO_ABOUT
-        )
-        
-    elif data == "properties":
-        properties_text = """BitID Properties
+• This network validates your identity to people you never met that are not part of the network""", parent="about")
+menu.add("properties", """BitID Properties
 
 • Your face is your public ID
 
@@ -132,203 +62,229 @@ async def button_callback(update, context):
 
 • You can ask how far any person from you in the network
 
-• Algorithm defines core network consisting of real humans and edge networks comprised of bots"""
-        
-        await query.edit_message_text(
-            properties_text,
-            reply_markup=BACK_TO_ABOUT
-        )
-        
-    elif data == "use_cases":
-        await query.edit_message_text(
-            "Use Cases of BitID\n\nChoose a use case:",
-            reply_markup=USE_CASES_SUBMENU
-        )
-        
-    elif data == "uc_connected":
-        uc_connected_text = """Use Case: Get Connected
+• Algorithm defines core network consisting of real humans and edge networks comprised of bots""", parent="about")
+menu.add(
+    "use_cases",
+    "Use Cases of BitID\n\nChoose a use case:",
+    [
+        ("Use case: Get Connected", "uc_connected"),
+        ("Use case: Device-less Access", "uc_deviceless"),
+        ("Use case: Fraud Prevention", "uc_fraud"),
+    ],
+    parent="about",
+    back_label="🔙 Back to Use Cases",
+)
+menu.add("uc_connected", """Use Case: Get Connected
 
 • There is no easy way to write somebody who did not gave you his identifier on one of centralized platforms
 
 • Why can't I just write to the person I see on stage or on TV?
 
-• BitID is identifier unique to the person and can be used to build permissionless messaging system"""
-        
-        await query.edit_message_text(
-            uc_connected_text,
-            reply_markup=BACK_TO_USE_CASES
-        )
-        
-    elif data == "uc_deviceless":
-        uc_deviceless_text = """Use Case: Device-less Access
+• BitID is identifier unique to the person and can be used to build permissionless messaging system""", parent="use_cases")
+menu.add("uc_deviceless", """Use Case: Device-less Access
 
 • Venue host issues access permission for your BitID
 
-• You present only your face at venue to get access"""
-        
-        await query.edit_message_text(
-            uc_deviceless_text,
-            reply_markup=BACK_TO_USE_CASES
-        )
-        
-    elif data == "uc_fraud":
-        uc_fraud_text = """Use Case: Fraud Prevention
+• You present only your face at venue to get access""", parent="use_cases")
+menu.add("uc_fraud", """Use Case: Fraud Prevention
 
 • Bad actors can use faceless ID system to manufacture fake identities to exploit trust built online
 
 • In contrast face identification system allows only one identity per person making every participant accountable for their actions
 
-• Which in turn builds trust and reduce economical interaction friction"""
-        
-        await query.edit_message_text(
-            uc_fraud_text,
-            reply_markup=BACK_TO_USE_CASES
-        )
+• Which in turn builds trust and reduce economical interaction friction""", parent="use_cases")
+
+@metrics.instrument_handler("start")
+async def start(update, context):
+    logger.info("/start")
+    # Only greet once
+    if not context.user_data.get('greeted'):
+        greeting = """Welcome to BitID!
+
+I'm Buddy, your guide to the BitID identity network. I'll help you understand how BitID works and register you in Genesis by collecting your selfie.
+
+Please choose an option:"""
+        await menu.send(update.message, "main", greeting)
+        context.user_data['greeted'] = True
+    else:
+        # Just show menu without greeting
+        await menu.send(update.message, "main")
+    # Clear only specific states, keep greeted flag
+    context.user_data.pop('awaiting_selfie_registration', None)
+    context.user_data.pop('awaiting_selfie_replacement', None)
+    context.user_data.pop('ai_chat_enabled', None)
+    context.user_data.pop('photo_message_id', None)
+    buddy.memory.clear(update.effective_user.id)
+    users.join_prefetch.start(update.effective_user.id)
+
+@metrics.instrument_handler("home")
+async def home(update, context):
+    """Handle /home command - same as start but never greets."""
+    logger.info("/home")
+    await menu.send(update.message, "main")
+    users.join_prefetch.start(update.effective_user.id)
+
+@metrics.instrument_handler("button_callback", label=lambda update: update.callback_query.data)
+async def button_callback(update, context):
+    """Handle inline button callbacks."""
+    query = update.callback_query
+    logger.info("Button callback: %s", query.data)
+
+    # Answer the callback to remove loading state
+    await query.answer()
+    if query.data != "join":
+        users.join_prefetch.discard(query.from_user.id)
+
+    if not await menu.dispatch(update, context, query.data):
+        logger.warning("Unknown callback data: %s", query.data)
+
+@menu.action("join")
+async def join(update, context):
+    query = update.callback_query
+    telegram_id = query.from_user.id
+    try:
+        # Check if user exists (usually prefetched when the main menu was shown)
+        data = await users.join_prefetch.take(telegram_id) or await users.join_data(telegram_id)
+        logger.debug("Registered: %s", data.registered)
         
-    elif data == "join":
-        telegram_id = query.from_user.id
-        try:
-            # Check if user exists
-            response = supabase.table("users").select("id").eq("telegram_id", telegram_id).execute()
-            print(f"DB check result: {response}")
-            
-            if response.data and len(response.data) > 0:
-                # User exists - show photo
-                try:
-                    import time
-                    cache_buster = int(time.time())
-                    photo_url = supabase.storage.from_("user_selfies").get_public_url(f"{telegram_id}.jpg")
-                    photo_url_with_cache_buster = f"{photo_url}?v={cache_buster}"
-                    print(f"Photo URL: {photo_url_with_cache_buster}")
-                    
-                    await query.edit_message_text(
-                        "Here is your registration photo:\n\nIf you want to replace it - send a new selfie.",
-                        reply_markup=BACK_KEYBOARD
-                    )
-                    # Send photo separately and save message ID for later deletion
-                    photo_message = await context.bot.send_photo(
-                        chat_id=query.message.chat_id,
-                        photo=photo_url_with_cache_buster
-                    )
-                    context.user_data['awaiting_selfie_replacement'] = True
-                    context.user_data['photo_message_id'] = photo_message.message_id
-                    
-                except Exception as photo_error:
-                    print(f"Photo error: {photo_error}")
-                    await query.edit_message_text(
-                        "You are registered but photo not found. Send a new selfie.",
-                        reply_markup=BACK_KEYBOARD
-                    )
-                    context.user_data['awaiting_selfie_replacement'] = True
-            else:
-                # User doesn't exist
-                await query.edit_message_text(
-                    "You don't have BitID. Send a selfie to get BitID.",
-                    reply_markup=BACK_KEYBOARD
-                )
-                context.user_data['awaiting_selfie_registration'] = True
-                
-        except Exception as e:
-            print(f"DB error: {e}")
-            await query.edit_message_text(
-                "You don't have BitID. Send a selfie to get BitID.",
-                reply_markup=BACK_KEYBOARD
+        if data.registered:
+            # User exists - edit the menu and send the photo at the same time
+            edited, photo_message = await asyncio.gather(
+                menu.edit(
+                    query,
+                    "Here is your registration photo:\n\nIf you want to replace it - send a new selfie.",
+                    menu.back_markup("main"),
+                ),
+                selfies.send_selfie(
+                    functools.partial(context.bot.send_photo, chat_id=query.message.chat_id),
+                    clients.get_supabase(),
+                    telegram_id,
+                    file_id=data.file_id,
+                ),
+                return_exceptions=True,
             )
+            context.user_data['awaiting_selfie_replacement'] = True
+            if isinstance(photo_message, BaseException):
+                logger.warning("Could not send registration photo: %s", photo_message)
+                await menu.edit(query, "You are registered but photo not found. Send a new selfie.", menu.back_markup("main"))
+            else:
+                # Save message ID for later deletion
+                context.user_data['photo_message_id'] = photo_message.message_id
+                if isinstance(edited, BaseException):
+                    # The photo is already there; the menu just keeps its previous text
+                    logger.warning("Could not update the Join message: %s", edited)
+        else:
+            # User doesn't exist
+            await menu.edit(query, "You don't have BitID. Send a selfie to get BitID.", menu.back_markup("main"))
             context.user_data['awaiting_selfie_registration'] = True
             
-    elif data == "discuss":
-        await query.edit_message_text(
-            "Hi! I'm Buddy, I help you learn about BitID and will register you in Genesis as soon as I get your selfie. Will you send a photo now or want to know more about the project?",
-            reply_markup=BACK_KEYBOARD
-        )
-        context.user_data['ai_chat_enabled'] = True
-        
-    elif data == "back":
-        # Delete photo if it exists
-        if context.user_data.get('photo_message_id'):
-            try:
-                await context.bot.delete_message(
-                    chat_id=query.message.chat_id,
-                    message_id=context.user_data['photo_message_id']
-                )
-                print(f"Deleted photo message {context.user_data['photo_message_id']}")
-            except Exception as e:
-                print(f"Could not delete photo message: {e}")
-        
-        # Return to main menu without greeting
-        await query.edit_message_text(
-            "Choose an option:",
-            reply_markup=MAIN_KEYBOARD
-        )
-        # Clear states but keep greeted flag
-        greeted = context.user_data.get('greeted', False)
-        context.user_data.clear()
-        context.user_data['greeted'] = greeted
+    except Exception:
+        logger.exception("Registration lookup failed")
+        await menu.edit(query, "You don't have BitID. Send a selfie to get BitID.", menu.back_markup("main"))
+        context.user_data['awaiting_selfie_registration'] = True
+
+@menu.action("discuss")
+async def discuss(update, context):
+    await menu.edit(
+        update.callback_query,
+        "Hi! I'm Buddy, I help you learn about BitID and will register you in Genesis as soon as I get your selfie. Will you send a photo now or want to know more about the project?",
+        menu.back_markup("main"),
+    )
+    context.user_data['ai_chat_enabled'] = True
 
+@menu.action("back")
+async def back(update, context):
+    query = update.callback_query
+    # Delete photo if it exists
+    if context.user_data.get('photo_message_id'):
+        try:
+            await context.bot.delete_message(
+                chat_id=query.message.chat_id,
+                message_id=context.user_data['photo_message_id']
+            )
+            logger.debug("Deleted photo message %s", context.user_data['photo_message_id'])
+        except Exception as e:
+            logger.warning("Could not delete photo message: %s", e)
+    
+    # Return to main menu without greeting
+    await menu.show(update, "main")
+    users.join_prefetch.start(query.from_user.id)
+    # Clear states but keep greeted flag
+    greeted = context.user_data.get('greeted', False)
+    context.user_data.clear()
+    context.user_data['greeted'] = greeted
+
+@metrics.instrument_handler("photo")
 async def photo(update, context):
-    print(f"PHOTO from user {update.effective_user.id}")
-    print(f"User state: {context.user_data}")
+    logger.info("Photo received")
+    logger.debug("User state: %s", dict(context.user_data))
     
     if context.user_data.get('awaiting_selfie_registration') or context.user_data.get('awaiting_selfie_replacement'):
         try:
-            # Download photo
-            photo_file = await update.message.photo[-1].get_file()
-            file_content = await photo_file.download_as_bytearray()
-            telegram_id = update.effective_user.id
-            file_path = f"{telegram_id}.jpg"
-            print(f"Photo downloaded, size: {len(file_content)} bytes")
-
-            # Upload to storage (force overwrite)
-            try:
-                # Try to remove existing file first
-                supabase.storage.from_("user_selfies").remove([file_path])
-                print(f"Removed existing file: {file_path}")
-            except:
-                print(f"No existing file to remove: {file_path}")
-                
-            upload_result = supabase.storage.from_("user_selfies").upload(
-                file=bytes(file_content), 
-                path=file_path, 
-                file_options={"content-type": "image/jpeg"}
+            # Upload and registration run in the background; the outcome arrives as a follow-up
+            await selfie_jobs.enqueue({
+                "telegram_id": update.effective_user.id,
+                "chat_id": update.effective_chat.id,
+                "file_id": update.message.photo[-1].file_id,
+                "register": bool(context.user_data.get('awaiting_selfie_registration')),
+            })
+            users.join_prefetch.discard(update.effective_user.id)
+        except QueueFull:
+            logger.warning("Selfie queue full, asking user to retry")
+            await update.message.reply_text(
+                "We are receiving a lot of selfies right now. Please send yours again in a minute."
             )
-            print(f"Upload result: {upload_result}")
-
-            if context.user_data.get('awaiting_selfie_registration'):
-                # Register new user
-                insert_result = supabase.table("users").insert({"telegram_id": telegram_id}).execute()
-                print(f"User registration result: {insert_result}")
-                await update.message.reply_text(
-                    "Thank you for registration! We will send you BitID as soon as it is generated.",
-                    reply_markup=MAIN_KEYBOARD
-                )
-            else:
-                # Photo replacement
-                await update.message.reply_text(
-                    "Your photo has been updated!",
-                    reply_markup=MAIN_KEYBOARD
-                )
-            
-            # Clear registration states but keep greeted
-            greeted = context.user_data.get('greeted', True)
-            context.user_data.clear()
-            context.user_data['greeted'] = greeted
-            
+            return
         except Exception as e:
-            print(f"Photo processing error: {e}")
+            logger.exception("Could not queue selfie")
             await update.message.reply_text(f"Error processing photo: {e}")
+            return
+
+        await update.message.reply_text("Got your selfie! I'll let you know as soon as it is saved.")
+
+        # Clear registration states but keep greeted
+        greeted = context.user_data.get('greeted', True)
+        context.user_data.clear()
+        context.user_data['greeted'] = greeted
     else:
         # Photo sent outside registration - treat as AI chat
-        print("Photo sent outside registration - treating as AI question")
-        await handle_ai_message(update, context, "What can you tell me about this photo and BitID?")
-
-async def handle_ai_message(update, context, user_message=None):
-    """Handle AI chat messages."""
-    if not user_message:
-        user_message = update.message.text
-        
-    print(f"AI CHAT: '{user_message}' from user {update.effective_user.id}")
-    
-    bitid_knowledge = """WHAT IS BitID:
+        logger.debug("Photo sent outside registration - treating as AI question")
+        await handle_ai_message(update, context, PHOTO_QUESTION, pin=True)
+
+async def process_selfie_job(bot, job):
+    """Store a queued selfie, register the user if needed and report back."""
+    telegram_id = job["telegram_id"]
+    supabase = clients.get_supabase()
+    stored = await selfies.store_from_telegram(bot, supabase, telegram_id, job["file_id"])
+    logger.info("Selfie for user %s stored: %s", telegram_id, stored)
+
+    if job["register"]:
+        # A retried job may already have inserted the user
+        if not await users.is_registered(supabase, telegram_id):
+            insert_result = await users.register_user(supabase, telegram_id)
+            logger.info("User %s registered: %s", telegram_id, insert_result)
+        text = "Thank you for registration! We will send you BitID as soon as it is generated."
+    else:
+        users.mark_registered(telegram_id)
+        text = "Your photo has been updated!"
+    await bot.send_message(chat_id=job["chat_id"], text=text, reply_markup=menu.markup("main"))
+
+async def selfie_job_failed(bot, job, error):
+    logger.error("Photo processing error for user %s: %s", job['telegram_id'], error)
+    await bot.send_message(chat_id=job["chat_id"], text=f"Error processing photo: {error}")
+
+selfie_jobs = DurableQueue(
+    settings.STATE_DB_PATH,
+    "selfies",
+    process_selfie_job,
+    on_failure=selfie_job_failed,
+    workers=settings.JOB_WORKERS,
+    max_attempts=settings.JOB_MAX_ATTEMPTS,
+    max_pending=settings.JOB_MAX_PENDING,
+    retry_delay=settings.JOB_RETRY_DELAY,
+)
+
+BITID_KNOWLEDGE = """WHAT IS BitID:
 - Network of human participants running permissionless biometric identification protocol software
 - Think ID issued by network of people you ever met and exchanged bits of identity information
 - This network validates your identity to people you never met that are not part of the network
@@ -359,65 +315,127 @@ Fraud Prevention:
 - In contrast face identification system allows only one identity per person making every participant accountable for their actions
 - Which in turn builds trust and reduce economical interaction friction"""
 
-    system_prompt = f"""You are Buddy, an assistant for the BitID project. Your goal is to help users understand BitID and encourage them to register by sending their selfie.
+SYSTEM_PROMPT = f"""You are Buddy, an assistant for the BitID project. Your goal is to help users understand BitID and encourage them to register by sending their selfie.
 
 IMPORTANT: You can ONLY answer questions based on the following information about BitID:
 
-{bitid_knowledge}
+{BITID_KNOWLEDGE}
 
 If a question cannot be answered using ONLY the information above, you MUST respond: "I don't have that information. Please contact the Architect for more details."
 
 You speak English, politely and unobtrusively. Never make up information that is not in the knowledge base above."""
+
+PHOTO_QUESTION = "What can you tell me about this photo and BitID?"
+
+# The knowledge base above, as the About menus show it
+KNOWLEDGE_SECTIONS = ("what_is", "properties", "uc_connected", "uc_deviceless", "uc_fraud")
+
+buddy = ChatResponder(
+    SYSTEM_PROMPT,
+    namespace="bitid_bot_final",
+    slow_down_text="You're sending messages too quickly. Please wait a few seconds and try again.",
+    router=IntentRouter(
+        {key: menu[key].text for key in KNOWLEDGE_SECTIONS},
+        threshold=settings.INTENT_ROUTER_THRESHOLD,
+        margin=settings.INTENT_ROUTER_MARGIN,
+    ),
+)
+
+@metrics.instrument_handler("handle_ai_message")
+async def handle_ai_message(update, context, user_message=None, pin=False):
+    """Handle AI chat messages."""
+    if not user_message:
+        user_message = update.message.text
+        
+    logger.debug("AI chat: %r", user_message)
     
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ]
+        await buddy.reply(
+            update.message,
+            update.effective_user.id,
+            user_message,
+            pin=pin,
+            use_history=not pin,
         )
-        ai_response = response.choices[0].message.content
-        await update.message.reply_text(ai_response)
-        print(f"AI response sent to user {update.effective_user.id}")
+        logger.debug("AI response sent")
         
-    except Exception as e:
-        print(f"OpenAI error: {e}")
+    except Exception:
+        logger.exception("OpenAI error")
         await update.message.reply_text(
             "Sorry, I'm having trouble connecting to my AI brain right now. Please try again later or use the menu buttons."
         )
 
+@metrics.instrument_handler("text")
 async def text(update, context):
     """Handle all text messages - route to AI by default."""
-    print(f"TEXT: '{update.message.text}' from user {update.effective_user.id}")
+    logger.debug("Text: %r", update.message.text)
     
     # Always route text to AI (unless it's a command)
     if not update.message.text.startswith('/'):
         await handle_ai_message(update, context)
 
-# Main
-print("Creating application...")
-app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-# Handlers
-app.add_handler(CommandHandler("start", start))
-app.add_handler(CommandHandler("home", home))
-app.add_handler(CallbackQueryHandler(button_callback))
-app.add_handler(MessageHandler(filters.PHOTO, photo))
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text))
+metrics_runner = None
 
-# Setup bot menu commands
-async def setup_bot_commands():
-    """Set up bot menu commands."""
+async def post_init(application):
     from telegram import BotCommand
-    commands = [
-        BotCommand("home", "Return to main menu"),
-    ]
-    await app.bot.set_my_commands(commands)
-    print("Bot menu commands configured")
-
-print("Starting bot...")
-print("Configuring bot menu...")
-import asyncio
-asyncio.get_event_loop().run_until_complete(setup_bot_commands())
-app.run_polling()
+
+    global metrics_runner
+    await application.bot.set_my_commands([BotCommand("home", "Return to main menu")])
+    logger.info("Bot menu commands configured")
+    await selfie_jobs.start(application.bot)
+    application.persistence.start_eviction(application)
+    if settings.METRICS_PORT:
+        metrics_runner = await metrics.start_server(settings.METRICS_HOST, settings.METRICS_PORT)
+
+async def post_shutdown(application):
+    users.join_prefetch.cancel_all()
+    await selfie_jobs.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+def build_application():
+    """Create the Telegram application with all handlers registered."""
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
+    from persistence import SQLitePersistence
+    from telegram_request import InstrumentedRequest
+    from update_processor import PerUserUpdateProcessor
+
+    app = (
+        Application.builder()
+        .token(settings.TELEGRAM_BOT_TOKEN)
+        .base_url(f"{settings.TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{settings.TELEGRAM_API_URL}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=settings.TELEGRAM_POOL_SIZE))
+        .concurrent_updates(
+            PerUserUpdateProcessor(
+                settings.CONCURRENT_UPDATES,
+                settings.MAX_QUEUED_UPDATES_PER_USER,
+                key_by=settings.UPDATE_ORDERING_KEY,
+            )
+        )
+        .persistence(
+            SQLitePersistence(settings.STATE_DB_PATH, settings.PERSISTENCE_UPDATE_INTERVAL, settings.USER_DATA_IDLE_TTL)
+        )
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("home", home))
+    app.add_handler(CallbackQueryHandler(button_callback))
+    app.add_handler(MessageHandler(filters.PHOTO, photo))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text))
+    return app
+
+def main():
+    import logsetup
+    import serving
+
+    logsetup.setup_logging(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_DEBUG_SAMPLE_RATE)
+    logger.info("Starting BitID bot")
+    serving.run(build_application())
+
+if __name__ == "__main__":
+    main()
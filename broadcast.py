@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""Send one message to every registered user as fast as Telegram allows.
+
+Telegram accepts roughly 30 messages per second per bot and about one per
+second per chat; going faster earns 429 "flood control" errors carrying a
+``retry_after`` during which the whole bot is throttled. A broadcast here:
+
+* streams ``telegram_id`` values from the ``users`` table in keyset-paginated
+  pages, fetching the next page while the current one is being sent;
+* paces sends with a global :class:`~ratelimit.TokenBucket` at
+  ``BROADCAST_RATE`` and keeps ``BROADCAST_CHAT_INTERVAL`` between two sends
+  to the same chat;
+* on ``RetryAfter`` pauses every sender for the requested time, lowers the
+  rate by a fifth and retries the message; the rate climbs back towards
+  ``BROADCAST_RATE`` while sends succeed;
+* records its progress in ``STATE_DB_PATH`` every second, as the highest
+  ``telegram_id`` below which every user has been handled, so an interrupted
+  run resumes where it stopped (messages in flight at the crash may be sent
+  twice);
+* logs messages/sec while it runs and prints a summary at the end.
+
+Users who blocked the bot are counted and skipped. Start or resume a run::
+
+    python broadcast.py bitid-ready --text "Your BitID is ready!"
+    python broadcast.py bitid-ready          # resume after a crash
+
+Against the fake Bot API: ``bench/fake_services.py --flood-limit 30 --chat-flood-limit 1``.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Optional
+
+import settings
+from ratelimit import TokenBucket
+from upstream import call_upstream, run_blocking
+from users import USERS_TABLE
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 5.0
+CHECKPOINT_INTERVAL = 1.0
+MAX_ATTEMPTS = 5
+# After a flood wait the rate is multiplied by this, and it grows back by one
+# message/sec for every second's worth of successful sends
+RATE_DECREASE = 0.8
+
+OUTCOMES = ("sent", "blocked", "failed")
+
+
+class BroadcastCheckpoints:
+    """Progress of named broadcasts, in a SQLite table."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS broadcasts ("
+                "name TEXT PRIMARY KEY, text TEXT NOT NULL, cursor INTEGER, "
+                "sent INTEGER NOT NULL DEFAULT 0, blocked INTEGER NOT NULL DEFAULT 0, "
+                "failed INTEGER NOT NULL DEFAULT 0, started_at REAL NOT NULL, finished_at REAL)"
+            )
+        return self._conn
+
+    def load(self, name: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cursor = self._connect().execute(
+                "SELECT name, text, cursor, sent, blocked, failed, started_at, finished_at "
+                "FROM broadcasts WHERE name = ?",
+                (name,),
+            )
+            row = cursor.fetchone()
+        return None if row is None else dict(zip([column[0] for column in cursor.description], row))
+
+    def start(self, name: str, text: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO broadcasts (name, text, started_at) VALUES (?, ?, ?)",
+                (name, text, time.time()),
+            )
+            conn.commit()
+
+    def save(self, name: str, cursor: Optional[int], counts: Dict[str, int], finished: bool = False) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE broadcasts SET cursor = ?, sent = ?, blocked = ?, failed = ?, finished_at = ? "
+                "WHERE name = ?",
+                (cursor, counts["sent"], counts["blocked"], counts["failed"], time.time() if finished else None, name),
+            )
+            conn.commit()
+
+
+class Broadcast:
+    """Sends ``text`` to every user with a ``telegram_id`` above ``cursor``, in id order."""
+
+    def __init__(
+        self,
+        bot,
+        supabase,
+        name: str,
+        text: str,
+        checkpoints: BroadcastCheckpoints,
+        cursor: Optional[int] = None,
+        counts: Optional[Dict[str, int]] = None,
+        rate: float = settings.BROADCAST_RATE,
+        chat_interval: float = settings.BROADCAST_CHAT_INTERVAL,
+        concurrency: int = settings.BROADCAST_CONCURRENCY,
+        page_size: int = settings.BROADCAST_PAGE_SIZE,
+    ) -> None:
+        self.bot = bot
+        self.supabase = supabase
+        self.name = name
+        self.text = text
+        self.checkpoints = checkpoints
+        self.cursor = cursor
+        self.counts = {outcome: (counts or {}).get(outcome, 0) for outcome in OUTCOMES}
+        self.max_rate = rate
+        self.chat_interval = chat_interval
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.bucket = TokenBucket(rate)
+        self.flood_waits = 0
+        self._flood_until = 0.0
+        self._successes = 0
+        # telegram_id -> finished, in dispatch order; the finished prefix advances the cursor
+        self._in_flight: "OrderedDict[int, bool]" = OrderedDict()
+        self._chat_ready: Dict[int, float] = {}
+
+    async def _user_ids(self) -> AsyncIterator[int]:
+        """Yield every ``telegram_id`` above the cursor once, in ascending order, prefetching a page ahead."""
+        last = self.cursor
+
+        def fetch(after: Optional[int]):
+            # NULLs sort last; a NULL cursor would restart the scan from the beginning
+            query = self.supabase.table(USERS_TABLE).select("telegram_id").not_.is_("telegram_id", "null")
+            if after is not None:
+                query = query.gt("telegram_id", after)
+            return query.order("telegram_id").limit(self.page_size).execute()
+
+        page = asyncio.ensure_future(call_upstream("supabase", "users.page", fetch, last))
+        while True:
+            rows = (await page).data
+            ids = [row["telegram_id"] for row in rows if row["telegram_id"] is not None]
+            if len(rows) < self.page_size or not ids:
+                page = None
+            else:
+                page = asyncio.ensure_future(call_upstream("supabase", "users.page", fetch, ids[-1]))
+            for telegram_id in ids:
+                if telegram_id == last:
+                    continue
+                last = telegram_id
+                yield telegram_id
+            if page is None:
+                return
+
+    def _on_flood(self, seconds: float) -> None:
+        self.flood_waits += 1
+        now = time.monotonic()
+        # Every send in flight hits the same flood wait; slow down once per wait
+        if now >= self._flood_until:
+            self.bucket.rate = max(1.0, self.bucket.rate * RATE_DECREASE)
+            self._successes = 0
+            logger.warning("Flood control: pausing %.0fs, rate now %.1f msg/s", seconds, self.bucket.rate)
+        self._flood_until = max(self._flood_until, now + seconds)
+        self.bucket.pause(seconds)
+
+    def _on_success(self) -> None:
+        self._successes += 1
+        if self.bucket.rate < self.max_rate and self._successes >= self.bucket.rate:
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + 1)
+            self._successes = 0
+
+    async def _send(self, chat_id: int) -> str:
+        """Deliver the message to one chat and return its outcome; flood waits are retried indefinitely."""
+        from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+        attempts = 0
+        while True:
+            wait = self._chat_ready.get(chat_id, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.bucket.acquire()
+            self._chat_ready[chat_id] = time.monotonic() + self.chat_interval
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=self.text)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                self._on_flood(retry_after)
+                self._chat_ready[chat_id] = time.monotonic() + max(retry_after, self.chat_interval)
+                continue
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                logger.info("Cannot message %s: %s", chat_id, e)
+                return "failed"
+            except NetworkError as e:
+                attempts += 1
+                logger.warning("Sending to %s failed (attempt %d/%d): %s", chat_id, attempts, MAX_ATTEMPTS, e)
+                if attempts >= MAX_ATTEMPTS:
+                    return "failed"
+                await asyncio.sleep(min(2 ** attempts, 30))
+                continue
+            self._on_success()
+            return "sent"
+
+    def _finish(self, chat_id: int, outcome: str) -> None:
+        self.counts[outcome] += 1
+        self._chat_ready.pop(chat_id, None)
+        self._in_flight[chat_id] = True
+        while self._in_flight:
+            oldest, finished = next(iter(self._in_flight.items()))
+            if not finished:
+                break
+            self._in_flight.popitem(last=False)
+            self.cursor = oldest
+
+    async def _sender(self, queue: "asyncio.Queue[Optional[int]]") -> None:
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            try:
+                outcome = await self._send(chat_id)
+            except Exception:
+                logger.exception("Unexpected error sending to %s", chat_id)
+                outcome = "failed"
+            self._finish(chat_id, outcome)
+
+    async def _checkpoint(self, finished: bool = False) -> None:
+        await run_blocking(self.checkpoints.save, self.name, self.cursor, dict(self.counts), finished)
+
+    async def _monitor(self) -> None:
+        """Checkpoint every second and log progress every ``REPORT_INTERVAL``."""
+        last_report, last_sent = time.monotonic(), self.counts["sent"]
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            await self._checkpoint()
+            now = time.monotonic()
+            if now - last_report >= REPORT_INTERVAL:
+                logger.info(
+                    "Broadcast %s: %d sent, %.1f msg/s (limit %.1f), %d blocked, %d failed, cursor %s",
+                    self.name, self.counts["sent"], (self.counts["sent"] - last_sent) / (now - last_report),
+                    self.bucket.rate, self.counts["blocked"], self.counts["failed"], self.cursor,
+                )
+                last_report, last_sent = now, self.counts["sent"]
+
+    async def run(self) -> Dict[str, Any]:
+        """Send to every remaining user and return a summary."""
+        started = time.monotonic()
+        sent_before = self.counts["sent"]
+        queue: "asyncio.Queue[Optional[int]]" = asyncio.Queue(maxsize=self.concurrency * 2)
+        senders = [asyncio.create_task(self._sender(queue)) for _ in range(self.concurrency)]
+        monitor = asyncio.create_task(self._monitor())
+        try:
+            async for telegram_id in self._user_ids():
+                self._in_flight[telegram_id] = False
+                await queue.put(telegram_id)
+            for _ in senders:
+                await queue.put(None)
+            await asyncio.gather(*senders)
+        finally:
+            monitor.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await monitor
+            for task in senders:
+                task.cancel()
+            await self._checkpoint(finished=not self._in_flight and all(task.done() for task in senders))
+
+        elapsed = time.monotonic() - started
+        return {
+            **self.counts,
+            "elapsed_s": elapsed,
+            "messages_per_s": (self.counts["sent"] - sent_before) / elapsed if elapsed else 0.0,
+            "flood_waits": self.flood_waits,
+        }
+
+
+async def run_broadcast(name: str, text: Optional[str], restart: bool = False, **options: Any) -> Dict[str, Any]:
+    """Start broadcast ``name`` (or resume it from its checkpoint) and return its summary."""
+    from telegram import Bot
+
+    import clients
+    from telegram_request import InstrumentedRequest
+
+    checkpoints = BroadcastCheckpoints(settings.STATE_DB_PATH)
+    state = await run_blocking(checkpoints.load, name)
+    if state is not None and not restart:
+        if state["finished_at"] is not None:
+            raise SystemExit(f"Broadcast {name!r} already finished; pass --restart to send it again")
+        if text is not None and text != state["text"]:
+            raise SystemExit(f"Broadcast {name!r} was started with a different text; pass --restart to replace it")
+        logger.info("Resuming broadcast %s after telegram_id %s (%d sent so far)", name, state["cursor"], state["sent"])
+    else:
+        if text is None:
+            raise SystemExit("--text is required to start a broadcast")
+        await run_blocking(checkpoints.start, name, text)
+        state = {"text": text, "cursor": None}
+
+    concurrency = options.get("concurrency", settings.BROADCAST_CONCURRENCY)
+    bot = Bot(
+        settings.TELEGRAM_BOT_TOKEN,
+        base_url=f"{settings.TELEGRAM_API_URL}/bot",
+        request=InstrumentedRequest(connection_pool_size=concurrency),
+    )
+    async with bot:
+        broadcast = Broadcast(
+            bot,
+            clients.get_supabase(),
+            name,
+            state["text"],
+            checkpoints,
+            cursor=state["cursor"],
+            counts=state,
+            **options,
+        )
+        return await broadcast.run()
+
+
+def main() -> None:
+    import logsetup
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("name", help="broadcast name; an unfinished broadcast of this name is resumed")
+    parser.add_argument("--text", help="message to send (required when starting)")
+    parser.add_argument("--restart", action="store_true", help="start over even if a checkpoint exists")
+    parser.add_argument("--rate", type=float, default=settings.BROADCAST_RATE, help="messages per second")
+    parser.add_argument("--concurrency", type=int, default=settings.BROADCAST_CONCURRENCY)
+    args = parser.parse_args()
+
+    logsetup.setup_logging(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_DEBUG_SAMPLE_RATE)
+    try:
+        summary = asyncio.run(
+            run_broadcast(args.name, args.text, args.restart, rate=args.rate, concurrency=args.concurrency)
+        )
+    except KeyboardInterrupt:
+        raise SystemExit(f"Interrupted; run 'python broadcast.py {args.name}' to resume")
+    print(
+        "{sent} sent, {blocked} blocked, {failed} failed in {elapsed_s:.1f}s "
+        "({messages_per_s:.1f} msg/s, {flood_waits} flood waits)".format(**summary)
+    )
+
+
+if __name__ == "__main__":
+    main()
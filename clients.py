@@ -0,0 +1,39 @@
+"""Shared Supabase and OpenAI clients, created on first use.
+
+Importing the client libraries and building the clients is the slowest part
+of starting the bot, and neither is needed to import a module, register
+handlers or run tests. Everything that talks to Supabase or OpenAI asks for
+the process-wide client here instead of holding one from import time.
+"""
+import threading
+from typing import Any, Optional
+
+import settings
+
+_supabase: Optional[Any] = None
+_openai: Optional[Any] = None
+_lock = threading.Lock()
+
+
+def get_supabase():
+    """Return the shared Supabase client."""
+    global _supabase
+    if _supabase is None:
+        with _lock:
+            if _supabase is None:
+                from supabase import create_client
+
+                _supabase = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY)
+    return _supabase
+
+
+def get_openai():
+    """Return the shared ``AsyncOpenAI`` client."""
+    global _openai
+    if _openai is None:
+        with _lock:
+            if _openai is None:
+                from openai import AsyncOpenAI
+
+                _openai = AsyncOpenAI(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_BASE_URL)
+    return _openai
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""Multi-process mode: one webhook ingress in front of N bot worker processes.
+
+A single process runs every handler on one core. Here the ingress receives
+Telegram's webhook POSTs, reads only enough of each update to find its user
+(or chat), and forwards the raw body to the worker that owns that key on a
+consistent-hash ring. A user's updates therefore always reach the same
+worker, so ``user_data``, conversation memory and the per-user update
+ordering stay process-local, and adding a worker only moves about 1/N of
+the users.
+
+Each worker is an unmodified entry point in ``BOT_MODE=webhook`` on a
+loopback port with its own ``STATE_DB_PATH``; state meant to be shared
+across users (the AI answer cache) lives in ``SHARED_STATE_DB_PATH``. When
+the number of workers changes, users move to other workers; before starting
+any worker the supervisor moves their persisted state (``user_data``,
+pending selfie jobs, selfie ``file_id``\ s) to the database of the worker
+that now owns them. The supervisor restarts crashed workers with exponential
+backoff; while a worker is down its updates get a 503 so Telegram redelivers
+them.
+
+    CLUSTER_WORKERS=4 WEBHOOK_URL=https://example.com python cluster.py bitid_bot_final.py
+"""
+import argparse
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import signal
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+import metrics
+import settings
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+RESTART_BACKOFF_MAX = 30.0
+# A worker that stayed up this long has its restart backoff reset
+STABLE_AFTER = 60.0
+
+FORWARDED = metrics.Counter("bot_cluster_forwarded_total", "Updates forwarded to workers", ["worker"])
+FORWARD_ERRORS = metrics.Counter("bot_cluster_forward_errors_total", "Updates a worker did not accept", ["worker"])
+RESTARTS = metrics.Counter("bot_cluster_restarts_total", "Worker restarts", ["worker"])
+FORWARD_SECONDS = metrics.Histogram("bot_cluster_forward_seconds", "Time for a worker to accept an update")
+
+# Per-user tables in a worker's STATE_DB_PATH -> the expression naming each row's user
+USER_STATE_TABLES = {
+    "user_data": "user_id",
+    "selfie_file_ids": "telegram_id",
+    "selfie_hashes": "telegram_id",
+    "jobs": "json_extract(payload, '$.telegram_id')",
+}
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent-hash ring mapping keys to nodes, with ``replicas`` virtual points per node."""
+
+    def __init__(self, nodes: Sequence[Hashable], replicas: int = 128) -> None:
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: Hashable) -> Hashable:
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def routing_key(update: Dict[str, Any], key_by: str = "user") -> Optional[Hashable]:
+    """Return the user (or chat) an update belongs to, from the raw update JSON."""
+    for field, payload in update.items():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        user = payload.get("from") or payload.get("user")
+        if key_by == "chat" and chat:
+            return f"chat:{chat['id']}"
+        if user:
+            return f"user:{user['id']}"
+        if chat:
+            return f"chat:{chat['id']}"
+    return None
+
+
+def worker_state_path(index: int) -> str:
+    base, ext = os.path.splitext(settings.STATE_DB_PATH)
+    return f"{base}.worker{index}{ext}"
+
+
+def _existing_worker_states() -> List[int]:
+    base, ext = os.path.splitext(settings.STATE_DB_PATH)
+    pattern = re.compile(re.escape(os.path.basename(base)) + r"\.worker(\d+)" + re.escape(ext) + "$")
+    matches = (pattern.match(name) for name in os.listdir(os.path.dirname(base) or "."))
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def rebalance_state(worker_count: int, replicas: int, key_by: str = "user") -> int:
+    """Move per-user rows into the state database of the user's worker on a ``worker_count`` ring.
+
+    Only safe while no worker is running. Databases of workers that no
+    longer exist are drained too. Returns the number of rows moved.
+    """
+    ring = HashRing(range(worker_count), replicas)
+    # Updates are routed by user or by chat; in a private chat both ids are the same
+    prefix = "chat" if key_by == "chat" else "user"
+    moved = 0
+    for source in _existing_worker_states():
+        conn = sqlite3.connect(worker_state_path(source))
+        try:
+            conn.create_function(
+                "owner", 1, lambda user_id: ring.node_for(f"{prefix}:{user_id}"), deterministic=True
+            )
+            tables = {
+                name: sql
+                for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+                if name in USER_STATE_TABLES
+            }
+            for target in range(worker_count):
+                if target == source or not tables:
+                    continue
+                conn.execute("ATTACH DATABASE ? AS target", (worker_state_path(target),))
+                try:
+                    for table, sql in tables.items():
+                        moved += _move_rows(conn, table, sql, USER_STATE_TABLES[table], target)
+                    conn.commit()
+                finally:
+                    conn.execute("DETACH DATABASE target")
+        finally:
+            conn.close()
+    if moved:
+        logger.info("Moved %d rows of per-user state to their workers", moved)
+    return moved
+
+
+def _move_rows(conn: sqlite3.Connection, table: str, sql: str, owner: str, target: int) -> int:
+    conn.execute(re.sub(r"^CREATE TABLE\s+", "CREATE TABLE IF NOT EXISTS target.", sql))
+    # A surrogate key (the job id) is assigned afresh in the target database
+    columns = ", ".join(
+        name for _, name, _, _, _, pk in conn.execute(f"PRAGMA main.table_info({table})") if not pk or name == owner
+    )
+    conn.execute(
+        f"INSERT OR REPLACE INTO target.{table} ({columns}) "
+        f"SELECT {columns} FROM main.{table} WHERE owner({owner}) = ?",
+        (target,),
+    )
+    return conn.execute(f"DELETE FROM main.{table} WHERE owner({owner}) = ?", (target,)).rowcount
+
+
+class Worker:
+    """One supervised bot process listening on ``127.0.0.1:port``."""
+
+    def __init__(self, index: int, entry: str, port: int, secret: str) -> None:
+        self.index = index
+        self.entry = entry
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}/{settings.WEBHOOK_PATH.strip('/')}"
+        self.secret = secret
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.restarts = 0
+
+    def _env(self) -> Dict[str, str]:
+        return {
+            **os.environ,
+            "BOT_MODE": "webhook",
+            "WEBHOOK_LISTEN": "127.0.0.1",
+            "WEBHOOK_PORT": str(self.port),
+            "WEBHOOK_URL": "",
+            "WEBHOOK_SECRET": self.secret,
+            "METRICS_PORT": "0",
+            "STATE_DB_PATH": worker_state_path(self.index),
+            "SHARED_STATE_DB_PATH": settings.SHARED_STATE_DB_PATH,
+        }
+
+    async def supervise(self, stopping: asyncio.Event) -> None:
+        """Keep the worker running until ``stopping`` is set."""
+        backoff = 0.5
+        while not stopping.is_set():
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, self.entry, env=self._env())
+            logger.info("Worker %d started (pid %d, port %d)", self.index, self.process.pid, self.port)
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            if time.monotonic() - started > STABLE_AFTER:
+                backoff = 0.5
+            self.restarts += 1
+            RESTARTS.inc(worker=str(self.index))
+            logger.error("Worker %d exited with code %s; restarting in %.1fs", self.index, code, backoff)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stopping.wait(), backoff)
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+
+    async def stop(self, timeout: float = 15.0) -> None:
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+
+def build_ingress_app(workers: List[Worker]):
+    """Return the aiohttp app that routes Telegram's updates to ``workers``."""
+    from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+    ring = HashRing(range(len(workers)), settings.CLUSTER_VIRTUAL_NODES)
+    secret = settings.WEBHOOK_SECRET
+    session: Optional[ClientSession] = None
+
+    async def open_session(app: web.Application) -> None:
+        nonlocal session
+        session = ClientSession(
+            connector=TCPConnector(limit_per_host=settings.WEBHOOK_MAX_CONNECTIONS * 4),
+            timeout=ClientTimeout(total=10),
+        )
+
+    async def close_session(app: web.Application) -> None:
+        await session.close()
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+            key = routing_key(update, settings.UPDATE_ORDERING_KEY)
+            if key is None:
+                key = update["update_id"]
+        except (ValueError, TypeError, KeyError):
+            return web.Response(status=400)
+
+        worker = workers[ring.node_for(key)]
+        label = str(worker.index)
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                worker.url,
+                data=body,
+                headers={SECRET_HEADER: worker.secret, "Content-Type": "application/json"},
+            ) as response:
+                status = response.status
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Worker %d unreachable: %s", worker.index, e)
+            status = 503
+        FORWARD_SECONDS.observe(time.perf_counter() - started)
+        if status != 200:
+            FORWARD_ERRORS.inc(worker=label)
+            # Anything but 200 makes Telegram redeliver the update later
+            return web.Response(status=503)
+        FORWARDED.inc(worker=label)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        statuses = {}
+        for worker in workers:
+            try:
+                async with session.get(f"http://127.0.0.1:{worker.port}/healthz") as response:
+                    statuses[worker.index] = response.status == 200
+            except (ClientError, asyncio.TimeoutError):
+                statuses[worker.index] = False
+        healthy = all(statuses.values())
+        return web.json_response(
+            {"status": "ok" if healthy else "degraded", "workers": statuses}, status=200 if healthy else 503
+        )
+
+    app = web.Application()
+    app.on_startup.append(open_session)
+    app.on_cleanup.append(close_session)
+    app.router.add_post(f"/{settings.WEBHOOK_PATH.strip('/')}", receive_update)
+    app.router.add_get("/healthz", health)
+    app.router.add_get("/metrics", metrics.scrape)
+    return app
+
+
+async def _set_webhook() -> None:
+    """Point Telegram at the ingress (the workers never register a webhook themselves)."""
+    from aiohttp import ClientSession
+
+    payload = {
+        "url": f"{settings.WEBHOOK_URL.rstrip('/')}/{settings.WEBHOOK_PATH.strip('/')}",
+        "max_connections": settings.WEBHOOK_MAX_CONNECTIONS,
+    }
+    if settings.WEBHOOK_SECRET:
+        payload["secret_token"] = settings.WEBHOOK_SECRET
+    url = f"{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/setWebhook"
+    async with ClientSession() as session:
+        async with session.post(url, json=payload) as response:
+            result = await response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"setWebhook failed: {result.get('description')}")
+
+
+async def run_cluster(entry: str, worker_count: int) -> None:
+    """Run the ingress and ``worker_count`` workers of ``entry`` until SIGINT/SIGTERM."""
+    from aiohttp import web
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stopping.set)
+
+    # Workers only accept updates carrying this secret, i.e. from the ingress
+    internal_secret = secrets.token_urlsafe(24)
+    workers = [
+        Worker(i, entry, settings.CLUSTER_WORKER_BASE_PORT + i, internal_secret) for i in range(worker_count)
+    ]
+    metrics.register_collector("bot_cluster", lambda: {"workers": len(workers)})
+    # No worker is running yet, so nothing writes to their databases meanwhile
+    await loop.run_in_executor(
+        None, rebalance_state, worker_count, settings.CLUSTER_VIRTUAL_NODES, settings.UPDATE_ORDERING_KEY
+    )
+    supervisors = [asyncio.create_task(worker.supervise(stopping)) for worker in workers]
+
+    runner = web.AppRunner(build_ingress_app(workers), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT).start()
+    logger.info(
+        "Ingress listening on %s:%d with %d workers", settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT, worker_count
+    )
+    if settings.WEBHOOK_URL:
+        await _set_webhook()
+    try:
+        await stopping.wait()
+    finally:
+        await runner.cleanup()
+        await asyncio.gather(*(worker.stop() for worker in workers))
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
+def main() -> None:
+    import logsetup
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("entry", nargs="?", default="bitid_bot_final.py", help="bot entry point to run in each worker")
+    parser.add_argument("--workers", type=int, default=settings.CLUSTER_WORKERS)
+    args = parser.parse_args()
+
+    logsetup.setup_logging(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_DEBUG_SAMPLE_RATE)
+    asyncio.run(run_cluster(os.path.abspath(args.entry), args.workers))
+
+
+if __name__ == "__main__":
+    main()
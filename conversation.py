@@ -0,0 +1,92 @@
+"""Bounded multi-turn memory for the AI chat.
+
+Each user gets a ring buffer of recent turns that is trimmed from the oldest
+end to stay inside a token budget, so follow-up questions keep their context
+while prompt size and memory stay flat however long a session runs. The
+number of users tracked is capped too; the least recently active user's
+history is dropped first.
+"""
+import logging
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+Turn = Tuple[str, str]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+class PromptSizeStats:
+    """Running statistics of prompt sizes sent upstream, in estimated tokens."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+        self.history_turns = 0
+
+    def record(self, tokens: int, turns: int) -> None:
+        self.requests += 1
+        self.total_tokens += tokens
+        self.max_tokens = max(self.max_tokens, tokens)
+        self.history_turns += turns
+
+    def snapshot(self) -> Dict[str, float]:
+        mean = self.total_tokens / self.requests if self.requests else 0.0
+        return {
+            "requests": self.requests,
+            "mean_prompt_tokens": round(mean, 1),
+            "max_prompt_tokens": self.max_tokens,
+            "mean_history_turns": round(self.history_turns / self.requests, 2) if self.requests else 0.0,
+        }
+
+
+class ConversationMemory:
+    """Per-user conversation history capped by token budget, turn count and user count."""
+
+    def __init__(self, token_budget: int, max_turns: int, max_users: int) -> None:
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self._histories: "OrderedDict[int, Deque[Tuple[Turn, int]]]" = OrderedDict()
+        self.prompt_stats = PromptSizeStats()
+
+    def history(self, user_id: int) -> List[Dict[str, str]]:
+        """Return the user's retained turns as chat-completion messages, oldest first."""
+        turns = self._histories.get(user_id)
+        if not turns:
+            return []
+        self._histories.move_to_end(user_id)
+        return [{"role": role, "content": content} for (role, content), _ in turns]
+
+    def append(self, user_id: int, question: str, answer: str) -> None:
+        """Record one question/answer exchange and trim the user's buffer to budget."""
+        turns = self._histories.get(user_id)
+        if turns is None:
+            turns = self._histories[user_id] = deque(maxlen=self.max_turns * 2)
+        self._histories.move_to_end(user_id)
+        for role, content in (("user", question), ("assistant", answer)):
+            turns.append(((role, content), estimate_tokens(content)))
+
+        used = sum(tokens for _, tokens in turns)
+        # Drop whole exchanges so the history never starts with an orphan answer
+        while used > self.token_budget and len(turns) > 2:
+            for _ in range(2):
+                _, tokens = turns.popleft()
+                used -= tokens
+        if used > self.token_budget:
+            turns.clear()
+
+        while len(self._histories) > self.max_users:
+            self._histories.popitem(last=False)
+
+    def clear(self, user_id: int) -> None:
+        """Forget the user's conversation (e.g. when they leave the chat)."""
+        self._histories.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._histories)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""Perceptual-hash index of stored selfies, for flagging duplicate faces.
+
+Every selfie gets a 64-bit DCT perceptual hash (pHash); near-identical
+images - the same photo re-encoded, resized or slightly cropped - land
+within a few bits of each other. :class:`HashIndex` finds all hashes within
+a Hamming radius with multi-index hashing: the hash is split into four
+16-bit chunks, and by the pigeonhole principle any hash within radius ``r``
+matches at least one chunk within ``r // 4`` bits, so a lookup probes a few
+dozen buckets instead of scanning every user.
+
+Hashes are kept in ``SHARED_STATE_DB_PATH`` so every worker process sees
+every upload; each process keeps an in-memory index and, before each lookup,
+pulls the rows whose change sequence number is above the last one it saw
+(wall clocks of different hosts cannot be compared). Matches are logged and
+recorded in the ``selfie_duplicates`` table for review - a perceptual hash
+is not face recognition, so registrations are never rejected on it.
+
+The index is updated on every upload; to build it from the selfies already
+in Storage run::
+
+    python face_index.py rebuild --processes 4 --concurrency 16
+
+A rebuild records the duplicates it finds, and hashes it drops are kept as
+tombstones so running processes remove them from memory too.
+
+Hashing needs Pillow; without it nothing is indexed.
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import metrics
+import settings
+from upstream import run_blocking
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+_CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# pHash: DCT of a 32x32 grayscale thumbnail, keeping the 8x8 lowest frequencies
+_SIZE = 32
+_LOW = 8
+# Nearest matches recorded per upload; a blank or stock image can match thousands
+MAX_MATCHES = 10
+# Stored in place of a hash a rebuild dropped
+REMOVED = ""
+# Every write takes the next change sequence number; SQLite runs one writer at a
+# time, so rows become visible in sequence order and a reader's cursor skips none
+_NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM selfie_phashes)"
+
+_COSINES = [[math.cos(math.pi * (2 * x + 1) * u / (2 * _SIZE)) for x in range(_SIZE)] for u in range(_LOW)]
+
+DUPLICATES = metrics.Counter("bot_selfie_duplicates_total", "Selfies within the duplicate radius of another user's")
+LOOKUP_SECONDS = metrics.Histogram(
+    "bot_selfie_index_lookup_seconds",
+    "Near-duplicate lookup time",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05),
+)
+
+
+def phash(content: bytes) -> Optional[int]:
+    """Return the 64-bit perceptual hash of an encoded image, or ``None`` without Pillow."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    image = Image.open(io.BytesIO(content))
+    image.draft("L", (_SIZE * 4, _SIZE * 4))  # let the JPEG decoder downscale cheaply
+    image = ImageOps.exif_transpose(image).convert("L").resize((_SIZE, _SIZE), Image.LANCZOS)
+    pixels = image.tobytes()
+    rows = [pixels[y * _SIZE:(y + 1) * _SIZE] for y in range(_SIZE)]
+    # Separable 2-D DCT-II, computing only the coefficients that are kept
+    row_dct = [[sum(c * p for c, p in zip(_COSINES[u], row)) for u in range(_LOW)] for row in rows]
+    coefficients = [
+        sum(_COSINES[v][y] * row_dct[y][u] for y in range(_SIZE)) for v in range(_LOW) for u in range(_LOW)
+    ]
+    # The DC term only reflects overall brightness
+    median = sorted(coefficients[1:])[(len(coefficients) - 1) // 2]
+    value = 0
+    for coefficient in coefficients:
+        value = (value << 1) | (coefficient > median)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _chunks(value: int) -> List[int]:
+    return [(value >> (CHUNK_BITS * i)) & _CHUNK_MASK for i in range(CHUNKS)]
+
+
+class HashIndex:
+    """In-memory multi-index hash table of ``key -> 64-bit hash``."""
+
+    def __init__(self) -> None:
+        self._hashes: Dict[int, int] = {}
+        self._buckets: List[Dict[int, Set[int]]] = [defaultdict(set) for _ in range(CHUNKS)]
+        self._probes: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def add(self, key: int, value: int) -> None:
+        """Index ``value`` under ``key``, replacing the key's previous hash."""
+        self.remove(key)
+        self._hashes[key] = value
+        for buckets, chunk in zip(self._buckets, _chunks(value)):
+            buckets[chunk].add(key)
+
+    def remove(self, key: int) -> None:
+        value = self._hashes.pop(key, None)
+        if value is None:
+            return
+        for buckets, chunk in zip(self._buckets, _chunks(value)):
+            bucket = buckets[chunk]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[chunk]
+
+    def _flips(self, radius: int) -> List[int]:
+        """Every chunk-sized bit mask with at most ``radius`` bits set."""
+        masks = self._probes.get(radius)
+        if masks is None:
+            masks = [
+                sum(1 << bit for bit in bits)
+                for r in range(radius + 1)
+                for bits in itertools.combinations(range(CHUNK_BITS), r)
+            ]
+            self._probes[radius] = masks
+        return masks
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, int]]:
+        """Return ``(key, distance)`` for every hash within ``radius`` bits of ``value``, nearest first."""
+        flips = self._flips(radius // CHUNKS)
+        candidates: Set[int] = set()
+        for buckets, chunk in zip(self._buckets, _chunks(value)):
+            for mask in flips:
+                bucket = buckets.get(chunk ^ mask)
+                if bucket:
+                    candidates |= bucket
+        matches = []
+        for key in candidates:
+            distance = hamming(self._hashes[key], value)
+            if distance <= radius:
+                matches.append((key, distance))
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+
+class FaceIndex:
+    """Selfie hashes of every user, persisted in SQLite and indexed in memory."""
+
+    def __init__(self, path: str, radius: int) -> None:
+        self.path = path
+        self.radius = radius
+        self.index = HashIndex()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._synced_seq = -1
+        self._refresh_lock: Optional[asyncio.Lock] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS selfie_phashes ("
+                "telegram_id INTEGER PRIMARY KEY, phash TEXT NOT NULL, updated_at REAL NOT NULL, "
+                "seq INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(selfie_phashes)")}
+            if "seq" not in columns:
+                # Rows written before the sequence existed get 0 and are pulled by the first refresh
+                self._conn.execute("ALTER TABLE selfie_phashes ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS selfie_phashes_seq ON selfie_phashes (seq)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS selfie_duplicates ("
+                "telegram_id INTEGER NOT NULL, duplicate_of INTEGER NOT NULL, distance INTEGER NOT NULL, "
+                "flagged_at REAL NOT NULL, PRIMARY KEY (telegram_id, duplicate_of))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _changed_since(self, seq: int) -> List[Tuple[int, str, int]]:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT telegram_id, phash, seq FROM selfie_phashes WHERE seq > ? ORDER BY seq", (seq,)
+            ).fetchall()
+
+    def _store(self, telegram_id: int, value: int, matches: List[Tuple[int, int]]) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO selfie_phashes (telegram_id, phash, updated_at, seq) "
+                f"VALUES (?, ?, ?, {_NEXT_SEQ})",
+                (telegram_id, f"{value:016x}", now),
+            )
+            self._record(conn, [(telegram_id, other, distance) for other, distance in matches], now)
+            conn.commit()
+
+    @staticmethod
+    def _record(conn: sqlite3.Connection, duplicates: Iterable[Tuple[int, int, int]], now: float) -> None:
+        conn.executemany(
+            "INSERT OR REPLACE INTO selfie_duplicates (telegram_id, duplicate_of, distance, flagged_at) "
+            "VALUES (?, ?, ?, ?)",
+            ((telegram_id, other, distance, now) for telegram_id, other, distance in duplicates),
+        )
+
+    def replace_all(self, hashes: Iterable[Tuple[int, int]], duplicates: Iterable[Tuple[int, int, int]] = ()) -> int:
+        """Replace every stored hash with ``hashes`` (``(telegram_id, phash)`` pairs); used by rebuilds.
+
+        Only hashes that changed get a new sequence number; dropped ones become
+        tombstones. ``duplicates`` (``(telegram_id, duplicate_of, distance)``)
+        are recorded alongside. Returns the number of rows changed.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            # Hold the write lock from reading the next sequence number until commit
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS rebuilt (telegram_id INTEGER PRIMARY KEY, phash TEXT)")
+            conn.execute("DELETE FROM temp.rebuilt")
+            conn.executemany(
+                "INSERT OR REPLACE INTO temp.rebuilt (telegram_id, phash) VALUES (?, ?)",
+                ((telegram_id, f"{value:016x}") for telegram_id, value in hashes),
+            )
+            (seq,) = conn.execute(f"SELECT {_NEXT_SEQ}").fetchone()
+            removed = conn.execute(
+                "UPDATE selfie_phashes SET phash = ?, updated_at = ?, seq = ? "
+                "WHERE phash != ? AND telegram_id NOT IN (SELECT telegram_id FROM temp.rebuilt)",
+                (REMOVED, now, seq, REMOVED),
+            ).rowcount
+            changed = conn.execute(
+                "INSERT OR REPLACE INTO selfie_phashes (telegram_id, phash, updated_at, seq) "
+                "SELECT r.telegram_id, r.phash, ?, ? FROM temp.rebuilt AS r "
+                "LEFT JOIN selfie_phashes AS p ON p.telegram_id = r.telegram_id WHERE p.phash IS NOT r.phash",
+                (now, seq),
+            ).rowcount
+            self._record(conn, duplicates, now)
+            conn.execute("DELETE FROM temp.rebuilt")
+            conn.commit()
+        return removed + changed
+
+    async def refresh(self) -> None:
+        """Pull hashes stored since the last refresh, including other processes' uploads."""
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            rows = await run_blocking(self._changed_since, self._synced_seq)
+            for telegram_id, value, seq in rows:
+                if value == REMOVED:
+                    self.index.remove(telegram_id)
+                else:
+                    self.index.add(telegram_id, int(value, 16))
+                self._synced_seq = max(self._synced_seq, seq)
+            if rows:
+                logger.debug("Pulled %d selfie hashes (%d indexed)", len(rows), len(self.index))
+
+    def find(self, value: int, exclude: Optional[int] = None) -> List[Tuple[int, int]]:
+        """Return ``(telegram_id, distance)`` of stored selfies near ``value``."""
+        with LOOKUP_SECONDS.time():
+            return [match for match in self.index.search(value, self.radius) if match[0] != exclude]
+
+    async def add(self, telegram_id: int, content: bytes) -> List[Tuple[int, int]]:
+        """Index a user's new selfie and return the nearest other users' selfies it nearly duplicates."""
+        value = await run_blocking(phash, content)
+        if value is None:
+            return []
+        await self.refresh()
+        matches = self.find(value, exclude=telegram_id)[:MAX_MATCHES]
+        self.index.add(telegram_id, value)
+        await run_blocking(self._store, telegram_id, value, matches)
+        if matches:
+            DUPLICATES.inc()
+            logger.warning("Selfie of %s nearly duplicates %s", telegram_id, matches)
+        return matches
+
+
+faces = FaceIndex(settings.SHARED_STATE_DB_PATH, settings.SELFIE_DUPLICATE_RADIUS)
+metrics.register_collector("bot_selfie_index", lambda: {"size": len(faces.index)})
+
+
+def _download(supabase, bucket: str, name: str) -> bytes:
+    return supabase.storage.from_(bucket).download(name)
+
+
+def rebuild(processes: int, concurrency: int, page_size: int = 1000) -> None:
+    """Hash every selfie in Storage and replace the stored index with the result.
+
+    Objects are listed page by page and downloaded on ``concurrency`` threads;
+    hashing is CPU-bound and runs on ``processes`` worker processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+    import clients
+    from selfies import BUCKET_NAME
+
+    supabase = clients.get_supabase()
+    started = time.perf_counter()
+    hashes: List[Tuple[int, int]] = []
+    failed = 0
+    with ThreadPoolExecutor(concurrency) as downloads, ProcessPoolExecutor(processes) as hashers:
+        for offset in itertools.count(0, page_size):
+            page = supabase.storage.from_(BUCKET_NAME).list("", {"limit": page_size, "offset": offset})
+            owners = []
+            for entry in page:
+                stem = entry["name"].rsplit(".", 1)[0]
+                if stem.isdigit():
+                    owners.append((int(stem), entry["name"]))
+            fetches = {
+                downloads.submit(_download, supabase, BUCKET_NAME, name): telegram_id for telegram_id, name in owners
+            }
+            pending = []
+            # Hash each selfie as soon as it arrives; a failed download only loses that one
+            for fetch in as_completed(fetches):
+                telegram_id = fetches[fetch]
+                try:
+                    content = fetch.result()
+                except Exception as e:
+                    logger.warning("Could not download selfie of %s: %s", telegram_id, e)
+                    failed += 1
+                    continue
+                pending.append((telegram_id, hashers.submit(phash, content)))
+            for telegram_id, future in pending:
+                try:
+                    value = future.result()
+                except Exception as e:
+                    logger.warning("Could not hash selfie of %s: %s", telegram_id, e)
+                    failed += 1
+                    continue
+                if value is None:
+                    raise RuntimeError("Hashing selfies requires Pillow")
+                hashes.append((telegram_id, value))
+            logger.info("Hashed %d selfies", len(hashes))
+            if len(page) < page_size:
+                break
+    elapsed = time.perf_counter() - started
+
+    index = HashIndex()
+    for telegram_id, value in hashes:
+        index.add(telegram_id, value)
+    duplicates = []
+    for telegram_id, value in hashes:
+        matches = [match for match in index.search(value, faces.radius) if match[0] != telegram_id]
+        duplicates.extend((telegram_id, other, distance) for other, distance in matches[:MAX_MATCHES])
+    changed = faces.replace_all(hashes, duplicates)
+    logger.info(
+        "Rebuilt selfie index: %d hashed (%d changed), %d failed in %.1fs (%.0f/s)",
+        len(hashes), changed, failed, elapsed, len(hashes) / elapsed if elapsed else 0.0,
+    )
+    flagged = len({telegram_id for telegram_id, _, _ in duplicates})
+    logger.info("%d selfies have a near duplicate within %d bits", flagged, faces.radius)
+
+
+def main() -> None:
+    import logsetup
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = commands.add_parser("rebuild", help="hash every selfie in Storage and replace the index")
+    rebuild_parser.add_argument("--processes", type=int, default=None, help="hashing processes (default: CPUs)")
+    rebuild_parser.add_argument("--concurrency", type=int, default=16, help="parallel downloads")
+    args = parser.parse_args()
+
+    logsetup.setup_logging(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_DEBUG_SAMPLE_RATE)
+    if args.command == "rebuild":
+        rebuild(args.processes, args.concurrency)
+
+
+if __name__ == "__main__":
+    main()
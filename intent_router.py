@@ -0,0 +1,139 @@
+"""Answers common questions locally from the knowledge-base sections.
+
+The assistant's knowledge base is a few dozen bullet points, grouped in the
+same sections the menus show. :class:`IntentRouter` indexes every bullet
+once (TF-IDF, cosine similarity) and, when a question clearly matches one
+section, returns that section's text instead of a completion. Questions it is
+not sure about (low best score, or two sections scoring alike) return
+``None`` and go to the model as before.
+
+Words the index has never seen still count towards the question's norm, so
+a question that mentions a known term among many unknown ones scores low.
+"""
+import logging
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import metrics
+from answer_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+_BULLET = re.compile(r"^\s*(?:[•\-*]|\d+[.)])\s*")
+_SUFFIXES = (("ies", "y"), ("ing", ""), ("ion", ""), ("ed", ""), ("es", ""), ("ly", ""), ("ss", "ss"), ("s", ""))
+
+STOP_WORDS = frozenset(
+    """a about am an and any are as at be been but by can could did do does doing for from had has have
+    how i if in is it its me my no not of on or our please so tell than that the their them then there
+    these they this to us was we what when where which who why will with would you your""".split()
+)
+
+SCORES = metrics.Histogram(
+    "bot_intent_router_score",
+    "Best section similarity of questions seen by the local router",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split ``text`` into folded, lightly stemmed terms without stop words."""
+    terms = []
+    for word in normalize_question(text).split():
+        if word in STOP_WORDS or len(word) < 2:
+            continue
+        terms.append(_stem(word))
+    return terms
+
+
+def _stem(word: str) -> str:
+    # Crude suffix folding is enough for a vocabulary this small
+    for suffix, replacement in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)] + replacement
+    return word
+
+
+def _normalized(weights: Dict[str, float], extra_norm: float = 0.0) -> Dict[str, float]:
+    norm = math.sqrt(sum(w * w for w in weights.values()) + extra_norm)
+    return {term: w / norm for term, w in weights.items()} if norm else {}
+
+
+class IntentRouter:
+    """TF-IDF index over the bullets of ``sections`` (key -> text shown for that topic).
+
+    A section's first line is its title and every other non-empty line is a
+    bullet; the title is indexed on its own and together with each bullet.
+    :meth:`route` returns the key of the best-matching section when its score
+    reaches ``threshold`` and beats the next section by at least ``margin``.
+    """
+
+    def __init__(self, sections: Mapping[str, str], threshold: float = 0.5, margin: float = 0.1) -> None:
+        self.sections = dict(sections)
+        self.threshold = threshold
+        self.margin = margin
+        self.questions = 0
+        self.answered = 0
+
+        documents: List[Tuple[str, List[str]]] = []
+        for key, text in self.sections.items():
+            title, *lines = [line for line in text.splitlines() if line.strip()]
+            documents.append((key, tokenize(title)))
+            for line in lines:
+                documents.append((key, tokenize(f"{title} {_BULLET.sub('', line)}")))
+
+        document_frequency = Counter(term for _, terms in documents for term in set(terms))
+        count = len(documents)
+        self._idf = {term: math.log((1 + count) / (1 + df)) + 1 for term, df in document_frequency.items()}
+        # Weight of a term no bullet contains
+        self._unknown_idf = math.log(1 + count) + 1
+        self._documents = [
+            (key, _normalized({term: tf * self._idf[term] for term, tf in Counter(terms).items()}))
+            for key, terms in documents
+        ]
+
+    def scores(self, question: str) -> Dict[str, float]:
+        """Return each section's best bullet similarity to ``question``."""
+        known: Dict[str, float] = {}
+        unknown = 0.0
+        for term, tf in Counter(tokenize(question)).items():
+            if term in self._idf:
+                known[term] = tf * self._idf[term]
+            else:
+                unknown += (tf * self._unknown_idf) ** 2
+        query = _normalized(known, unknown)
+        best = dict.fromkeys(self.sections, 0.0)
+        if query:
+            for key, vector in self._documents:
+                score = sum(weight * vector.get(term, 0.0) for term, weight in query.items())
+                if score > best[key]:
+                    best[key] = score
+        return best
+
+    def route(self, question: str) -> Optional[str]:
+        """Return the key of the section that answers ``question``, or ``None`` if unsure."""
+        self.questions += 1
+        ranked = sorted(self.scores(question).items(), key=lambda item: item[1], reverse=True)
+        key, score = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        SCORES.observe(score)
+        if score < self.threshold or score - runner_up < self.margin:
+            logger.debug("No local answer (best %s %.2f, next %.2f)", key, score, runner_up)
+            return None
+        self.answered += 1
+        logger.debug("Local answer from %s (%.2f, next %.2f)", key, score, runner_up)
+        return key
+
+    def answer(self, question: str) -> Optional[str]:
+        """Return the text of the section that answers ``question``, or ``None`` if unsure."""
+        key = self.route(question)
+        return None if key is None else self.sections[key]
+
+    def stats(self) -> Dict[str, float]:
+        """Return how many questions were seen and what fraction was answered locally."""
+        return {
+            "questions": self.questions,
+            "answered_locally": self.answered,
+            "local_fraction": self.answered / self.questions if self.questions else 0.0,
+        }
@@ -0,0 +1,221 @@
+"""Durable background job queue for work that should not block a handler.
+
+Jobs are rows in a local SQLite table, so they survive restarts: anything
+left ``running`` by a crash is retried on the next start. A fixed pool of
+asyncio workers claims due jobs and calls the queue's handler; failures are
+retried with exponential backoff up to ``max_attempts`` before the failure
+callback runs. Jobs that share a ``key`` (the user, by default) run one at a
+time and in the order they were enqueued. :meth:`DurableQueue.enqueue` raises :class:`QueueFull` once the
+backlog reaches ``max_pending`` so bursts are pushed back on the sender
+instead of growing without bound.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import metrics
+from upstream import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on how long an idle worker sleeps before looking for due jobs again
+IDLE_POLL = 1.0
+# A job waits while an earlier job with the same key is unfinished; jobs without the key never wait
+_KEY_FREE = (
+    "NOT EXISTS (SELECT 1 FROM jobs AS other WHERE other.queue = jobs.queue "
+    "AND other.status IN ('pending', 'running') AND other.id <> jobs.id "
+    "AND (other.status = 'running' OR other.id < jobs.id) "
+    "AND json_extract(other.payload, :key) = json_extract(jobs.payload, :key))"
+)
+
+Handler = Callable[[Any, Dict[str, Any]], Awaitable[None]]
+FailureHandler = Callable[[Any, Dict[str, Any], BaseException], Awaitable[None]]
+
+
+class QueueFull(Exception):
+    """Raised when a queue's backlog is at its limit."""
+
+
+class DurableQueue:
+    """SQLite-backed job queue drained by a pool of asyncio workers.
+
+    ``handler(bot, payload)`` processes one job; ``on_failure(bot, payload,
+    error)`` is awaited once a job has used up its attempts. Jobs whose
+    payloads have the same ``key`` value never run concurrently or out of
+    order; ``key=None`` lets every job run as soon as it is due.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        name: str,
+        handler: Handler,
+        on_failure: Optional[FailureHandler] = None,
+        workers: int = 4,
+        max_attempts: int = 5,
+        max_pending: int = 1000,
+        retry_delay: float = 2.0,
+        key: Optional[str] = "telegram_id",
+    ) -> None:
+        self.path = path
+        self.name = name
+        self.handler = handler
+        self.on_failure = on_failure
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.key = key
+        self.pending = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._bot: Any = None
+        metrics.register_collector(f"bot_jobs_{name}", lambda: {"pending": self.pending})
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_run_at REAL NOT NULL, last_error TEXT)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (queue, status, next_run_at)")
+        return self._conn
+
+    def _recover(self) -> int:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE jobs SET status = 'pending' WHERE queue = ? AND status = 'running'", (self.name,)
+            )
+            conn.commit()
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE queue = ? AND status = 'pending'", (self.name,)
+            ).fetchone()[0]
+
+    def _insert(self, payload: Dict[str, Any]) -> int:
+        with self._lock:
+            conn = self._connect()
+            job_id = conn.execute(
+                "INSERT INTO jobs (queue, payload, next_run_at) VALUES (?, ?, ?)",
+                (self.name, json.dumps(payload), time.time()),
+            ).lastrowid
+            conn.commit()
+            return job_id
+
+    def _claim(self) -> Tuple[Optional[tuple], float]:
+        """Claim the oldest due job; otherwise return how long until the next one is due."""
+        now = time.time()
+        ready = "queue = :queue AND status = 'pending'"
+        if self.key is not None:
+            ready += " AND " + _KEY_FREE
+        params = {"queue": self.name, "now": now, "key": f"$.{self.key}"}
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                f"SELECT id, payload, attempts FROM jobs WHERE {ready} AND next_run_at <= :now ORDER BY id LIMIT 1",
+                params,
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (row[0],))
+                conn.commit()
+                return row, 0.0
+            # Jobs held back by their key are picked up when the job ahead of them finishes
+            next_run_at = conn.execute(f"SELECT MIN(next_run_at) FROM jobs WHERE {ready}", params).fetchone()[0]
+        return None, IDLE_POLL if next_run_at is None else min(IDLE_POLL, next_run_at - now)
+
+    def _finish(self, job_id: int) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.commit()
+
+    def _fail(self, job_id: int, attempts: int, error: str) -> bool:
+        """Record a failed attempt; return whether the job will be retried."""
+        retry = attempts < self.max_attempts
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, next_run_at = ?, last_error = ? WHERE id = ?",
+                (
+                    "pending" if retry else "failed",
+                    attempts,
+                    time.time() + self.retry_delay * 2 ** (attempts - 1),
+                    error,
+                    job_id,
+                ),
+            )
+            conn.commit()
+        return retry
+
+    async def enqueue(self, payload: Dict[str, Any]) -> int:
+        """Persist a job and wake a worker; raise :class:`QueueFull` if the backlog is full."""
+        if self.pending >= self.max_pending:
+            raise QueueFull(f"{self.name} queue has {self.pending} pending jobs")
+        self.pending += 1
+        try:
+            job_id = await run_blocking(self._insert, payload)
+        except Exception:
+            self.pending -= 1
+            raise
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def start(self, bot: Any) -> None:
+        """Recover interrupted jobs and start the worker pool."""
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self.pending = await run_blocking(self._recover)
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"{self.name}-worker-{i}") for i in range(self.workers)
+        ]
+        logger.info("Started %d %s workers (%d jobs pending)", self.workers, self.name, self.pending)
+
+    async def stop(self) -> None:
+        """Stop the workers; jobs still running are picked up again on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+
+    async def _worker(self) -> None:
+        while True:
+            job, wait = await run_blocking(self._claim)
+            if job is None:
+                self._wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(wait, 0.01))
+                continue
+
+            job_id, raw_payload, attempts = job
+            payload = json.loads(raw_payload)
+            try:
+                await self.handler(self._bot, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                attempts += 1
+                logger.warning("%s job %d failed (attempt %d/%d): %s", self.name, job_id, attempts, self.max_attempts, e)
+                if not await run_blocking(self._fail, job_id, attempts, repr(e)):
+                    self.pending -= 1
+                    # Release the next job with the same key
+                    self._wakeup.set()
+                    if self.on_failure is not None:
+                        with contextlib.suppress(Exception):
+                            await self.on_failure(self._bot, payload, e)
+                continue
+            self.pending -= 1
+            await run_blocking(self._finish, job_id)
+            self._wakeup.set()
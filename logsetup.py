@@ -0,0 +1,103 @@
+"""Logging setup: off-thread output, structured records, sampled debug logs.
+
+Handlers only put records on an in-memory queue; formatting and writing to
+stdout happen on a listener thread, so logging never blocks the event loop.
+Messages use ``%``-style arguments and are only formatted if a record is
+actually emitted. Every record carries the ``user_id`` and ``update_id`` of
+the update being processed (set by :func:`bind_update`), and DEBUG records
+can be sampled to keep high-volume diagnostics affordable.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from typing import Optional
+
+user_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("user_id", default=None)
+update_id_var: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("update_id", default=None)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def bind_update(update: object) -> None:
+    """Tag log records of the current task with the update's ids."""
+    update_id_var.set(getattr(update, "update_id", None))
+    user = getattr(update, "effective_user", None)
+    user_id_var.set(user.id if user is not None else None)
+
+
+class ContextFilter(logging.Filter):
+    """Attach the current update's ids to each record and sample DEBUG records."""
+
+    def __init__(self, debug_sample_rate: float = 1.0) -> None:
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and self.debug_sample_rate < 1.0:
+            if random.random() >= self.debug_sample_rate:
+                return False
+        record.user_id = user_id_var.get()
+        record.update_id = update_id_var.get()
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that leaves message formatting to the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in ("user_id", "update_id"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: str = "INFO", fmt: str = "json", debug_sample_rate: float = 1.0) -> None:
+    """Route all logging through a background listener thread. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    if fmt == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - [user=%(user_id)s update=%(update_id)s] %(message)s")
+        )
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(records)
+    handler.addFilter(ContextFilter(debug_sample_rate))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # Library chatter (every HTTP request) is not useful at INFO
+    for noisy in ("httpx", "httpcore", "hpack"):
+        logging.getLogger(noisy).setLevel(max(logging.WARNING, root.level))
+
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
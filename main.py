@@ -1,89 +1,92 @@
+from __future__ import annotations
+
 import logging
-import asyncio
-import config
-from supabase import create_client, Client
-from openai import OpenAI
-
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    filters,
-    ContextTypes,
-)
+from typing import TYPE_CHECKING
 
-# Enable detailed logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.DEBUG
-)
-logger = logging.getLogger(__name__)
+import clients
+import metrics
+import selfies
+import settings
+import users
+from ai_chat import ChatResponder
+from jobs import DurableQueue, QueueFull
+from menus import MenuRegistry
 
-# Supabase setup
-supabase: Client = create_client(config.SUPABASE_URL, config.SUPABASE_SERVICE_KEY)
-BUCKET_NAME = "user_selfies"
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
 
-# OpenAI setup
-openai_client = OpenAI(api_key=config.OPENAI_API_KEY)
+logger = logging.getLogger(__name__)
 
-# Keyboards
-MAIN_KEYBOARD = [
-    [KeyboardButton("About BitID")],
-    [KeyboardButton("Join Genesis.BitID")],
-    [KeyboardButton("Discuss, ask about BitID.(ai)")],
-]
-BACK_KEYBOARD = [[KeyboardButton("🔙 Back to Main Menu")]]
+# AI chat
+SYSTEM_PROMPT = "Твоя задача - рассказать пользователю о проекте BitID отвечая на его вопросы. Твоя цель - убедить пользователя зарегистрироваться прислав свое селфи. Ты говоришь по-русски, вежливо и ненавязчиво. BitID - это цифровой идентификатор на основе биометрии лица человека."
+buddy = ChatResponder(
+    SYSTEM_PROMPT,
+    namespace="main",
+    slow_down_text="Вы отправляете сообщения слишком часто. Подождите несколько секунд и попробуйте снова.",
+)
+
+# Menus
+menu = MenuRegistry("main", inline=False)
+menu.add(
+    "main",
+    "Добро пожаловать! Пожалуйста, выберите опцию:",
+    [
+        ("About BitID", "about"),
+        ("Join Genesis.BitID", "join"),
+        ("Discuss, ask about BitID.(ai)", "discuss"),
+    ],
+    back_label="🔙 Back to Main Menu",
+    back_target="back",
+)
+menu.add(
+    "about",
+    "BitID - это цифровой идентификатор на основе вашего лица. Он позволяет безопасно подтверждать вашу личность в различных сервисах без паролей и документов. BitID создается на основе уникальных характеристик вашего лица и обеспечивает высокий уровень безопасности.",
+    parent="main",
+)
 
 
+@metrics.instrument_handler("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a message with three buttons."""
-    logger.info(f"Start command from user {update.message.from_user.id}")
+    logger.info("Start command from user %s", update.message.from_user.id)
     context.user_data.clear()  # Clear state on /start
-    reply_markup = ReplyKeyboardMarkup(MAIN_KEYBOARD, resize_keyboard=True)
-    await update.message.reply_text(
-        "Добро пожаловать! Пожалуйста, выберите опцию:", reply_markup=reply_markup
-    )
-
-
-async def about_bitid(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles the 'About BitID' button."""
-    logger.info(f"About BitID clicked by user {update.message.from_user.id}")
-    reply_markup = ReplyKeyboardMarkup(BACK_KEYBOARD, resize_keyboard=True)
-    await update.message.reply_text(
-        "BitID - это цифровой идентификатор на основе вашего лица. Он позволяет безопасно подтверждать вашу личность в различных сервисах без паролей и документов. BitID создается на основе уникальных характеристик вашего лица и обеспечивает высокий уровень безопасности.",
-        reply_markup=reply_markup,
-    )
+    buddy.memory.clear(update.message.from_user.id)
+    await menu.send(update.message, "main")
+    users.join_prefetch.start(update.message.from_user.id)
 
 
+@menu.action("join")
+@metrics.instrument_handler("join_genesis")
 async def join_genesis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the 'Join Genesis.BitID' button according to README.md specs."""
     telegram_id = update.message.from_user.id
-    logger.info(f"Join Genesis clicked by user {telegram_id}")
-    reply_markup = ReplyKeyboardMarkup(BACK_KEYBOARD, resize_keyboard=True)
+    logger.info("Join Genesis clicked by user %s", telegram_id)
+    reply_markup = menu.back_markup("main")
     
     try:
-        # Check if user exists in database
-        logger.debug(f"Checking if user {telegram_id} exists in database")
-        response = supabase.table("users").select("id, bit_id").eq("telegram_id", telegram_id).execute()
-        logger.debug(f"Database response: {response}")
+        # Check if user exists in database (usually prefetched when the main menu was shown)
+        logger.debug("Checking if user %s exists in database", telegram_id)
+        data = await users.join_prefetch.take(telegram_id) or await users.join_data(telegram_id)
+        logger.debug("Registration status: %s", data.registered)
         
-        if response.data and len(response.data) > 0:
+        if data.registered:
             # User is registered - try to show their photo
-            logger.info(f"User {telegram_id} is registered, showing photo")
+            logger.info("User %s is registered, showing photo", telegram_id)
             try:
-                photo_url = supabase.storage.from_(BUCKET_NAME).get_public_url(f"{telegram_id}.jpg")
-                logger.debug(f"Photo URL for user {telegram_id}: {photo_url}")
-                
-                await update.message.reply_photo(
-                    photo=photo_url,
+                await selfies.send_selfie(
+                    update.message.reply_photo,
+                    clients.get_supabase(),
+                    telegram_id,
+                    file_id=data.file_id,
                     caption="Вот твое фото для регистрации:\n\nЕсли хочешь заменить - пришли новое селфи.",
                     reply_markup=reply_markup,
                 )
                 context.user_data['awaiting_selfie_replacement'] = True
-                logger.info(f"Successfully showed photo for user {telegram_id}")
+                logger.info("Successfully showed photo for user %s", telegram_id)
                 
             except Exception as photo_error:
-                logger.error(f"Error showing photo for user {telegram_id}: {photo_error}")
+                logger.error("Error showing photo for user %s: %s", telegram_id, photo_error)
                 # If photo doesn't exist but user is registered, ask for new photo
                 await update.message.reply_text(
                     "Вы зарегистрированы, но фото не найдено. Пришлите новое селфи.",
@@ -92,7 +95,7 @@ async def join_genesis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                 context.user_data['awaiting_selfie_replacement'] = True
         else:
             # User is not registered
-            logger.info(f"User {telegram_id} is not registered, prompting for selfie")
+            logger.info("User %s is not registered, prompting for selfie", telegram_id)
             await update.message.reply_text(
                 "У тебя нет BitID. Пришли селфи чтобы получить BitID.",
                 reply_markup=reply_markup,
@@ -100,7 +103,7 @@ async def join_genesis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             context.user_data['awaiting_selfie_registration'] = True
 
     except Exception as e:
-        logger.error(f"Error checking user registration for {telegram_id}: {e}")
+        logger.error("Error checking user registration for %s: %s", telegram_id, e)
         # Fallback: assume user is not registered
         await update.message.reply_text(
             "У тебя нет BitID. Пришли селфи чтобы получить BitID.",
@@ -109,80 +112,44 @@ async def join_genesis(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         context.user_data['awaiting_selfie_registration'] = True
 
 
+@metrics.instrument_handler("handle_photo")
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles user's selfie according to README.md specs."""
     telegram_id = update.message.from_user.id
-    logger.info(f"Photo received from user {telegram_id}")
-    logger.debug(f"User data state: {context.user_data}")
+    logger.info("Photo received from user %s", telegram_id)
+    logger.debug("User data state: %s", dict(context.user_data))
     
     if context.user_data.get('awaiting_selfie_registration') or context.user_data.get('awaiting_selfie_replacement'):
-        logger.info(f"Processing photo for user {telegram_id}")
+        logger.info("Queueing photo for user %s", telegram_id)
         try:
-            # Download photo from Telegram
-            photo_file = await update.message.photo[-1].get_file()
-            logger.debug(f"Got photo file: {photo_file}")
-            
-            file_content = await photo_file.download_as_bytearray()
-            logger.debug(f"Downloaded photo, size: {len(file_content)} bytes")
-            
-            file_path = f"{telegram_id}.jpg"
-
-            # Upload to Supabase Storage
-            logger.info(f"Uploading photo to Supabase storage: {file_path}")
-            try:
-                upload_result = supabase.storage.from_(BUCKET_NAME).upload(
-                    file=bytes(file_content), 
-                    path=file_path, 
-                    file_options={"content-type": "image/jpeg", "upsert": "true"}
-                )
-                logger.info(f"Photo uploaded successfully: {upload_result}")
-            except Exception as upload_error:
-                logger.error(f"Upload error: {upload_error}")
-                # Try alternative upload method
-                try:
-                    upload_result = supabase.storage.from_(BUCKET_NAME).upload(
-                        file=bytes(file_content), 
-                        path=file_path
-                    )
-                    logger.info(f"Photo uploaded with alternative method: {upload_result}")
-                except Exception as upload_error2:
-                    logger.error(f"Alternative upload also failed: {upload_error2}")
-                    raise upload_error2
-
-            if context.user_data.get('awaiting_selfie_registration'):
-                # New user registration - add to database
-                logger.info(f"Registering new user {telegram_id} in database")
-                try:
-                    insert_result = supabase.table("users").insert({"telegram_id": telegram_id}).execute()
-                    logger.info(f"User registered successfully: {insert_result}")
-                except Exception as insert_error:
-                    logger.warning(f"Insert error for user {telegram_id}: {insert_error}")
-                    
-                # Send success message according to README.md
-                await update.message.reply_text(
-                    "Спасибо за регистрацию! Мы отправим тебе BitID как только он будет сформирован."
-                )
-                logger.info(f"Registration complete for user {telegram_id}")
-            
-            elif context.user_data.get('awaiting_selfie_replacement'):
-                # Photo replacement
-                await update.message.reply_text(
-                    "Ваше фото было обновлено!"
-                )
-                logger.info(f"Photo updated for user {telegram_id}")
-            
-            # Clear state and return to main menu
-            context.user_data.clear()
-            await asyncio.sleep(1)
-            await start(update, context)
-
+            # Upload and registration run in the background; the outcome arrives as a follow-up
+            await selfie_jobs.enqueue({
+                "telegram_id": telegram_id,
+                "chat_id": update.effective_chat.id,
+                "file_id": update.message.photo[-1].file_id,
+                "register": bool(context.user_data.get('awaiting_selfie_registration')),
+            })
+            users.join_prefetch.discard(telegram_id)
+        except QueueFull:
+            logger.warning("Selfie queue full, asking user %s to retry", telegram_id)
+            await update.message.reply_text(
+                "Сейчас мы получаем очень много селфи. Пожалуйста, пришлите фото еще раз через минуту."
+            )
+            return
         except Exception as e:
-            logger.error(f"Error processing photo for user {telegram_id}: {e}")
+            logger.error("Error queueing photo for user %s: %s", telegram_id, e)
             await update.message.reply_text(
                 "Не удалось сохранить ваше фото. Попробуйте снова."
             )
+            return
+
+        await update.message.reply_text("Селфи получено! Я напишу, как только оно будет сохранено.")
+
+        # Clear state and return to main menu
+        context.user_data.clear()
+        await start(update, context)
     else:
-        logger.info(f"Photo sent outside of registration flow by user {telegram_id}")
+        logger.info("Photo sent outside of registration flow by user %s", telegram_id)
         # Photo sent outside of registration flow - redirect to AI chat
         if not context.user_data.get('ai_chat_enabled'):
             await start_ai_chat(update, context)
@@ -192,74 +159,173 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             )
 
 
+async def process_selfie_job(bot, job: dict) -> None:
+    """Stores a queued selfie, registers the user if needed and reports back."""
+    telegram_id = job["telegram_id"]
+    logger.info("Storing selfie for user %s", telegram_id)
+    supabase = clients.get_supabase()
+    stored = await selfies.store_from_telegram(bot, supabase, telegram_id, job["file_id"])
+    logger.info("Selfie stored for user %s: %s", telegram_id, stored)
+
+    if job["register"]:
+        # New user registration - add to database
+        logger.info("Registering new user %s in database", telegram_id)
+        # A retried job may already have inserted the user; other errors go to the queue for a retry
+        if not await users.is_registered(supabase, telegram_id):
+            insert_result = await users.register_user(supabase, telegram_id)
+            logger.info("User registered successfully: %s", insert_result)
+
+        # Send success message according to README.md
+        await bot.send_message(
+            chat_id=job["chat_id"],
+            text="Спасибо за регистрацию! Мы отправим тебе BitID как только он будет сформирован.",
+        )
+        logger.info("Registration complete for user %s", telegram_id)
+    else:
+        # Photo replacement
+        users.mark_registered(telegram_id)
+        await bot.send_message(chat_id=job["chat_id"], text="Ваше фото было обновлено!")
+        logger.info("Photo updated for user %s", telegram_id)
+
+
+async def selfie_job_failed(bot, job: dict, error: BaseException) -> None:
+    """Tells the user their queued selfie could not be saved."""
+    logger.error("Error processing photo for user %s: %s", job['telegram_id'], error)
+    await bot.send_message(
+        chat_id=job["chat_id"],
+        text="Не удалось сохранить ваше фото. Попробуйте снова.",
+    )
+
+
+selfie_jobs = DurableQueue(
+    settings.STATE_DB_PATH,
+    "selfies",
+    process_selfie_job,
+    on_failure=selfie_job_failed,
+    workers=settings.JOB_WORKERS,
+    max_attempts=settings.JOB_MAX_ATTEMPTS,
+    max_pending=settings.JOB_MAX_PENDING,
+    retry_delay=settings.JOB_RETRY_DELAY,
+)
+
+
+@menu.action("discuss")
+@metrics.instrument_handler("start_ai_chat")
 async def start_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Starts a chat session with the AI assistant according to README.md specs."""
-    logger.info(f"AI chat started by user {update.message.from_user.id}")
+    logger.info("AI chat started by user %s", update.message.from_user.id)
     context.user_data['ai_chat_enabled'] = True
-    reply_markup = ReplyKeyboardMarkup(BACK_KEYBOARD, resize_keyboard=True)
     await update.message.reply_text(
         "Привет! Я - Бадди, я помогаю тебе узнать о BitID и зарегистрирую тебя в Genesis как только получу твое селфи. пришлешь фото сейчас или хочешь узнать больше о проекте?",
-        reply_markup=reply_markup,
+        reply_markup=menu.back_markup("main"),
     )
 
 
+@metrics.instrument_handler("handle_text", label=lambda update: menu.key_for_label(update.message.text) or "chat")
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Routes menu button labels through the menu registry and other text to the AI chat."""
+    logger.info("RECEIVED MESSAGE: '%s' from user %s", update.message.text, update.message.from_user.id)
+    key = menu.key_for_label(update.message.text)
+    if key is not None:
+        await menu.dispatch(update, context, key)
+    else:
+        await handle_ai_chat(update, context)
+
+
+@metrics.instrument_handler("handle_ai_chat")
 async def handle_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles messages when in AI chat mode."""
-    logger.info(f"RECEIVED MESSAGE: '{update.message.text}' from user {update.message.from_user.id}")
-    
-    # Skip processing button clicks to avoid duplication
-    button_texts = ["About BitID", "Join Genesis.BitID", "Discuss, ask about BitID.(ai)", "🔙 Back to Main Menu"]
-    if update.message.text in button_texts:
-        logger.debug(f"Skipping button text: {update.message.text}")
-        return
-    
     if context.user_data.get('ai_chat_enabled'):
         user_message = update.message.text
-        logger.info(f"AI chat message from user {update.message.from_user.id}: {user_message}")
+        logger.info("AI chat message from user %s: %s", update.message.from_user.id, user_message)
         
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "Твоя задача - рассказать пользователю о проекте BitID отвечая на его вопросы. Твоя цель - убедить пользователя зарегистрироваться прислав свое селфи. Ты говоришь по-русски, вежливо и ненавязчиво. BitID - это цифровой идентификатор на основе биометрии лица человека."},
-                    {"role": "user", "content": user_message}
-                ]
-            )
-            ai_response = response.choices[0].message.content
-            await update.message.reply_text(ai_response)
+            await buddy.reply(update.message, update.message.from_user.id, user_message)
         except Exception as e:
-            logger.error(f"Error calling OpenAI: {e}")
+            logger.error("Error calling OpenAI: %s", e)
             await update.message.reply_text("Извините, у меня временные проблемы с подключением к ИИ. Попробуйте позже или обратитесь в главное меню.")
 
 
+@menu.action("back")
+@metrics.instrument_handler("handle_back_button")
 async def handle_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the back button."""
-    logger.info(f"Back button pressed by user {update.message.from_user.id}")
+    logger.info("Back button pressed by user %s", update.message.from_user.id)
     await start(update, context)
 
 
-def main() -> None:
-    """Start the bot."""
-    logger.info("Creating Telegram application...")
-    application = Application.builder().token(config.TELEGRAM_BOT_TOKEN).build()
+metrics_runner = None
+
+
+async def post_init(application: Application) -> None:
+    """Starts background workers and the metrics endpoint once the bot is initialized."""
+    global metrics_runner
+    await selfie_jobs.start(application.bot)
+    application.persistence.start_eviction(application)
+    if settings.METRICS_PORT:
+        metrics_runner = await metrics.start_server(settings.METRICS_HOST, settings.METRICS_PORT)
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stops background workers and the metrics endpoint."""
+    users.join_prefetch.cancel_all()
+    await selfie_jobs.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+
+def build_application() -> Application:
+    """Creates the Telegram application with all handlers registered."""
+    from telegram.ext import Application, CommandHandler, MessageHandler, filters
+
+    from persistence import SQLitePersistence
+    from telegram_request import InstrumentedRequest
+    from update_processor import PerUserUpdateProcessor
+
+    application = (
+        Application.builder()
+        .token(settings.TELEGRAM_BOT_TOKEN)
+        .base_url(f"{settings.TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{settings.TELEGRAM_API_URL}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=settings.TELEGRAM_POOL_SIZE))
+        .concurrent_updates(
+            PerUserUpdateProcessor(
+                settings.CONCURRENT_UPDATES,
+                settings.MAX_QUEUED_UPDATES_PER_USER,
+                key_by=settings.UPDATE_ORDERING_KEY,
+            )
+        )
+        .persistence(
+            SQLitePersistence(settings.STATE_DB_PATH, settings.PERSISTENCE_UPDATE_INTERVAL, settings.USER_DATA_IDLE_TTL)
+        )
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
     
-    # Button handlers (order matters - specific buttons before general text handler!)
-    application.add_handler(MessageHandler(filters.Regex("^🔙 Back to Main Menu$"), handle_back_button))
-    application.add_handler(MessageHandler(filters.Regex("^About BitID$"), about_bitid))
-    application.add_handler(MessageHandler(filters.Regex("^Join Genesis\\.BitID$"), join_genesis))
-    application.add_handler(MessageHandler(filters.Regex("^Discuss, ask about BitID\\.\\(ai\\)$"), start_ai_chat))
-    
-    # Catch-all text handler for debugging
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_ai_chat))
+    # Menu buttons and AI chat share one text handler; buttons are resolved through the menu registry
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     
     # Photo handler
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    return application
+
+
+def main() -> None:
+    """Start the bot."""
+    from telegram import Update
 
+    import logsetup
+    import serving
+
+    logsetup.setup_logging(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_DEBUG_SAMPLE_RATE)
+    logger.info("Creating Telegram application...")
+    application = build_application()
     logger.info("Starting bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    serving.run(application, allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+"""Declarative menu tree shared by both entry points.
+
+Each menu is a node with its text, its buttons and an optional parent; the
+keyboard markup (including the "back" button to the parent) is built once,
+the first time the menu is shown. Button presses are dispatched with a single
+dict lookup: nodes that need to do work (query the database, change user
+state) register an action, all others are rendered straight from the tree.
+
+Re-tapping the menu that is already on screen would make Telegram reject
+the edit with "message is not modified" after a wasted round-trip, so
+:meth:`MenuRegistry.show` compares the rendered text and markup with the
+message being edited and skips the call when they match.
+"""
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+import metrics
+
+if TYPE_CHECKING:
+    from telegram import Message, Update
+
+logger = logging.getLogger(__name__)
+
+Action = Callable[["Update", Any], Awaitable[None]]
+
+
+@dataclass(frozen=True)
+class Menu:
+    """A menu node: its text and one ``(label, target key)`` button per row."""
+
+    key: str
+    text: str
+    rows: Tuple[Tuple[str, str], ...]
+    parent: Optional[str] = None
+    # Label and target of the button that returns to this menu from its children
+    back_label: Optional[str] = None
+    back_target: Optional[str] = None
+
+
+class MenuRegistry:
+    """Menu nodes keyed by callback data (inline) or button label (reply keyboards).
+
+    With ``inline=True`` buttons carry their target key as callback data and
+    menus are shown by editing the message they are attached to. With
+    ``inline=False`` buttons are reply-keyboard labels, resolved back to keys
+    with :meth:`key_for_label`, and every menu is sent as a new message.
+    """
+
+    def __init__(self, name: str, inline: bool = True) -> None:
+        self.inline = inline
+        self._menus: Dict[str, Menu] = {}
+        self._actions: Dict[str, Action] = {}
+        self._labels: Dict[str, str] = {}
+        self._markups: Dict[Any, Any] = {}
+        self.edits = 0
+        self.edits_skipped = 0
+        metrics.register_collector(
+            f"bot_menus_{name}", lambda: {"edits": self.edits, "edits_skipped": self.edits_skipped}
+        )
+
+    def add(
+        self,
+        key: str,
+        text: str,
+        buttons: Sequence[Tuple[str, str]] = (),
+        parent: Optional[str] = None,
+        back_label: Optional[str] = None,
+        back_target: Optional[str] = None,
+    ) -> Menu:
+        """Register a menu showing ``text`` with one row per ``(label, target key)`` button.
+
+        A child of ``parent`` gets the parent's back button as its last row;
+        ``back_label``/``back_target`` define that button for this node's own
+        children (the target defaults to ``key``).
+        """
+        rows = list(buttons)
+        if parent is not None:
+            rows.append(self.back_button(parent))
+        menu = Menu(key, text, tuple(rows), parent, back_label, back_target or key)
+        self._menus[key] = menu
+        for label, target in rows:
+            self._labels[label] = target
+        return menu
+
+    def action(self, key: str) -> Callable[[Action], Action]:
+        """Decorate ``async def handler(update, context)`` to run when ``key`` is chosen."""
+
+        def decorator(handler: Action) -> Action:
+            self._actions[key] = handler
+            return handler
+
+        return decorator
+
+    def __getitem__(self, key: str) -> Menu:
+        return self._menus[key]
+
+    def back_button(self, key: str) -> Tuple[str, str]:
+        """The ``(label, target)`` button leading back to menu ``key``."""
+        menu = self._menus[key]
+        if menu.back_label is None:
+            raise ValueError(f"menu {key!r} has no back_label")
+        return menu.back_label, menu.back_target
+
+    def markup(self, key: str) -> Any:
+        """The keyboard of menu ``key``."""
+        return self._markup(self._menus[key].rows)
+
+    def back_markup(self, key: str) -> Any:
+        """A keyboard with only the button back to menu ``key``."""
+        return self._markup((self.back_button(key),))
+
+    def key_for_label(self, label: str) -> Optional[str]:
+        """Map a reply-keyboard button label to the key it leads to."""
+        return self._labels.get(label)
+
+    def _markup(self, rows: Tuple[Tuple[str, str], ...]) -> Any:
+        markup = self._markups.get(rows)
+        if markup is None:
+            from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+            if self.inline:
+                markup = InlineKeyboardMarkup(
+                    [[InlineKeyboardButton(label, callback_data=target)] for label, target in rows]
+                )
+            else:
+                markup = ReplyKeyboardMarkup([[KeyboardButton(label)] for label, _ in rows], resize_keyboard=True)
+            self._markups[rows] = markup
+        return markup
+
+    async def dispatch(self, update: "Update", context: Any, key: str) -> bool:
+        """Run the action for ``key`` or show its menu; ``False`` if ``key`` is unknown."""
+        action = self._actions.get(key)
+        if action is not None:
+            await action(update, context)
+            return True
+        if key in self._menus:
+            await self.show(update, key)
+            return True
+        return False
+
+    async def send(self, message: "Message", key: str, text: Optional[str] = None) -> "Message":
+        """Send menu ``key`` as a reply to ``message``, optionally with different text."""
+        return await message.reply_text(text or self._menus[key].text, reply_markup=self.markup(key))
+
+    async def show(self, update: "Update", key: str) -> bool:
+        """Show menu ``key`` in place of the pressed menu (or as a new message).
+
+        Returns ``False`` when the edit was skipped because the menu is already on screen.
+        """
+        menu = self._menus[key]
+        query = update.callback_query
+        if query is None:
+            await self.send(update.effective_message, key)
+            return True
+        return await self.edit(query, menu.text, self.markup(key))
+
+    async def edit(self, query, text: str, markup: Any = None) -> bool:
+        """Edit the message of ``query`` unless it already shows ``text`` and ``markup``."""
+        from telegram.error import BadRequest
+
+        current = query.message
+        if getattr(current, "text", None) == text and getattr(current, "reply_markup", None) == markup:
+            self.edits_skipped += 1
+            return False
+        try:
+            await query.edit_message_text(text, reply_markup=markup)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+            self.edits_skipped += 1
+            return False
+        self.edits += 1
+        return True
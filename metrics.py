@@ -0,0 +1,222 @@
+"""In-process latency/throughput metrics with a Prometheus text endpoint.
+
+Recording is a couple of dict lookups and integer increments; nothing is
+formatted until someone scrapes ``/metrics``, so instrumentation costs next to
+nothing when no one is looking. Values owned by other components (cache hit
+counters, queue depths, ...) are read at scrape time through callbacks
+registered with :func:`register_collector`.
+"""
+import bisect
+import contextlib
+import functools
+import logging
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: str = "") -> str:
+        parts = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for key, value in self._values.items():
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> Iterator[str]:
+        yield from super().render()
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{self._format_labels(key, le)} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {total[0]}"
+            yield f"{self.name}_count{self._format_labels(key)} {cumulative}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_registry: List[_Metric] = []
+_collectors: List[Callable[[], Dict[str, float]]] = []
+
+
+def register_collector(prefix: str, collect: Callable[[], Dict[str, float]]) -> None:
+    """Expose ``collect()``'s numeric values as gauges named ``<prefix>_<key>`` at scrape time."""
+    _collectors.append(lambda: {f"{prefix}_{key}": value for key, value in collect().items()})
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            values = collect()
+        except Exception:
+            logger.exception("Metrics collector failed")
+            continue
+        for name, value in values.items():
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# Bot-wide metrics
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Handler latency", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler invocations that raised", ["handler"])
+UPSTREAM_SECONDS = Histogram("bot_upstream_seconds", "Upstream call latency", ["service", "operation"])
+UPSTREAM_ERRORS = Counter("bot_upstream_errors_total", "Upstream calls that failed", ["service", "operation"])
+UPSTREAM_IN_FLIGHT = Gauge("bot_upstream_in_flight", "Upstream calls in progress", ["service"])
+UPDATE_WAIT_SECONDS = Histogram(
+    "bot_update_wait_seconds", "Time an update waited for its turn and a processing slot"
+)
+
+
+def instrument_handler(name: str, label: Optional[Callable[[Any], str]] = None):
+    """Decorate a handler ``(update, context, ...)`` to record its latency and errors.
+
+    ``label`` derives a finer-grained handler label from the update, e.g. the
+    callback data of a button press.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context, *args, **kwargs):
+            handler_label = name
+            if label is not None:
+                with contextlib.suppress(Exception):
+                    handler_label = f"{name}:{label(update)}"
+            started = time.perf_counter()
+            try:
+                return await handler(update, context, *args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=handler_label)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler_label)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def track_upstream(service: str, operation: str) -> Iterator[None]:
+    """Time one upstream call and count it as in flight while it runs."""
+    UPSTREAM_IN_FLIGHT.inc(service=service)
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        UPSTREAM_ERRORS.inc(service=service, operation=operation)
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, service=service, operation=operation)
+        UPSTREAM_IN_FLIGHT.dec(service=service)
+
+
+async def scrape(request):
+    """aiohttp handler returning :func:`render`'s output."""
+    from aiohttp import web
+
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+def build_metrics_app():
+    """Return an aiohttp app serving ``/metrics``."""
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", scrape)
+    return app
+
+
+async def start_server(host: str, port: int):
+    """Serve ``/metrics`` on ``host:port``; return the runner so the caller can clean it up."""
+    from aiohttp import web
+
+    runner = web.AppRunner(build_metrics_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics endpoint listening on %s:%d", host, port)
+    return runner
@@ -0,0 +1,239 @@
+"""SQLite-backed persistence for per-user bot state.
+
+Conversation state (``greeted``, ``awaiting_selfie_*``, ``ai_chat_enabled``,
+``photo_message_id``) lives in ``context.user_data``. :class:`SQLitePersistence`
+keeps it across restarts without the cost of the stock pickle persistence,
+which rewrites one big blob:
+
+* each user is one row holding a compact JSON record (pickle only as a
+  fallback for values JSON cannot represent), and empty records are deleted;
+* changed records are written behind, coalesced into one transaction;
+* nothing is read at startup - a user's record is loaded the first time one
+  of their updates is processed;
+* users idle for ``idle_ttl`` seconds are dropped from ``Application.user_data``
+  (their row stays), so memory only holds users who are active.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from upstream import run_blocking
+
+if TYPE_CHECKING:
+    from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+_JSON = b"j"
+_PICKLE = b"p"
+
+
+def encode_record(data: Dict[str, Any]) -> bytes:
+    try:
+        return _JSON + json.dumps(data, separators=(",", ":")).encode()
+    except (TypeError, ValueError):
+        return _PICKLE + pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_record(blob: bytes) -> Dict[str, Any]:
+    if blob[:1] == _JSON:
+        return json.loads(blob[1:])
+    return pickle.loads(blob[1:])
+
+
+class SQLitePersistence(BasePersistence):
+    """Persists ``user_data`` only, one row per user, loaded lazily and written behind.
+
+    With ``idle_ttl`` (seconds, 0 disables), :meth:`start_eviction` drops
+    idle users from memory; their record is read again on their next update.
+    """
+
+    def __init__(self, path: str, update_interval: float = 5, idle_ttl: float = 0) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.evicted = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # Users whose record is loaded: user_id -> (last seen, their live user_data), least recent first
+        self._active: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # Dropped from memory by evict_idle; the drop must not delete their row
+        self._evicting: Set[int] = set()
+        # user_id -> encoded record, or None to delete the row
+        self._dirty: Dict[int, Optional[bytes]] = {}
+        self._writing: Dict[int, Optional[bytes]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+        self._evict_task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, record BLOB NOT NULL)"
+            )
+        return self._conn
+
+    def _read(self, user_id: int) -> Optional[bytes]:
+        with self._lock:
+            row = self._connect().execute("SELECT record FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, changes: Dict[int, Optional[bytes]]) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, record) VALUES (?, ?)",
+                [(user_id, record) for user_id, record in changes.items() if record is not None],
+            )
+            conn.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, record in changes.items() if record is None],
+            )
+            conn.commit()
+
+    async def _write_behind(self) -> None:
+        # Let every update_user_data() call of this persistence run land first
+        await asyncio.sleep(0)
+        while self._dirty:
+            changes, self._dirty = self._dirty, {}
+            self._writing = changes
+            try:
+                await run_blocking(self._write, changes)
+            except Exception:
+                logger.exception("Writing %d user records failed, will retry on next flush", len(changes))
+                self._dirty = {**changes, **self._dirty}
+                break
+            finally:
+                self._writing = {}
+            logger.debug("Persisted %d user records", len(changes))
+        self._write_task = None
+
+    def _schedule_write(self) -> None:
+        if self._write_task is None:
+            self._write_task = asyncio.get_running_loop().create_task(self._write_behind())
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # Records are loaded per user in refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        if user_id in self._active:
+            self._active[user_id] = (time.monotonic(), user_data)
+            self._active.move_to_end(user_id)
+            return
+        # A record evicted moments ago may not have reached the database yet
+        if user_id in self._dirty:
+            blob = self._dirty[user_id]
+        elif user_id in self._writing:
+            blob = self._writing[user_id]
+        else:
+            blob = await run_blocking(self._read, user_id)
+        if blob is not None:
+            # Keep anything set before the record arrived
+            user_data.update({**decode_record(blob), **user_data})
+        # Only now: if the read failed, the next update tries again
+        self._active[user_id] = (time.monotonic(), user_data)
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        if user_id not in self._active:
+            # Their record never loaded; writing would overwrite it with a partial one
+            logger.debug("Not persisting user %s, whose record is not loaded", user_id)
+            return
+        self._dirty[user_id] = encode_record(data) if data else None
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicting:
+            self._evicting.discard(user_id)
+            if user_id in self._active:
+                # They came back before the drop was processed, and the
+                # application skipped their update in favour of it
+                await self.update_user_data(user_id, self._active[user_id][1])
+            return
+        self._active.pop(user_id, None)
+        self._dirty[user_id] = None
+        self._schedule_write()
+
+    def evict_idle(self, application: "Application") -> int:
+        """Drop users idle for ``idle_ttl`` seconds from ``application.user_data``, keeping their rows."""
+        cutoff = time.monotonic() - self.idle_ttl
+        evicted = 0
+        while self._active:
+            user_id, (seen_at, _) = next(iter(self._active.items()))
+            if seen_at > cutoff:
+                break
+            del self._active[user_id]
+            self._evicting.add(user_id)
+            application.drop_user_data(user_id)
+            evicted += 1
+        self.evicted += evicted
+        if evicted:
+            logger.debug("Evicted %d idle users from memory", evicted)
+        return evicted
+
+    def start_eviction(self, application: "Application") -> None:
+        """Run :meth:`evict_idle` in the background until :meth:`flush`; no-op without ``idle_ttl``."""
+        if self.idle_ttl > 0 and self._evict_task is None:
+            self._evict_task = asyncio.create_task(self._evict_forever(application))
+
+    async def _evict_forever(self, application: "Application") -> None:
+        while True:
+            await asyncio.sleep(max(self.idle_ttl / 4, self.update_interval))
+            self.evict_idle(application)
+
+    async def flush(self) -> None:
+        if self._evict_task is not None:
+            self._evict_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._evict_task
+            self._evict_task = None
+        if self._write_task is not None:
+            await self._write_task
+        if self._dirty:
+            changes, self._dirty = self._dirty, {}
+            await run_blocking(self._write, changes)
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
@@ -0,0 +1,113 @@
+"""Speculative per-user prefetching into short-lived slots.
+
+When the bot shows a menu it often knows what the next tap will need - the
+main menu is followed by "Join" often enough that its database lookups are
+worth starting before the tap arrives. :meth:`Prefetcher.start` launches the
+fetch in the background; the handler then takes the result with
+:meth:`Prefetcher.take`, awaiting it if it is still in flight, and falls
+back to fetching itself when there is nothing usable.
+
+Prefetches are best-effort: at most ``max_concurrent`` run at once (further
+ones are skipped rather than queued), results expire after ``ttl`` seconds,
+and :meth:`Prefetcher.discard` cancels a user's fetch once it can no longer
+be used or would be stale.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Prefetcher(Generic[T]):
+    """Background ``fetch(key)`` calls whose results are kept for ``ttl`` seconds."""
+
+    def __init__(self, fetch: Callable[[Hashable], Awaitable[T]], ttl: float, max_concurrent: int) -> None:
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_concurrent = max_concurrent
+        self.started = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.cancelled = 0
+        self.in_flight = 0
+        # key -> (expires_at, task), oldest first
+        self._slots: "OrderedDict[Hashable, Tuple[float, asyncio.Task]]" = OrderedDict()
+
+    def _expire(self, now: float) -> None:
+        while self._slots:
+            key, (expires_at, task) = next(iter(self._slots.items()))
+            if expires_at > now:
+                break
+            del self._slots[key]
+            if not task.done():
+                task.cancel()
+                self.cancelled += 1
+
+    def start(self, key: Hashable) -> None:
+        """Begin fetching ``key`` unless a fresh result is already there or too many fetches are running."""
+        now = time.monotonic()
+        self._expire(now)
+        if key in self._slots:
+            return
+        if self.in_flight >= self.max_concurrent:
+            self.skipped += 1
+            return
+        self.started += 1
+        self.in_flight += 1
+        task = asyncio.create_task(self.fetch(key))
+        task.add_done_callback(self._done)
+        self._slots[key] = (now + self.ttl, task)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self.in_flight -= 1
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("Prefetch failed: %r", task.exception())
+
+    async def take(self, key: Hashable) -> Optional[T]:
+        """Remove and return the prefetched result for ``key``; ``None`` if there is none or it failed."""
+        self._expire(time.monotonic())
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            self.misses += 1
+            return None
+        task = slot[1]
+        try:
+            # The caller may give up waiting without cancelling the fetch itself
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            self.misses += 1
+            return None
+        except Exception:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def discard(self, key: Hashable) -> None:
+        """Drop ``key``'s result, cancelling its fetch if it is still running."""
+        slot = self._slots.pop(key, None)
+        if slot is not None and not slot[1].done():
+            slot[1].cancel()
+            self.cancelled += 1
+
+    def cancel_all(self) -> None:
+        for key in list(self._slots):
+            self.discard(key)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "started": self.started,
+            "hits": self.hits,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "cancelled": self.cancelled,
+            "in_flight": self.in_flight,
+        }
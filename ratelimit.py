@@ -0,0 +1,200 @@
+"""Rate limiting for upstream calls.
+
+Two layers keep OpenAI usage inside quota when someone spams the bot:
+
+* :class:`UserRateLimiter` - a token bucket per ``telegram_id``, checked before
+  any work is done so an over-limit user gets an immediate "slow down" reply;
+* :class:`AdaptiveLimiter` - a global cap on in-flight completions that halves
+  itself and pauses on HTTP 429 (honouring ``Retry-After``) and grows back
+  additively while calls succeed.
+
+:class:`TokenBucket` paces outgoing calls to a fixed rate instead, for bulk
+sends such as broadcasts that should run as fast as the upstream allows.
+"""
+import asyncio
+import contextlib
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UserRateLimiter:
+    """Token bucket per user: ``rate`` requests/second with bursts of up to ``burst``.
+
+    At most ``max_users`` buckets are kept; the least recently seen user's
+    bucket is dropped first (a dropped bucket starts full again).
+    """
+
+    def __init__(self, rate: float, burst: int, max_users: int = 100_000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.rejected = 0
+        self._buckets: "OrderedDict[int, Tuple[float, float]]" = OrderedDict()
+
+    def allow(self, user_id: int) -> bool:
+        """Take a token from the user's bucket; return ``False`` if it is empty."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(user_id, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        else:
+            self.rejected += 1
+        self._buckets[user_id] = (tokens, now)
+        self._buckets.move_to_end(user_id)
+        while len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class TokenBucket:
+    """Paces callers to ``rate`` calls per second, allowing bursts of up to ``burst``.
+
+    :meth:`acquire` reserves the next free slot and sleeps until it is due, so
+    waiters go in arrival order without polling. :meth:`pause` holds every
+    caller back, including those already waiting, e.g. for a ``Retry-After``.
+    ``rate`` may be changed at any time.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        # Theoretical arrival time of the next call at exactly ``rate`` (GCRA)
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    def _reserve(self) -> float:
+        now = time.monotonic()
+        interval = 1 / self.rate
+        due = max(now, self._next - (self.burst - 1) * interval, self._paused_until)
+        self._next = max(self._next, due) + interval
+        return due - now
+
+    async def acquire(self) -> None:
+        """Wait until the caller may make its call."""
+        while True:
+            delay = self._reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # A pause that started while we slept voids the reservation
+            if time.monotonic() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float) -> None:
+        """Let no caller through for ``seconds``; the burst allowance is spent afterwards."""
+        until = time.monotonic() + seconds
+        self._paused_until = max(self._paused_until, until)
+        self._next = max(self._next, until + (self.burst - 1) / self.rate)
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Return the ``Retry-After`` delay of an HTTP error response, if it carries one."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        with contextlib.suppress(ValueError):
+            return float(headers["retry-after-ms"]) / 1000
+    with contextlib.suppress(TypeError, ValueError):
+        return float(headers.get("retry-after"))
+    return None
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for calls to a rate-limited upstream.
+
+    Callers wrap each upstream call in :meth:`slot` and report 429s through
+    :meth:`on_rate_limited`; successful calls are counted automatically.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, default_backoff: float = 1.0) -> None:
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.default_backoff = default_backoff
+        self.in_flight = 0
+        self.rate_limited = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of callers waiting for a slot."""
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "rate_limited": self.rate_limited,
+        }
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Wait for a free slot and hold it for the duration of the block."""
+        await self._acquire()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.in_flight -= 1
+            if not failed:
+                self._on_success()
+            self._wake()
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """Halve the limit and pause new calls for ``retry_after`` seconds."""
+        self.rate_limited += 1
+        self.limit = max(self.minimum, self.limit // 2)
+        self._successes = 0
+        delay = retry_after if retry_after is not None else self.default_backoff
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning("Upstream rate limited; limit now %d, pausing %.1fs", self.limit, delay)
+
+    def _on_success(self) -> None:
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+
+    async def _acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        woken = False
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            # Newcomers queue behind existing waiters; a woken waiter takes the free slot
+            if self.in_flight < self.limit and (woken or not self.queue_depth):
+                self.in_flight += 1
+                return
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # We were handed a wake-up we will not use; pass it on
+                    self._wake()
+                raise
+            woken = True
+
+    def _wake(self) -> None:
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
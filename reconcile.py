@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""Find (and optionally repair) users and selfies that lost their counterpart.
+
+A registered user should have exactly one ``users`` row and one object in
+the ``user_selfies`` bucket. Two kinds of drift happen in practice:
+
+* **missing selfie** - a ``users`` row without an object, e.g. after an
+  upload was lost; the bot then answers "registered but photo not found";
+* **orphan selfie** - an object without a ``users`` row, e.g. when the
+  selfie was stored but the insert that followed failed.
+
+The table and the bucket listing are paged concurrently, and every page is
+written straight into a scratch SQLite file, so memory use does not grow with
+the number of users. The two sets are then compared with ``EXCEPT`` and the
+differences are streamed back in chunks. With ``--repair``:
+
+* orphan selfies get their ``users`` row inserted (in batches);
+* missing selfies are re-uploaded from Telegram when this host still knows
+  the selfie's ``file_id``; the rest are only reported.
+
+Repairs run with at most ``--parallel`` requests in flight. Running bots
+may keep answering "not registered" to a repaired user for up to
+``REGISTRATION_CACHE_NEGATIVE_TTL`` seconds.
+
+    python reconcile.py                  # report only
+    python reconcile.py --repair --parallel 8
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Dict, Iterator, List, Optional, Set
+
+import settings
+from upstream import call_upstream, run_blocking
+from users import USERS_TABLE
+
+logger = logging.getLogger(__name__)
+
+# Bucket listing pages fetched at the same time (the listing is offset-based)
+LIST_PAGES_IN_FLIGHT = 4
+SAMPLE_SIZE = 10
+INSERT_BATCH = 500
+
+
+class IdSets:
+    """Two sets of ``telegram_id`` values in a scratch SQLite file, compared with ``EXCEPT``."""
+
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=OFF")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE user_ids (telegram_id INTEGER PRIMARY KEY)")
+        self._conn.execute("CREATE TABLE selfie_ids (telegram_id INTEGER PRIMARY KEY)")
+        self._lock = threading.Lock()
+
+    def add(self, table: str, ids: List[int]) -> None:
+        with self._lock:
+            self._conn.executemany(f"INSERT OR IGNORE INTO {table} (telegram_id) VALUES (?)", ((i,) for i in ids))
+            self._conn.commit()
+
+    def count(self, table: str) -> int:
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def difference(self, table: str, other: str, chunk: int) -> Iterator[List[int]]:
+        """Yield the ids in ``table`` but not in ``other``, ascending, ``chunk`` at a time."""
+        with self._lock:
+            cursor = self._conn.execute(
+                f"SELECT telegram_id FROM {table} EXCEPT SELECT telegram_id FROM {other} ORDER BY telegram_id"
+            )
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(chunk)
+            if not rows:
+                return
+            yield [row[0] for row in rows]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+async def page_users(supabase, ids: IdSets, page_size: int) -> None:
+    """Copy every ``telegram_id`` of the users table into ``ids``, one keyset page at a time."""
+
+    def fetch(after: Optional[int]):
+        # NULLs sort last and would end the keyset with gt.None
+        query = supabase.table(USERS_TABLE).select("telegram_id").not_.is_("telegram_id", "null")
+        if after is not None:
+            query = query.gt("telegram_id", after)
+        return query.order("telegram_id").limit(page_size).execute()
+
+    last = None
+    while True:
+        rows = (await call_upstream("supabase", "users.page", fetch, last)).data
+        if not rows:
+            return
+        last = rows[-1]["telegram_id"]
+        await run_blocking(ids.add, "user_ids", [row["telegram_id"] for row in rows])
+        if len(rows) < page_size:
+            return
+
+
+async def page_selfies(supabase, ids: IdSets, page_size: int) -> int:
+    """Copy the owner of every ``<telegram_id>.jpg`` object into ``ids``; return how many names did not parse."""
+    from selfies import BUCKET_NAME
+
+    bucket = supabase.storage.from_(BUCKET_NAME)
+    options = {"limit": page_size, "sortBy": {"column": "name", "order": "asc"}}
+    unparsed = 0
+    offset = 0
+    while True:
+        window = [
+            call_upstream("supabase_storage", "list", bucket.list, "", {**options, "offset": offset + i * page_size})
+            for i in range(LIST_PAGES_IN_FLIGHT)
+        ]
+        offset += LIST_PAGES_IN_FLIGHT * page_size
+        pages = await asyncio.gather(*window)
+        for page in pages:
+            owners = []
+            for entry in page:
+                stem, _, _ = entry["name"].partition(".")
+                if stem.isdigit():
+                    owners.append(int(stem))
+                else:
+                    unparsed += 1
+            await run_blocking(ids.add, "selfie_ids", owners)
+        if len(pages[-1]) < page_size:
+            return unparsed
+
+
+async def register_orphans(supabase, telegram_ids: List[int]) -> int:
+    """Insert ``users`` rows for owners of orphan selfies."""
+    rows = [{"telegram_id": telegram_id} for telegram_id in telegram_ids]
+    await call_upstream("supabase", "users.insert", supabase.table(USERS_TABLE).insert(rows).execute)
+    return len(rows)
+
+
+async def restore_selfie(bot, supabase, telegram_id: int) -> int:
+    """Re-upload a missing selfie from Telegram; 0 if its ``file_id`` is unknown on this host."""
+    import selfies
+
+    file_id = await selfies.file_ids.get(telegram_id)
+    if file_id is None:
+        return 0
+    # The local content hash still claims the object exists
+    await selfies.content_hashes.invalidate(telegram_id)
+    await selfies.store_from_telegram(bot, supabase, telegram_id, file_id)
+    return 1
+
+
+class Repairs:
+    """Runs repair coroutines with at most ``parallel`` in flight, summing their results by kind."""
+
+    def __init__(self, parallel: int) -> None:
+        self.parallel = parallel
+        self.done: Dict[str, int] = {"registered": 0, "restored": 0}
+        self.failures = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def submit(self, kind: str, coroutine: Awaitable[int]) -> None:
+        while len(self._tasks) >= self.parallel:
+            await asyncio.wait(set(self._tasks), return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.create_task(coroutine)
+        task.add_done_callback(functools.partial(self._collect, kind))
+        self._tasks.add(task)
+
+    def _collect(self, kind: str, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.failures += 1
+            logger.warning("Repair failed: %r", task.exception())
+            return
+        self.done[kind] += task.result()
+
+    async def wait(self) -> None:
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+
+async def _batches(chunks: Iterator[List[int]]) -> AsyncIterator[List[int]]:
+    """Advance a blocking chunk iterator on the upstream executor."""
+    while True:
+        batch = await run_blocking(next, chunks, None)
+        if batch is None:
+            return
+        yield batch
+
+
+async def _compare(ids: IdSets, supabase, repair: bool, parallel: int, chunk: int) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"orphan_selfies": 0, "missing_selfies": 0}
+    samples: Dict[str, List[int]] = {"orphan_selfies": [], "missing_selfies": []}
+    repairs = Repairs(parallel)
+    async with contextlib.AsyncExitStack() as stack:
+        bot = await stack.enter_async_context(_bot(parallel)) if repair else None
+
+        async for batch in _batches(ids.difference("selfie_ids", "user_ids", chunk)):
+            result["orphan_selfies"] += len(batch)
+            samples["orphan_selfies"].extend(batch[: SAMPLE_SIZE - len(samples["orphan_selfies"])])
+            if repair:
+                for start in range(0, len(batch), INSERT_BATCH):
+                    await repairs.submit("registered", register_orphans(supabase, batch[start:start + INSERT_BATCH]))
+
+        async for batch in _batches(ids.difference("user_ids", "selfie_ids", chunk)):
+            result["missing_selfies"] += len(batch)
+            samples["missing_selfies"].extend(batch[: SAMPLE_SIZE - len(samples["missing_selfies"])])
+            if repair:
+                for telegram_id in batch:
+                    await repairs.submit("restored", restore_selfie(bot, supabase, telegram_id))
+
+        await repairs.wait()
+    return {**result, **repairs.done, "repair_failures": repairs.failures, "samples": samples}
+
+
+async def reconcile(repair: bool, parallel: int, page_size: int, workdir: Optional[str] = None) -> Dict[str, Any]:
+    """Compare the users table with the selfie bucket, repair if asked, and return a summary."""
+    import clients
+
+    supabase = clients.get_supabase()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=workdir) as scratch:
+        ids = IdSets(os.path.join(scratch, "reconcile.db"))
+        try:
+            _, unparsed = await asyncio.gather(
+                page_users(supabase, ids, page_size),
+                page_selfies(supabase, ids, page_size),
+            )
+            summary: Dict[str, Any] = {
+                "users": await run_blocking(ids.count, "user_ids"),
+                "selfies": await run_blocking(ids.count, "selfie_ids"),
+                "unparsed_objects": unparsed,
+                "paged_s": time.perf_counter() - started,
+            }
+            logger.info("Paged %(users)d users and %(selfies)d selfies in %(paged_s).1fs", summary)
+            summary.update(await _compare(ids, supabase, repair, parallel, page_size))
+        finally:
+            ids.close()
+    summary["elapsed_s"] = time.perf_counter() - started
+    return summary
+
+
+def _bot(pool_size: int):
+    from telegram import Bot
+
+    from telegram_request import InstrumentedRequest
+
+    return Bot(
+        settings.TELEGRAM_BOT_TOKEN,
+        base_url=f"{settings.TELEGRAM_API_URL}/bot",
+        base_file_url=f"{settings.TELEGRAM_API_URL}/file/bot",
+        request=InstrumentedRequest(connection_pool_size=pool_size),
+    )
+
+
+def main() -> None:
+    import logsetup
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repair", action="store_true", help="insert missing rows and restore missing selfies")
+    parser.add_argument("--parallel", type=int, default=8, help="repair requests in flight")
+    parser.add_argument("--page-size", type=int, default=1000, help="rows or objects per page")
+    parser.add_argument("--workdir", help="directory for the scratch database (default: system temp)")
+    args = parser.parse_args()
+
+    logsetup.setup_logging(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_DEBUG_SAMPLE_RATE)
+    summary = asyncio.run(reconcile(args.repair, args.parallel, args.page_size, args.workdir))
+    print(
+        "{users} users, {selfies} selfies ({unparsed_objects} unrecognised objects) in {elapsed_s:.1f}s\n"
+        "orphan selfies (no users row):  {orphan_selfies}  e.g. {samples[orphan_selfies]}\n"
+        "missing selfies (no object):    {missing_selfies}  e.g. {samples[missing_selfies]}".format(**summary)
+    )
+    if args.repair:
+        print(
+            "repaired: {registered} users rows inserted, {restored} selfies restored, "
+            "{repair_failures} failures".format(**summary)
+        )
+        if summary["registered"]:
+            print(
+                f"running bots may show those users as unregistered for up to "
+                f"{settings.REGISTRATION_CACHE_NEGATIVE_TTL:g}s (cached lookups)"
+            )
+
+
+if __name__ == "__main__":
+    main()
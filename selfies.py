@@ -0,0 +1,195 @@
+"""Registration selfie helpers shared by both entry points.
+
+Once Telegram has seen a selfie it can be re-sent by ``file_id`` without
+Telegram fetching it from Supabase Storage again, so a persistent
+``telegram_id -> file_id`` map makes re-displaying a selfie a zero-transfer
+send; the entry is replaced whenever the user uploads a new one.
+
+New selfies go through :func:`ingest_selfie`: a resent identical image is
+recognised by content hash and skipped, larger images are optionally
+downscaled, and the object is written with a single upsert so the user is
+never left without a photo. Stored selfies are added to the perceptual-hash
+index in :mod:`face_index`, which flags near duplicates of other users'.
+"""
+import hashlib
+import io
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import settings
+from face_index import faces
+from upstream import call_upstream, run_blocking
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NAME = "user_selfies"
+
+
+def selfie_path(telegram_id: int) -> str:
+    """Return the storage path of a user's selfie."""
+    return f"{telegram_id}.jpg"
+
+
+class TelegramIdMap:
+    """Persistent ``telegram_id -> str`` map backed by a SQLite table.
+
+    The whole table is loaded into memory on first use; writes go through to
+    disk on the upstream executor.
+    """
+
+    def __init__(self, path: str, table: str, column: str) -> None:
+        self.path = path
+        self.table = table
+        self.column = column
+        self._conn: Optional[sqlite3.Connection] = None
+        self._values: Optional[Dict[int, str]] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                f"telegram_id INTEGER PRIMARY KEY, {self.column} TEXT NOT NULL)"
+            )
+        return self._conn
+
+    def _load(self) -> Dict[int, str]:
+        with self._lock:
+            rows = self._connect().execute(f"SELECT telegram_id, {self.column} FROM {self.table}").fetchall()
+        return dict(rows)
+
+    def _write(self, telegram_id: int, value: Optional[str]) -> None:
+        with self._lock:
+            conn = self._connect()
+            if value is None:
+                conn.execute(f"DELETE FROM {self.table} WHERE telegram_id = ?", (telegram_id,))
+            else:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.table} (telegram_id, {self.column}) VALUES (?, ?)",
+                    (telegram_id, value),
+                )
+            conn.commit()
+
+    async def _ensure_loaded(self) -> Dict[int, str]:
+        if self._values is None:
+            self._values = await run_blocking(self._load)
+            logger.info("Loaded %d %s rows from %s", len(self._values), self.table, self.path)
+        return self._values
+
+    async def get(self, telegram_id: int) -> Optional[str]:
+        return (await self._ensure_loaded()).get(telegram_id)
+
+    async def set(self, telegram_id: int, value: str) -> None:
+        values = await self._ensure_loaded()
+        if values.get(telegram_id) == value:
+            return
+        values[telegram_id] = value
+        await run_blocking(self._write, telegram_id, value)
+
+    async def invalidate(self, telegram_id: int) -> None:
+        values = await self._ensure_loaded()
+        if values.pop(telegram_id, None) is not None:
+            await run_blocking(self._write, telegram_id, None)
+
+
+file_ids = TelegramIdMap(settings.STATE_DB_PATH, "selfie_file_ids", "file_id")
+content_hashes = TelegramIdMap(settings.STATE_DB_PATH, "selfie_hashes", "sha256")
+
+
+def normalize_jpeg(content: bytes) -> bytes:
+    """Downscale ``content`` to ``SELFIE_MAX_SIDE`` pixels and re-encode it as JPEG.
+
+    Images already within bounds are returned untouched. Requires Pillow;
+    without it (or with ``SELFIE_MAX_SIDE=0``) the content is stored as sent.
+    """
+    if not settings.SELFIE_MAX_SIDE:
+        return content
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return content
+
+    image = Image.open(io.BytesIO(content))
+    if max(image.size) <= settings.SELFIE_MAX_SIDE:
+        return content
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((settings.SELFIE_MAX_SIDE, settings.SELFIE_MAX_SIDE))
+    out = io.BytesIO()
+    image.convert("RGB").save(out, "JPEG", quality=settings.SELFIE_JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+async def ingest_selfie(supabase, telegram_id: int, content: bytes, file_id: Optional[str] = None) -> bool:
+    """Store ``content`` as the user's selfie in one upsert.
+
+    Returns ``False`` without touching Storage when the same image is already
+    stored. ``file_id`` is the Telegram ``PhotoSize`` the content came from;
+    it replaces the cached one once the selfie is stored.
+    """
+    digest = hashlib.sha256(content).hexdigest()
+    if await content_hashes.get(telegram_id) == digest:
+        logger.info("Selfie for %s unchanged, skipping upload", telegram_id)
+        stored = False
+    else:
+        data = await run_blocking(normalize_jpeg, content)
+        await call_upstream(
+            "supabase_storage",
+            "upload",
+            supabase.storage.from_(BUCKET_NAME).upload,
+            path=selfie_path(telegram_id),
+            file=data,
+            file_options={"content-type": "image/jpeg", "upsert": "true"},
+        )
+        await content_hashes.set(telegram_id, digest)
+        logger.info("Stored selfie for %s (%d -> %d bytes)", telegram_id, len(content), len(data))
+        stored = True
+        try:
+            await faces.add(telegram_id, data)
+        except Exception:
+            # Duplicate detection is advisory; it must never fail an upload
+            logger.exception("Could not index selfie of %s", telegram_id)
+    if file_id is not None:
+        await file_ids.set(telegram_id, file_id)
+    return stored
+
+
+async def send_selfie(
+    send_photo: Callable[..., Awaitable[Any]],
+    supabase,
+    telegram_id: int,
+    file_id: Optional[str] = None,
+    **kwargs: Any,
+):
+    """Send a user's selfie, preferring the cached Telegram ``file_id``.
+
+    ``send_photo`` is ``bot.send_photo`` (bound to a chat) or
+    ``message.reply_photo``; pass ``file_id`` if it was already looked up.
+    When no usable ``file_id`` is known the public Storage URL is sent
+    instead and the ``file_id`` Telegram assigns to it is remembered for next
+    time.
+    """
+    if file_id is None:
+        file_id = await file_ids.get(telegram_id)
+    if file_id is not None:
+        try:
+            return await send_photo(photo=file_id, **kwargs)
+        except Exception as e:
+            logger.warning("Cached file_id for %s rejected, falling back to URL: %s", telegram_id, e)
+            await file_ids.invalidate(telegram_id)
+
+    photo_url = supabase.storage.from_(BUCKET_NAME).get_public_url(selfie_path(telegram_id))
+    # Cache-bust so Telegram does not serve a previously fetched selfie
+    message = await send_photo(photo=f"{photo_url}?v={int(time.time())}", **kwargs)
+    await file_ids.set(telegram_id, message.photo[-1].file_id)
+    return message
+
+
+async def store_from_telegram(bot, supabase, telegram_id: int, file_id: str) -> bool:
+    """Download the photo ``file_id`` from Telegram and ingest it as the user's selfie."""
+    photo_file = await bot.get_file(file_id)
+    content = await photo_file.download_as_bytearray()
+    return await ingest_selfie(supabase, telegram_id, bytes(content), file_id)
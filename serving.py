@@ -0,0 +1,101 @@
+"""How the bot receives updates: long polling or a local webhook server.
+
+``BOT_MODE=webhook`` starts an aiohttp server that accepts Telegram's POSTs,
+checks the secret token and feeds the updates into the same ``Application``
+(and therefore the same handlers) that polling would. It also serves a
+``/healthz`` endpoint for supervisors and load balancers, and ``/metrics``.
+"""
+import asyncio
+import contextlib
+import logging
+import signal
+from typing import Optional, Sequence
+
+from telegram import Update
+from telegram.ext import Application
+
+import metrics
+import settings
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def run(application: Application, allowed_updates: Optional[Sequence[str]] = None) -> None:
+    """Serve ``application`` in the mode selected by ``BOT_MODE``."""
+    if settings.BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application, allowed_updates))
+    elif settings.BOT_MODE == "polling":
+        application.run_polling(allowed_updates=allowed_updates)
+    else:
+        raise ValueError(f"Unknown BOT_MODE: {settings.BOT_MODE!r}")
+
+
+def build_webhook_app(application: Application):
+    """Return the aiohttp app that receives updates for ``application``."""
+    from aiohttp import web
+
+    secret = settings.WEBHOOK_SECRET
+
+    async def receive_update(request: web.Request) -> web.Response:
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (ValueError, TypeError, KeyError):
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "status": "ok" if application.running else "starting",
+                "update_queue": application.update_queue.qsize(),
+            },
+            status=200 if application.running else 503,
+        )
+
+    web_app = web.Application()
+    web_app.router.add_post(f"/{settings.WEBHOOK_PATH.strip('/')}", receive_update)
+    web_app.router.add_get("/healthz", health)
+    web_app.router.add_get("/metrics", metrics.scrape)
+    return web_app
+
+
+async def run_webhook(application: Application, allowed_updates: Optional[Sequence[str]] = None) -> None:
+    """Run ``application`` behind the local webhook server until SIGINT/SIGTERM."""
+    from aiohttp import web
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(build_webhook_app(application), access_log=None)
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        if settings.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{settings.WEBHOOK_URL.rstrip('/')}/{settings.WEBHOOK_PATH.strip('/')}",
+                secret_token=settings.WEBHOOK_SECRET or None,
+                max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=allowed_updates,
+            )
+        await application.start()
+        await runner.setup()
+        site = web.TCPSite(runner, settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT)
+        await site.start()
+        logger.info("Webhook server listening on %s:%d", settings.WEBHOOK_LISTEN, settings.WEBHOOK_PORT)
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
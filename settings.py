@@ -0,0 +1,142 @@
+"""Runtime tunables shared by both bot entry points.
+
+Values come from the environment (or a local ``.env`` file) so deployments can
+tune them without code changes.
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def _float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def _bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# Credentials and endpoints. The base URLs default to the real services;
+# bench/fake_services.py stands in for all three during offline load tests.
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+SUPABASE_URL = os.getenv("SUPABASE_URL", "")
+SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY", "")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# Upstream I/O
+UPSTREAM_MAX_WORKERS = _int("UPSTREAM_MAX_WORKERS", 32)
+
+# Update processing
+CONCURRENT_UPDATES = _int("CONCURRENT_UPDATES", 256)
+MAX_QUEUED_UPDATES_PER_USER = _int("MAX_QUEUED_UPDATES_PER_USER", 8)
+# Serialize updates per "user" or per "chat"
+UPDATE_ORDERING_KEY = os.getenv("UPDATE_ORDERING_KEY", "user")
+
+# Registration-status cache
+REGISTRATION_CACHE_SIZE = _int("REGISTRATION_CACHE_SIZE", 100_000)
+REGISTRATION_CACHE_TTL = _int("REGISTRATION_CACHE_TTL", 3600)
+# "Not registered" can be made stale by another process inserting the row
+REGISTRATION_CACHE_NEGATIVE_TTL = _int("REGISTRATION_CACHE_NEGATIVE_TTL", 60)
+
+# Speculative prefetch of the "Join" screen's data when the main menu is shown
+PREFETCH_TTL = _float("PREFETCH_TTL", 30.0)
+PREFETCH_MAX_CONCURRENT = _int("PREFETCH_MAX_CONCURRENT", 64)
+
+# Local state (selfie jobs, file_ids, user_data and other small persistent
+# maps). file_ids only work with the bot that received them, so by default
+# every bot gets its own file and two bots run from one directory never
+# drain or recover each other's jobs.
+_BOT_ID = TELEGRAM_BOT_TOKEN.partition(":")[0]
+STATE_DB_PATH = os.getenv("STATE_DB_PATH") or (f"bot_state.{_BOT_ID}.sqlite3" if _BOT_ID else "bot_state.sqlite3")
+# State every process may share (the AI answer cache); defaults to STATE_DB_PATH
+SHARED_STATE_DB_PATH = os.getenv("SHARED_STATE_DB_PATH") or STATE_DB_PATH
+
+# Streamed AI replies
+AI_STREAMING = _bool("AI_STREAMING", True)
+STREAM_EDIT_INTERVAL = _float("STREAM_EDIT_INTERVAL", 1.0)
+STREAM_EDIT_MIN_CHARS = _int("STREAM_EDIT_MIN_CHARS", 20)
+
+# AI answer cache
+ANSWER_CACHE_SIZE = _int("ANSWER_CACHE_SIZE", 2048)
+ANSWER_CACHE_TTL = _int("ANSWER_CACHE_TTL", 7 * 24 * 3600)
+ANSWER_CACHE_PERSIST = _bool("ANSWER_CACHE_PERSIST", True)
+
+# Local answers from the knowledge base: minimum similarity of the best
+# section and its lead over the next one (a threshold above 1 disables it)
+INTENT_ROUTER_THRESHOLD = _float("INTENT_ROUTER_THRESHOLD", 0.5)
+INTENT_ROUTER_MARGIN = _float("INTENT_ROUTER_MARGIN", 0.1)
+
+# AI conversation memory
+CHAT_HISTORY_TOKEN_BUDGET = _int("CHAT_HISTORY_TOKEN_BUDGET", 1200)
+CHAT_HISTORY_MAX_TURNS = _int("CHAT_HISTORY_MAX_TURNS", 8)
+CHAT_HISTORY_MAX_USERS = _int("CHAT_HISTORY_MAX_USERS", 10_000)
+
+# Serving mode: "polling" or "webhook" (cluster.py runs workers in webhook mode)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = _int("WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Public URL Telegram should POST to; leave empty to skip set_webhook (e.g. behind a fake Telegram)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = _int("WEBHOOK_MAX_CONNECTIONS", 40)
+
+# Selfie ingestion (downscaling needs Pillow; 0 disables it)
+SELFIE_MAX_SIDE = _int("SELFIE_MAX_SIDE", 1280)
+SELFIE_JPEG_QUALITY = _int("SELFIE_JPEG_QUALITY", 85)
+# Selfies whose perceptual hashes differ in at most this many of 64 bits are flagged as duplicates
+SELFIE_DUPLICATE_RADIUS = _int("SELFIE_DUPLICATE_RADIUS", 6)
+
+# Background job queue (selfie upload + registration)
+JOB_WORKERS = _int("JOB_WORKERS", 4)
+JOB_MAX_ATTEMPTS = _int("JOB_MAX_ATTEMPTS", 5)
+JOB_MAX_PENDING = _int("JOB_MAX_PENDING", 1000)
+JOB_RETRY_DELAY = _float("JOB_RETRY_DELAY", 2.0)
+
+# Coalesced writes to the users table
+USERS_BATCH_MAX_ROWS = _int("USERS_BATCH_MAX_ROWS", 100)
+USERS_BATCH_MAX_DELAY = _float("USERS_BATCH_MAX_DELAY", 0.02)
+
+# Broadcasts (broadcast.py): Telegram allows about 30 messages/s per bot and 1/s per chat
+BROADCAST_RATE = _float("BROADCAST_RATE", 28.0)
+BROADCAST_CHAT_INTERVAL = _float("BROADCAST_CHAT_INTERVAL", 1.0)
+BROADCAST_CONCURRENCY = _int("BROADCAST_CONCURRENCY", 16)
+BROADCAST_PAGE_SIZE = _int("BROADCAST_PAGE_SIZE", 1000)
+
+# Per-user state persistence (write-behind interval in seconds)
+PERSISTENCE_UPDATE_INTERVAL = _float("PERSISTENCE_UPDATE_INTERVAL", 5)
+# Users idle this long are dropped from memory (their record stays); 0 keeps everyone
+USER_DATA_IDLE_TTL = _float("USER_DATA_IDLE_TTL", 3600)
+
+# OpenAI rate limiting
+AI_USER_RATE = _float("AI_USER_RATE", 0.2)  # sustained AI requests per second per user
+AI_USER_BURST = _int("AI_USER_BURST", 5)
+OPENAI_MAX_CONCURRENCY = _int("OPENAI_MAX_CONCURRENCY", 16)
+
+# Metrics (/metrics is also served by the webhook server); 0 disables the standalone endpoint
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = _int("METRICS_PORT", 9100)
+
+# Bot API connection pool
+TELEGRAM_POOL_SIZE = _int("TELEGRAM_POOL_SIZE", 256)
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_DEBUG_SAMPLE_RATE = _float("LOG_DEBUG_SAMPLE_RATE", 0.1)
+
+# Multi-process mode (cluster.py): one webhook ingress and N worker processes
+CLUSTER_WORKERS = _int("CLUSTER_WORKERS", os.cpu_count() or 1)
+CLUSTER_WORKER_BASE_PORT = _int("CLUSTER_WORKER_BASE_PORT", 9500)
+CLUSTER_VIRTUAL_NODES = _int("CLUSTER_VIRTUAL_NODES", 128)
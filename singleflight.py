@@ -0,0 +1,47 @@
+"""Collapse identical concurrent upstream requests into one.
+
+When several callers ask for the same thing at once (a user double-tapping
+"Join", or many users asking the same question), only the first actually
+calls upstream; the rest await the same in-flight result.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Group of in-flight calls keyed by request identity."""
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.collapsed = 0
+        self._in_flight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """Return ``func()``'s result and whether it was shared with an earlier caller.
+
+        Only the first caller for ``key`` runs ``func``; callers arriving while
+        it is in flight get the same result (or exception). Cancelling one
+        caller does not cancel the shared call.
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.collapsed += 1
+            return await asyncio.shield(future), True
+
+        self.calls += 1
+        future = asyncio.ensure_future(func())
+        self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(future), False
+
+    def _forget(self, key: Hashable, future: "asyncio.Future[Any]") -> None:
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved even if every caller went away
+            future.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {"calls": self.calls, "collapsed": self.collapsed, "in_flight": len(self._in_flight)}
@@ -0,0 +1,151 @@
+"""Progressive delivery of streamed AI replies.
+
+Instead of waiting for the whole completion, :func:`stream_reply` sends a
+placeholder straight away, keeps a typing indicator up until the first token
+arrives and then edits the placeholder as text streams in. Edits are throttled
+so a chat stays well inside Telegram's edit rate limits.
+"""
+import asyncio
+import contextlib
+import datetime
+import logging
+import time
+from typing import TYPE_CHECKING, AsyncIterator
+
+import settings
+
+if TYPE_CHECKING:
+    from telegram import Message
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER = "…"
+# Telegram shows a chat action for about five seconds
+TYPING_REFRESH = 4.0
+# Tries for the final edit, waiting out Telegram's retry_after in between
+FINAL_EDIT_ATTEMPTS = 3
+_END = object()
+
+
+async def openai_text_stream(openai_client, **kwargs) -> AsyncIterator[str]:
+    """Yield content deltas of a streamed chat completion.
+
+    The request is only issued when iteration starts, so callers can show the
+    placeholder before waiting on OpenAI.
+    """
+    stream = await openai_client.chat.completions.create(stream=True, **kwargs)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def buffered(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Yield from ``chunks``, reading it ahead in a background task.
+
+    The source is drained as fast as it produces rather than at the pace of
+    Telegram edits, so anything it holds open (an upstream request, a rate
+    limiter slot) is released as soon as the text is complete.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async for delta in chunks:
+                queue.put_nowait(delta)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(_END)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+async def _keep_typing(message: "Message") -> None:
+    from telegram.constants import ChatAction
+
+    while True:
+        with contextlib.suppress(Exception):
+            await message.reply_chat_action(ChatAction.TYPING)
+        await asyncio.sleep(TYPING_REFRESH)
+
+
+async def _edit(placeholder: "Message", text: str, attempts: int = 1) -> bool:
+    """Show ``text`` in ``placeholder``; ``False`` if Telegram throttled every attempt."""
+    from telegram.error import BadRequest, RetryAfter
+
+    for attempt in range(1, attempts + 1):
+        try:
+            await placeholder.edit_text(text)
+            return True
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.debug("Edit throttled by Telegram for %ss (attempt %d/%d)", retry_after, attempt, attempts)
+            if attempt < attempts:
+                await asyncio.sleep(retry_after)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+            return True
+    return False
+
+
+async def stream_reply(message: "Message", chunks: AsyncIterator[str]) -> str:
+    """Reply to ``message`` with the text produced by ``chunks`` and return it.
+
+    If the stream fails before any text is shown the placeholder is deleted
+    and the error re-raised, so the caller can send its usual error reply.
+    """
+    from telegram.constants import MessageLimit
+
+    typing = asyncio.create_task(_keep_typing(message))
+    placeholder = None
+    text = ""
+    shown = ""
+    last_edit = 0.0
+    try:
+        placeholder = await message.reply_text(PLACEHOLDER)
+        async for delta in chunks:
+            if not text:
+                typing.cancel()
+            text += delta
+            now = time.monotonic()
+            if (
+                now - last_edit >= settings.STREAM_EDIT_INTERVAL
+                and len(text) - len(shown) >= settings.STREAM_EDIT_MIN_CHARS
+                and len(text) <= MessageLimit.MAX_TEXT_LENGTH
+            ):
+                # A throttled edit is skipped; a later one (or the final one) catches up
+                if await _edit(placeholder, text):
+                    shown = text
+                last_edit = now
+    except Exception:
+        if placeholder is not None and not shown:
+            with contextlib.suppress(Exception):
+                await placeholder.delete()
+        raise
+    finally:
+        typing.cancel()
+
+    if not text:
+        with contextlib.suppress(Exception):
+            await placeholder.delete()
+        raise ValueError("AI stream produced no text")
+
+    limit = MessageLimit.MAX_TEXT_LENGTH
+    if text != shown and not await _edit(placeholder, text[:limit], attempts=FINAL_EDIT_ATTEMPTS):
+        raise RuntimeError("Telegram kept throttling the final edit of a streamed reply")
+    for start in range(limit, len(text), limit):
+        await message.reply_text(text[start:start + limit])
+    return text
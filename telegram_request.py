@@ -0,0 +1,14 @@
+"""Bot API request backend that records per-method latency."""
+from telegram.request import HTTPXRequest
+
+import metrics
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """:class:`~telegram.request.HTTPXRequest` that times every Bot API call by method."""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        # File downloads carry the file path in the URL; keep label cardinality bounded
+        operation = "file_download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        with metrics.track_upstream("telegram", operation):
+            return await super().do_request(url, method, request_data, *args, **kwargs)
@@ -0,0 +1,34 @@
+import asyncio
+import sqlite3
+
+from answer_cache import AnswerCache
+
+
+def test_disk_tier_keeps_the_newest_unpinned_answers_and_all_pinned(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+
+    async def scenario():
+        cache = AnswerCache("capped", "v1", maxsize=3, ttl=3600, path=path)
+        await cache.set("pinned question", "kept", pinned=True)
+        for i in range(6):
+            await cache.set(f"question {i}", f"answer {i}")
+
+    asyncio.run(scenario())
+    rows = sqlite3.connect(path).execute("SELECT question FROM answer_cache ORDER BY question").fetchall()
+    assert [question for question, in rows] == ["pinned question", "question 3", "question 4", "question 5"]
+
+
+def test_cap_applies_per_namespace(tmp_path):
+    path = str(tmp_path / "answers.sqlite3")
+
+    async def scenario():
+        first = AnswerCache("first", "v1", maxsize=2, ttl=3600, path=path)
+        second = AnswerCache("second", "v1", maxsize=2, ttl=3600, path=path)
+        for i in range(2):
+            await first.set(f"question {i}", "a")
+        for i in range(4):
+            await second.set(f"question {i}", "b")
+
+    asyncio.run(scenario())
+    rows = sqlite3.connect(path).execute("SELECT namespace, COUNT(*) FROM answer_cache GROUP BY namespace").fetchall()
+    assert dict(rows) == {"first": 2, "second": 2}
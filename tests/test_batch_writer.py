@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+from batch_writer import BatchWriter
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+    def execute(self):
+        self.table.requests.append(len(self.rows))
+        if any(row.get("bad") for row in self.rows):
+            raise ValueError("violates constraint")
+        return FakeResponse([{**row, "id": row["telegram_id"] * 10} for row in self.rows])
+
+
+class FakeTable:
+    def __init__(self):
+        self.requests = []
+
+    def insert(self, rows):
+        return FakeQuery(self, rows)
+
+    def upsert(self, rows, on_conflict):
+        return FakeQuery(self, rows)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.users = FakeTable()
+
+    def table(self, name):
+        return self.users
+
+
+def test_concurrent_inserts_become_one_request_with_per_caller_rows():
+    async def scenario():
+        supabase = FakeSupabase()
+        writer = BatchWriter(supabase, "batch_test_users", max_rows=100, max_delay=0.01)
+        rows = await asyncio.gather(*(writer.insert({"telegram_id": i}) for i in range(1, 6)))
+        return supabase.users.requests, rows
+
+    requests, rows = asyncio.run(scenario())
+    assert requests == [5]
+    assert [row["id"] for row in rows] == [10, 20, 30, 40, 50]
+
+
+def test_max_rows_flushes_without_waiting_for_the_delay():
+    async def scenario():
+        supabase = FakeSupabase()
+        writer = BatchWriter(supabase, "batch_test_full", max_rows=3, max_delay=60)
+        await asyncio.wait_for(asyncio.gather(*(writer.insert({"telegram_id": i}) for i in range(1, 7))), 5)
+        return supabase.users.requests
+
+    assert asyncio.run(scenario()) == [3, 3]
+
+
+def test_failed_batch_is_split_so_only_the_bad_row_fails():
+    async def scenario():
+        supabase = FakeSupabase()
+        writer = BatchWriter(supabase, "batch_test_split", max_rows=100, max_delay=0.01)
+        rows = [{"telegram_id": i, "bad": i == 3} for i in range(1, 9)]
+        results = await asyncio.gather(*(writer.insert(row) for row in rows), return_exceptions=True)
+        return writer, results
+
+    writer, results = asyncio.run(scenario())
+    assert isinstance(results[2], ValueError)
+    assert [result["id"] for i, result in enumerate(results) if i != 2] == [10, 20, 40, 50, 60, 70, 80]
+    assert writer.stats.fallbacks >= 1
+
+
+def test_single_row_failure_is_raised_to_its_caller():
+    async def scenario():
+        writer = BatchWriter(FakeSupabase(), "batch_test_single", max_delay=0.01)
+        await writer.upsert({"telegram_id": 1, "bad": True}, on_conflict="telegram_id")
+
+    with pytest.raises(ValueError):
+        asyncio.run(scenario())
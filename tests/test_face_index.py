@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from face_index import HASH_BITS, HashIndex, hamming
+
+
+def flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+@pytest.fixture
+def hashes():
+    rng = random.Random(7)
+    return {key: rng.getrandbits(HASH_BITS) for key in range(2000)}
+
+
+@pytest.fixture
+def index(hashes):
+    index = HashIndex()
+    for key, value in hashes.items():
+        index.add(key, value)
+    return index
+
+
+@pytest.mark.parametrize("radius", [0, 3, 6, 10])
+def test_search_matches_a_linear_scan(index, hashes, radius):
+    rng = random.Random(radius)
+    for key in rng.sample(sorted(hashes), 50):
+        # Near-duplicates of a stored hash, with the flipped bits spread over every chunk
+        query = flip(hashes[key], rng.sample(range(HASH_BITS), rng.randint(0, radius)))
+        expected = sorted((k, hamming(v, query)) for k, v in hashes.items() if hamming(v, query) <= radius)
+        assert sorted(index.search(query, radius)) == expected
+
+
+def test_search_finds_hashes_exactly_at_the_radius_only(index, hashes):
+    # Six flipped bits, at most two in any 16-bit chunk
+    query = flip(hashes[0], [0, 1, 16, 17, 32, 48])
+    assert (0, 6) in index.search(query, 6)
+    assert all(key != 0 for key, _ in index.search(query, 5))
+
+
+def test_results_are_nearest_first(index, hashes):
+    index.add(9001, flip(hashes[0], [3]))
+    index.add(9002, flip(hashes[0], [3, 20, 40]))
+    distances = [distance for _, distance in index.search(hashes[0], 6)]
+    assert distances == sorted(distances)
+    assert distances[:3] == [0, 1, 3]
+
+
+def test_add_replaces_and_remove_forgets(index, hashes):
+    index.add(0, hashes[1])
+    assert {key for key, _ in index.search(hashes[1], 0)} == {0, 1}
+    index.remove(0)
+    index.remove(0)
+    assert [key for key, _ in index.search(hashes[1], 0)] == [1]
+    assert len(index) == len(hashes) - 1
@@ -0,0 +1,47 @@
+import pytest
+
+from intent_router import IntentRouter, tokenize
+
+SECTIONS = {
+    "what_is": (
+        "What is BitID?\n"
+        "• BitID is a digital identity based on the biometrics of a person's face\n"
+        "• One person can have only one BitID"
+    ),
+    "fraud": (
+        "Fraud prevention\n"
+        "• Banks use BitID to stop account takeover and fake signups\n"
+        "• Duplicate faces are flagged before an account is opened"
+    ),
+}
+
+
+@pytest.fixture
+def router():
+    return IntentRouter(SECTIONS, threshold=0.5, margin=0.1)
+
+
+def test_tokenize_drops_stop_words_and_stems():
+    assert tokenize("What are the banks for?") == ["bank"]
+    assert tokenize("Who registered users") == tokenize("register user")
+
+
+def test_routes_a_question_about_one_section(router):
+    assert router.route("What is BitID?") == "what_is"
+    assert router.answer("How do banks prevent fraud?") == SECTIONS["fraud"]
+
+
+@pytest.mark.parametrize("question", ["What's the weather in Paris tomorrow?", "", "hello", "lol 123"])
+def test_abstains_on_off_topic_input(router, question):
+    assert router.route(question) is None
+
+
+def test_abstains_when_two_sections_score_alike():
+    router = IntentRouter({"a": "Face\n• face identity", "b": "Face\n• face identity"})
+    assert router.route("face identity") is None
+
+
+def test_stats_count_local_answers(router):
+    router.route("What is BitID?")
+    router.route("What's the weather in Paris tomorrow?")
+    assert router.stats() == {"questions": 2, "answered_locally": 1, "local_fraction": 0.5}
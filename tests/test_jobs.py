@@ -0,0 +1,71 @@
+import asyncio
+
+from jobs import DurableQueue
+
+
+def run_queue(tmp_path, name, payloads, handler, **kwargs):
+    async def scenario():
+        done = asyncio.Event()
+        finished = []
+
+        async def record(bot, payload):
+            await handler(payload)
+            finished.append(payload["n"])
+            if len(finished) == len(payloads):
+                done.set()
+
+        queue = DurableQueue(str(tmp_path / "jobs.sqlite3"), name, record, workers=4, retry_delay=0.01, **kwargs)
+        for payload in payloads:
+            await queue.enqueue(payload)
+        await queue.start(bot=None)
+        try:
+            await asyncio.wait_for(done.wait(), 5)
+        finally:
+            await queue.stop()
+
+    asyncio.run(scenario())
+
+
+def test_jobs_of_one_user_run_one_at_a_time_in_order(tmp_path):
+    running = set()
+    started = []
+
+    async def handler(payload):
+        assert payload["telegram_id"] not in running
+        running.add(payload["telegram_id"])
+        started.append(payload["n"])
+        await asyncio.sleep(0.02)
+        running.discard(payload["telegram_id"])
+
+    payloads = [{"telegram_id": 1, "n": 0}, {"telegram_id": 1, "n": 1}, {"telegram_id": 2, "n": 2}]
+    run_queue(tmp_path, "jobs_test_order", payloads, handler)
+    # The other user's job does not wait behind the first user's
+    assert started == [0, 2, 1]
+
+
+def test_later_job_waits_for_the_retry_of_an_earlier_one(tmp_path):
+    attempts = []
+
+    async def handler(payload):
+        attempts.append(payload["n"])
+        if attempts.count(0) == 1 and payload["n"] == 0:
+            raise ValueError("transient")
+
+    payloads = [{"telegram_id": 1, "n": 0}, {"telegram_id": 1, "n": 1}]
+    run_queue(tmp_path, "jobs_test_retry", payloads, handler)
+    assert attempts == [0, 0, 1]
+
+
+def test_jobs_without_a_key_run_concurrently(tmp_path):
+    running = []
+    peak = []
+
+    async def handler(payload):
+        running.append(payload["n"])
+        peak.append(len(running))
+        await asyncio.sleep(0.02)
+        running.remove(payload["n"])
+
+    payloads = [{"telegram_id": 1, "n": n} for n in range(3)]
+    run_queue(tmp_path, "jobs_test_unkeyed", payloads, handler, key=None)
+    assert max(peak) == 3
@@ -0,0 +1,90 @@
+import asyncio
+
+from prefetch import Prefetcher
+
+
+def test_take_returns_the_prefetched_result_once():
+    async def scenario():
+        prefetcher = Prefetcher(lambda key: asyncio.sleep(0.01, result=key * 2), ttl=10, max_concurrent=4)
+        prefetcher.start(21)
+        return await prefetcher.take(21), await prefetcher.take(21), prefetcher.stats()
+
+    first, second, stats = asyncio.run(scenario())
+    assert (first, second) == (42, None)
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_starts_beyond_max_concurrent_are_skipped():
+    async def scenario():
+        release = asyncio.Event()
+        fetched = []
+
+        async def fetch(key):
+            fetched.append(key)
+            await release.wait()
+            return key
+
+        prefetcher = Prefetcher(fetch, ttl=10, max_concurrent=2)
+        for key in (1, 2, 3):
+            prefetcher.start(key)
+        await asyncio.sleep(0)
+        in_flight = prefetcher.in_flight
+        release.set()
+        results = [await prefetcher.take(key) for key in (1, 2, 3)]
+        return fetched, in_flight, results, prefetcher.stats()
+
+    fetched, in_flight, results, stats = asyncio.run(scenario())
+    assert fetched == [1, 2]
+    assert in_flight == 2
+    assert results == [1, 2, None]
+    assert stats["skipped"] == 1 and stats["in_flight"] == 0
+
+
+def test_starting_a_fresh_key_again_does_not_refetch():
+    async def scenario():
+        calls = 0
+
+        async def fetch(key):
+            nonlocal calls
+            calls += 1
+            return key
+
+        prefetcher = Prefetcher(fetch, ttl=10, max_concurrent=4)
+        prefetcher.start(1)
+        prefetcher.start(1)
+        await prefetcher.take(1)
+        return calls
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_expired_results_are_dropped_and_their_fetch_cancelled():
+    async def scenario():
+        prefetcher = Prefetcher(lambda key: asyncio.sleep(10, result=key), ttl=0.01, max_concurrent=4)
+        prefetcher.start(1)
+        await asyncio.sleep(0.05)
+        result = await prefetcher.take(1)
+        await asyncio.sleep(0.01)
+        return result, prefetcher.stats()
+
+    result, stats = asyncio.run(scenario())
+    assert result is None
+    assert stats["cancelled"] == 1 and stats["in_flight"] == 0
+
+
+def test_failed_or_discarded_fetches_read_as_misses():
+    async def scenario():
+        async def fetch(key):
+            if key == "bad":
+                raise RuntimeError("lookup failed")
+            await asyncio.sleep(10)
+
+        prefetcher = Prefetcher(fetch, ttl=10, max_concurrent=4)
+        prefetcher.start("bad")
+        prefetcher.start("slow")
+        prefetcher.discard("slow")
+        return await prefetcher.take("bad"), await prefetcher.take("slow"), prefetcher.stats()
+
+    failed, discarded, stats = asyncio.run(scenario())
+    assert failed is None and discarded is None
+    assert stats["cancelled"] == 1 and stats["misses"] == 2
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from ratelimit import AdaptiveLimiter, TokenBucket, UserRateLimiter
+
+
+def test_rate_limited_halves_the_limit_and_pauses_new_calls():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=8, maximum=8)
+        limiter.on_rate_limited(retry_after=0.2)
+        assert limiter.limit == 4
+        assert limiter.rate_limited == 1
+        started = time.monotonic()
+        async with limiter.slot():
+            pass
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.2
+
+
+def test_limit_never_drops_below_minimum():
+    limiter = AdaptiveLimiter(initial=2, minimum=1, default_backoff=0)
+    for _ in range(5):
+        limiter.on_rate_limited()
+    assert limiter.limit == 1
+
+
+def test_limit_grows_back_by_one_per_window_of_successes():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=8, maximum=8)
+        limiter.on_rate_limited(retry_after=0)
+        for _ in range(4):
+            async with limiter.slot():
+                pass
+        grown = limiter.limit
+        for _ in range(100):
+            async with limiter.slot():
+                pass
+        return grown, limiter.limit
+
+    assert asyncio.run(scenario()) == (5, 8)
+
+
+def test_failed_calls_do_not_grow_the_limit():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=2, maximum=8)
+        for _ in range(10):
+            try:
+                async with limiter.slot():
+                    raise RuntimeError("upstream error")
+            except RuntimeError:
+                pass
+        return limiter.limit
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_in_flight_calls_never_exceed_the_limit():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=3, maximum=3)
+        peak = 0
+
+        async def call():
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(call() for _ in range(20)))
+        return peak, limiter.in_flight
+
+    assert asyncio.run(scenario()) == (3, 0)
+
+
+def test_user_rate_limiter_rejects_beyond_burst():
+    limiter = UserRateLimiter(rate=0.001, burst=3)
+    assert [limiter.allow(1) for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow(2)
+    assert limiter.rejected == 1
+
+
+def test_token_bucket_paces_callers():
+    async def scenario():
+        bucket = TokenBucket(rate=50)
+        started = time.monotonic()
+        for _ in range(11):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.19
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(flights.do("key", fetch) for _ in range(5)))
+        return calls, results, flights.stats()
+
+    calls, results, stats = asyncio.run(scenario())
+    assert calls == 1
+    assert [value for value, _ in results] == ["value"] * 5
+    assert [shared for _, shared in results] == [False, True, True, True, True]
+    assert stats == {"calls": 1, "collapsed": 4, "in_flight": 0}
+
+
+def test_error_reaches_every_caller_and_is_not_cached():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fail():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream failed")
+
+        results = await asyncio.gather(*(flights.do("key", fail) for _ in range(3)), return_exceptions=True)
+        # The failure is forgotten: the next caller runs the call again
+        with pytest.raises(ValueError):
+            await flights.do("key", fail)
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert calls == 2
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_cancelling_one_caller_keeps_the_shared_call_running():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.02)
+            return "value"
+
+        first = asyncio.ensure_future(flights.do("key", fetch))
+        second = asyncio.ensure_future(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == ("value", True)
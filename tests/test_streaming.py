@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from streaming import buffered
+
+
+def test_buffered_drains_the_source_ahead_of_a_slow_consumer():
+    async def scenario():
+        source_done = asyncio.Event()
+
+        async def source():
+            for delta in ("a", "b", "c"):
+                yield delta
+            source_done.set()
+
+        received = []
+        async for delta in buffered(source()):
+            if not received:
+                # The whole source is read while the consumer is still on its first delta
+                await asyncio.wait_for(source_done.wait(), 1)
+            received.append(delta)
+        return received
+
+    assert asyncio.run(scenario()) == ["a", "b", "c"]
+
+
+def test_buffered_reraises_source_errors_after_earlier_deltas():
+    async def scenario():
+        async def source():
+            yield "a"
+            raise ValueError("stream broke")
+
+        received = []
+        with pytest.raises(ValueError):
+            async for delta in buffered(source()):
+                received.append(delta)
+        return received
+
+    assert asyncio.run(scenario()) == ["a"]
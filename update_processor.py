@@ -0,0 +1,106 @@
+"""Update processor that is concurrent across users but ordered per user.
+
+Handlers keep per-user state in ``context.user_data`` (``awaiting_selfie_*``,
+``photo_message_id``, ``greeted``) and read, modify and ``clear()`` it across
+awaits. Running two updates of the same user at once would race on that
+state, so :class:`PerUserUpdateProcessor` serializes updates that share a key
+(the user, or the chat) while updates with different keys run in parallel up
+to the global cap.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import logsetup
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Run updates of different users concurrently and updates of one user in order.
+
+    ``max_concurrent_updates`` caps updates being handled at once across all
+    users; ``max_queued_per_key`` caps how many updates of a single user (or
+    chat) may be running or waiting, beyond which new ones are dropped.
+    Waiting for one's turn does not occupy a global slot.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_queued_per_key: int, key_by: str = "user") -> None:
+        super().__init__(max_concurrent_updates)
+        if key_by not in ("user", "chat"):
+            raise ValueError(f"key_by must be 'user' or 'chat', not {key_by!r}")
+        self.max_queued_per_key = max_queued_per_key
+        self.key_by = key_by
+        self.dropped = 0
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._depth: Dict[Hashable, int] = {}
+        metrics.register_collector(
+            "bot_update_processor",
+            lambda: {
+                "in_progress": self.current_concurrent_updates,
+                "queued_keys": self.queued_keys,
+                "dropped": self.dropped,
+            },
+        )
+
+    def update_key(self, update: object) -> Optional[Hashable]:
+        """Return the key updates are serialized on, or ``None`` for unordered updates."""
+        if not isinstance(update, Update):
+            return None
+        if self.key_by == "user" and update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        return None
+
+    @property
+    def queued_keys(self) -> int:
+        """Number of users (or chats) with updates running or waiting."""
+        return len(self._depth)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.update_key(update)
+        if key is None:
+            await super().process_update(update, self._timed(update, coroutine, time.perf_counter()))
+            return
+
+        depth = self._depth.get(key, 0)
+        if depth >= self.max_queued_per_key:
+            self.dropped += 1
+            coroutine.close()
+            logger.warning("Dropped update for %s: %d updates already queued", key, depth)
+            return
+
+        self._depth[key] = depth + 1
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        queued_at = time.perf_counter()
+        try:
+            async with lock:
+                await super().process_update(update, self._timed(update, coroutine, queued_at))
+        finally:
+            self._depth[key] -= 1
+            if not self._depth[key]:
+                del self._depth[key]
+                del self._locks[key]
+
+    @staticmethod
+    async def _timed(update: object, coroutine: Awaitable[Any], queued_at: float) -> None:
+        logsetup.bind_update(update)
+        metrics.UPDATE_WAIT_SECONDS.observe(time.perf_counter() - queued_at)
+        await coroutine
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,53 @@
+"""Off-loop execution of blocking upstream calls.
+
+The Supabase client is synchronous, so every ``execute()`` / storage call made
+directly from a handler stalls the event loop for the whole HTTP round-trip.
+Handlers route those calls through :func:`run_blocking`, which runs them on a
+bounded thread pool so many slow requests can be in flight at once.
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, TypeVar
+
+import metrics
+import settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Return the shared upstream thread pool, creating it on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.UPSTREAM_MAX_WORKERS,
+            thread_name_prefix="upstream",
+        )
+        logger.info("Upstream executor started with %d workers", settings.UPSTREAM_MAX_WORKERS)
+    return _executor
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run a blocking call on the upstream executor and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def call_upstream(service: str, operation: str, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Like :func:`run_blocking`, recording the call's latency and errors under ``service``/``operation``."""
+    with metrics.track_upstream(service, operation):
+        return await run_blocking(func, *args, **kwargs)
+
+
+def shutdown() -> None:
+    """Stop the upstream executor, waiting for calls already in flight."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
@@ -0,0 +1,118 @@
+"""Access to the Supabase ``users`` table shared by both entry points.
+
+Registration status almost never changes, so lookups are served from an
+in-process TTL cache keyed by ``telegram_id``. The cache is written through
+whenever this process registers a user or replaces a selfie, so repeat taps on
+"Join" cost no database round-trip. "Not registered" is only cached briefly:
+another process (or ``reconcile.py --repair``) may insert the row.
+
+Inserts are coalesced by a :class:`~batch_writer.BatchWriter`, so a signup
+spike costs a handful of bulk requests rather than one per user, and
+concurrent lookups of the same user share one select.
+
+Showing the main menu starts a prefetch of what "Join" needs
+(:data:`join_prefetch`), so the tap that usually follows finds it ready.
+"""
+import asyncio
+import logging
+from typing import Dict, NamedTuple, Optional
+
+import clients
+import metrics
+import selfies
+import settings
+from batch_writer import BatchWriter
+from cache import TTLCache
+from prefetch import Prefetcher
+from singleflight import SingleFlight
+from upstream import call_upstream
+
+logger = logging.getLogger(__name__)
+
+USERS_TABLE = "users"
+
+registration_cache = TTLCache(
+    maxsize=settings.REGISTRATION_CACHE_SIZE,
+    ttl=settings.REGISTRATION_CACHE_TTL,
+)
+
+lookups = SingleFlight()
+
+# One writer per Supabase client, keyed by client identity
+_writers: Dict[int, BatchWriter] = {}
+
+
+metrics.register_collector("bot_registration_cache", registration_cache.stats)
+metrics.register_collector("bot_registration_lookups", lookups.stats)
+
+
+def users_writer(supabase) -> BatchWriter:
+    """Return the batch writer for the users table of ``supabase``."""
+    writer = _writers.get(id(supabase))
+    if writer is None:
+        writer = _writers[id(supabase)] = BatchWriter(
+            supabase,
+            USERS_TABLE,
+            max_rows=settings.USERS_BATCH_MAX_ROWS,
+            max_delay=settings.USERS_BATCH_MAX_DELAY,
+        )
+    return writer
+
+
+async def is_registered(supabase, telegram_id: int) -> bool:
+    """Return whether ``telegram_id`` has a row in the users table.
+
+    Database errors propagate to the caller and are never cached.
+    """
+    registered = registration_cache.get(telegram_id)
+    if registered is not None:
+        return registered
+
+    response, _ = await lookups.do(
+        (USERS_TABLE, telegram_id),
+        lambda: call_upstream(
+            "supabase",
+            "users.select",
+            supabase.table(USERS_TABLE).select("id").eq("telegram_id", telegram_id).execute,
+        ),
+    )
+    registered = bool(response.data)
+    ttl = None if registered else settings.REGISTRATION_CACHE_NEGATIVE_TTL
+    registration_cache.set(telegram_id, registered, ttl=ttl)
+    logger.debug("Registration lookup for %s: %s (cache %s)", telegram_id, registered, registration_cache.stats())
+    return registered
+
+
+async def register_user(supabase, telegram_id: int):
+    """Insert ``telegram_id`` into the users table and mark it registered in the cache."""
+    result = await users_writer(supabase).insert({"telegram_id": telegram_id})
+    mark_registered(telegram_id)
+    return result
+
+
+def mark_registered(telegram_id: int) -> None:
+    """Record that ``telegram_id`` is registered (after an insert or selfie replacement)."""
+    registration_cache.set(telegram_id, True)
+    join_prefetch.discard(telegram_id)
+
+
+class JoinData(NamedTuple):
+    """What the "Join" screen shows: registration status and the cached selfie ``file_id``."""
+
+    registered: bool
+    file_id: Optional[str]
+
+
+async def join_data(telegram_id: int) -> JoinData:
+    """Look up registration status and the selfie ``file_id`` concurrently."""
+    registered, file_id = await asyncio.gather(
+        is_registered(clients.get_supabase(), telegram_id),
+        selfies.file_ids.get(telegram_id),
+    )
+    return JoinData(registered, file_id)
+
+
+join_prefetch: "Prefetcher[JoinData]" = Prefetcher(
+    join_data, ttl=settings.PREFETCH_TTL, max_concurrent=settings.PREFETCH_MAX_CONCURRENT
+)
+metrics.register_collector("bot_join_prefetch", join_prefetch.stats)